@@ -1,21 +1,35 @@
 # optica_manager_v7.py
 
+import os
 import sys
-import json
+import time
+import platform
 import datetime
-import mysql.connector
+import threading
+import json
+import uuid
+import http.client
+import traceback
+import urllib.parse
+import importlib.util
+from decimal import Decimal
+from datos_optica import (
+    PAGE_SIZE, MONTH_NAMES, METRICS_PORT, SERVICE_PORT, SERVICE_IDLE_S, SERVICE_METHODS, SERVICE_READ_METHODS,
+    ENTITY_FIELDS, IMPORT_SPECS, TRANSACTION_EXPORTS, METRICS, Database, QueryCache, format_cell, is_valid_rut, normalize_text, parse_diopter,
+    read_spreadsheet, transactions_title, wire_dumps, wire_loads, with_progress, write_report, write_spreadsheet,
+)
+
 from PySide6.QtWidgets import (
     QApplication, QWidget, QLabel, QLineEdit, QPushButton, QVBoxLayout, QHBoxLayout,
     QMessageBox, QMainWindow, QDialog, QGridLayout, QSpinBox,
-    QDateEdit, QComboBox, QTabWidget, QTableWidget, QTableWidgetItem,
-    QHeaderView, QAbstractItemView, QTextEdit, QDialogButtonBox, QGroupBox
+    QDateEdit, QComboBox, QTabWidget, QTableView,
+    QAbstractItemView, QTextEdit, QDialogButtonBox, QGroupBox, QFileDialog, QCheckBox, QProgressDialog
 )
-from PySide6.QtCore import QDate, Qt, Signal, QTimer
+from PySide6.QtCore import QDate, Qt, Signal, Slot, QTimer, QAbstractTableModel, QSortFilterProxyModel, QModelIndex, QObject, QRunnable, QThreadPool
 
-def is_valid_rut(rut: str) -> bool:
-    """Valida el formato de un RUT chileno (sin puntos y con guion)."""
-    import re
-    return re.match(r'^\d{7,8}-[\dkK]$', rut.strip())
+SIZE_SAMPLE = 50  # Filas que se miden para calcular el ancho de cada columna.
+MAX_COLUMN_WIDTH = 400
+ROW_OFFSET = "__offset__"  # Llave de paginación para resultados ordenados por relevancia (se pagina por desplazamiento).
 
 class CustomSpinBox(QSpinBox):
     """
@@ -26,156 +40,127 @@ class CustomSpinBox(QSpinBox):
         super().focusInEvent(event)
         QTimer.singleShot(0, self.selectAll)
 
-class Database:
+class DatabaseNotifier(QObject):
     """
-    Gestiona todas las interacciones con la base de datos MySQL para la óptica.
+    Muestra los mensajes de Database en el hilo de la interfaz. Si la consulta corre en un hilo
+    de fondo, la señal se encola y el QMessageBox se abre igual en el hilo principal.
     """
+    message = Signal(str, str, str)
     def __init__(self):
-        self.connection = None
-
-    def connect(self, user, password, host="localhost", db_name="bbdd_optica"):
-        try:
-            self.connection = mysql.connector.connect(host=host, user=user, password=password, database=db_name)
-            return True
-        except mysql.connector.Error as err:
-            QMessageBox.critical(None, "Error de Conexión", f"No se pudo conectar.\nError: {err}"); return False
-
-    def _execute_query(self, query, params=None, fetch=None):
-        if not self.connection or not self.connection.is_connected(): return None
-        cursor = self.connection.cursor(dictionary=True)
-        try:
-            cursor.execute(query, params or ()); is_transactional = any(cmd in query.strip().upper() for cmd in ["INSERT", "UPDATE", "DELETE"])
-            if is_transactional: self.connection.commit(); return cursor.lastrowid if "INSERT" in query.strip().upper() else cursor.rowcount
-            if fetch: return cursor.fetchall() if fetch == 'all' else cursor.fetchone()
+        super().__init__(); self.message.connect(self._show)
+    @Slot(str, str, str)
+    def _show(self, level, title, text): getattr(QMessageBox, level)(None, title, text)
+
+class RemoteDatabase:
+    """
+    Cliente de servidor_optica.py con la misma interfaz que Database: cada método de SERVICE_METHODS viaja como
+    una llamada JSON y los avisos que el servidor habría mostrado vuelven en la respuesta y se muestran aquí.
+    Así la terminal no necesita credenciales de MySQL ni abre conexiones propias.
+    Cada hilo usa su propia conexión HTTP persistente (AsyncQuery llama desde el QThreadPool).
+    """
+    EXPORT_GETTERS = {"Clientes": "get_clients", "Productos": "get_products", "Proveedores": "get_suppliers"}
+    _month_range = staticmethod(Database._month_range)
+
+    def __init__(self, url, timeout=30.0):
+        parsed = urllib.parse.urlsplit(url if "//" in url else f"http://{url}")
+        self.url, self.host, self.port, self.timeout = url, parsed.hostname, parsed.port or SERVICE_PORT, timeout
+        self.notifier = DatabaseNotifier(); self.cache = QueryCache(0); self.metrics = METRICS; self.replica = None; self.offline = False
+        self.token = self.terminal = None; self._local = threading.local()
+
+    def _notify(self, level, title, text): self.notifier.message.emit(level, title, text)
+
+    def _connection(self, fresh=False):
+        conn, last_used = getattr(self._local, 'conn', None), getattr(self._local, 'last_used', 0)
+        if conn is not None and (fresh or time.monotonic() - last_used > SERVICE_IDLE_S): conn.close(); conn = None
+        if conn is None: conn = self._local.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return conn
+
+    def _request(self, method, path, payload=None, retry=True):
+        """(estado HTTP, cuerpo decodificado). Solo se reintenta con una conexión nueva si `retry` (lecturas)."""
+        headers = {"Authorization": f"Bearer {self.token}", "X-Terminal": self.terminal or "", "Content-Type": "application/json"}
+        for attempt in range(2):
+            conn = self._connection(fresh=attempt > 0)
+            try:
+                conn.request(method, path, body=wire_dumps(payload) if payload is not None else None, headers=headers)
+                response = conn.getresponse(); body = response.read(); self._local.last_used = time.monotonic()
+                return response.status, wire_loads(body) if body else None
+            except (OSError, http.client.HTTPException):
+                conn.close(); self._local.conn = None
+                if attempt or not retry: raise
+
+    def connect(self, user, password, host=None, **kwargs):
+        """`password` es la clave del servicio (--token del servidor); `user` identifica a la terminal en el registro del servidor."""
+        self.terminal, self.token = user, password
+        try: status, _ = self._request("GET", "/salud")
+        except (OSError, http.client.HTTPException) as err: self._notify('critical', "Error de Conexión", f"No se pudo conectar con el servidor {self.host}:{self.port}.\nError: {err}"); return False
+        if status == 401: self._notify('critical', "Error de Conexión", "La clave del servicio no es correcta."); return False
+        return status == 200
+
+    def call(self, method, *args, **kwargs):
+        try: status, response = self._request("POST", "/api", {"metodo": method, "args": args, "kwargs": kwargs}, retry=method in SERVICE_READ_METHODS)
+        except (OSError, http.client.HTTPException) as err:
+            self._notify('critical', "Error de Conexión", f"Se perdió la conexión con el servidor.\nError: {err}"); return None
+        for level, title, text in (response or {}).get("mensajes", ()): self._notify(level, title, text)
+        if status != 200 or not response or "error" in response:
+            self._notify('critical', "Error del Servidor", (response or {}).get("error", f"HTTP {status}")); return None
+        return response["resultado"]
+
+    def __getattr__(self, name):
+        if name in SERVICE_METHODS: return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+    def import_entities(self, entity_name: str, rows, batch_size=500) -> dict:
+        """Envía la planilla en lotes de `batch_size` filas (una llamada por lote) y junta los informes."""
+        report, batch = {"procesadas": 0, "errores": []}, []
+        def send():
+            result = self.call("import_entities", entity_name, batch, batch_size)
+            if result is None: return False
+            report["procesadas"] += result["procesadas"]; report["errores"] += [tuple(e) for e in result["errores"]]; return True
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                if not send(): return None
+                batch = []
+        if batch and not send(): return None
+        return report
+
+    def export_entity(self, entity_name: str, path: str, chunk_size=1000):
+        """Como Database.export_entity, pero leyendo por páginas del servicio (el archivo se escribe en esta terminal)."""
+        spec = IMPORT_SPECS[entity_name]; columns = [spec['id_col']] + list(ENTITY_FIELDS[entity_name]); getter = getattr(self, self.EXPORT_GETTERS[entity_name])
+        def pages():
+            after = None
+            while True:
+                rows = getter("", after, chunk_size)
+                if rows is None: raise OSError("se perdió la conexión con el servidor")
+                if not rows: return
+                yield columns, [tuple(r[c] for c in columns) for r in rows]; after = rows[-1][spec['id_col']]
+        try: return write_spreadsheet(path, pages())
+        except (OSError, ImportError) as err: self._notify('critical', "Error de Exportación", f"No se pudo exportar.\n{err}"); return None
+
+    def export_transactions(self, type: str, start_date, end_date, path: str, progress=None, vendedor: str = None, chunk_size=1000):
+        """Como Database.export_transactions, leyendo del servicio de a `chunk_size` transacciones por llamada."""
+        total = self.count_transaction_lines(type, start_date, end_date, vendedor)
+        if total is None: return None
+        id_col = TRANSACTION_EXPORTS[type][3]
+        def pages():
+            after = None
+            while True:
+                rows = self.get_transaction_lines(type, start_date, end_date, after, chunk_size, vendedor)
+                if rows is None: raise OSError("se perdió la conexión con el servidor")
+                if not rows: return
+                yield list(rows[0]), [tuple(r.values()) for r in rows]; after = (rows[-1]['fecha'], rows[-1][id_col])
+        try: return write_report(path, with_progress(pages(), total, progress), transactions_title(type, start_date, end_date, vendedor))
+        except InterruptedError:
+            try: os.remove(path)
+            except OSError: pass
             return None
-        except mysql.connector.Error as err:
-            QMessageBox.critical(None, "Error de Base de Datos", f"No se pudo ejecutar la operación.\n\nError: {err}"); self.connection.rollback(); return None
-        finally: cursor.close()
-
-    def _generic_delete(self, table_name, id_col, item_id, success_msg="Registro eliminado."):
-        query = f"DELETE FROM {table_name} WHERE {id_col} = %s"
-        try:
-            rows_affected = self._execute_query(query, (item_id,))
-            if rows_affected > 0: return {"success": True, "message": success_msg}
-            else: return {"success": False, "message": "No se encontró el registro para eliminar."}
-        except Exception as e: return {"success": False, "message": f"No se puede eliminar.\nError: {e}"}
-
-    def get_clients(self, search_term: str = "") -> list:
-        query = "SELECT id_cliente, nombre, apellido, rut, telefono, correo, direccion FROM Clientes"
-        if search_term: query += " WHERE nombre LIKE %s OR apellido LIKE %s OR rut LIKE %s"
-        return self._execute_query(query, (f"%{search_term}%",)*3 if search_term else None, fetch='all')
-
-    def add_client(self, data: dict):
-        if self._execute_query("SELECT 1 FROM Clientes WHERE rut = %s", (data['rut'],), fetch='one'):
-            QMessageBox.warning(None, "RUT Duplicado", f"El RUT '{data['rut']}' ya está registrado."); return None
-        return self._execute_query("INSERT INTO Clientes (nombre, apellido, rut, telefono, correo, direccion) VALUES (%s, %s, %s, %s, %s, %s)", tuple(data.values()))
-    
-    def update_client(self, client_id: int, data: dict):
-        if self._execute_query("SELECT id_cliente FROM Clientes WHERE rut = %s AND id_cliente != %s", (data['rut'], client_id), fetch='one'):
-            QMessageBox.warning(None, "RUT Duplicado", f"El RUT '{data['rut']}' ya pertenece a otro cliente."); return None
-        return self._execute_query("UPDATE Clientes SET nombre=%s, apellido=%s, rut=%s, telefono=%s, correo=%s, direccion=%s WHERE id_cliente=%s", tuple(data.values()) + (client_id,))
-    
-    def delete_client(self, client_id: int):
-        if self._execute_query("SELECT 1 FROM Examenes WHERE id_cliente = %s", (client_id,), fetch='one'): return {"success": False, "message": "No se puede eliminar. El cliente tiene recetas médicas asociadas."}
-        if self._execute_query("SELECT 1 FROM Ordenes WHERE id_cliente = %s", (client_id,), fetch='one'): return {"success": False, "message": "No se puede eliminar. El cliente tiene ventas asociadas."}
-        return self._generic_delete("Clientes", "id_cliente", client_id)
-
-    def get_products(self, search_term: str = "") -> list:
-        query = "SELECT id_producto, nombre, tipo, marca, stock, precio_compra, precio_venta FROM Productos"
-        if search_term: query += " WHERE nombre LIKE %s OR tipo LIKE %s OR marca LIKE %s"
-        return self._execute_query(query, (f"%{search_term}%",)*3 if search_term else None, fetch='all')
-
-    def add_product(self, data: dict):
-        return self._execute_query("INSERT INTO Productos (nombre, tipo, marca, stock, precio_compra, precio_venta) VALUES (%s, %s, %s, %s, %s, %s)", tuple(data.values()))
-
-    def update_product(self, product_id: int, data: dict):
-        return self._execute_query("UPDATE Productos SET nombre=%s, tipo=%s, marca=%s, stock=%s, precio_compra=%s, precio_venta=%s WHERE id_producto=%s", tuple(data.values()) + (product_id,))
-
-    def delete_product(self, product_id: int):
-        if self._execute_query("SELECT 1 FROM DetalleOrden WHERE id_producto = %s", (product_id,), fetch='one'): return {"success": False, "message": "No se puede eliminar. El producto está incluido en ventas registradas."}
-        if self._execute_query("SELECT 1 FROM DetalleCompra WHERE id_producto = %s", (product_id,), fetch='one'): return {"success": False, "message": "No se puede eliminar. El producto está incluido en compras registradas."}
-        return self._generic_delete("Productos", "id_producto", product_id)
-
-    def get_suppliers(self, search_term: str = "") -> list:
-        query = "SELECT id_proveedor, nombre, contacto, telefono, direccion FROM Proveedores"
-        if search_term: query += " WHERE nombre LIKE %s OR contacto LIKE %s"
-        return self._execute_query(query, (f"%{search_term}%",)*2 if search_term else None, fetch='all')
-        
-    def add_supplier(self, data: dict): return self._execute_query("INSERT INTO Proveedores (nombre, contacto, telefono, direccion) VALUES (%s, %s, %s, %s)", tuple(data.values()))
-    def update_supplier(self, supplier_id: int, data: dict): return self._execute_query("UPDATE Proveedores SET nombre=%s, contacto=%s, telefono=%s, direccion=%s WHERE id_proveedor=%s", tuple(data.values()) + (supplier_id,))
-    def delete_supplier(self, supplier_id: int):
-        if self._execute_query("SELECT 1 FROM Compras WHERE id_proveedor = %s", (supplier_id,), fetch='one'): return {"success": False, "message": "No se puede eliminar. El proveedor tiene compras asociadas."}
-        return self._generic_delete("Proveedores", "id_proveedor", supplier_id)
-
-    def get_exams_for_client(self, client_id: int) -> list: return self._execute_query("SELECT id_examen, fecha, diagnostico, observaciones FROM Examenes WHERE id_cliente = %s ORDER BY fecha DESC", (client_id,), fetch='all')
-    def get_exam_details(self, exam_id: int) -> dict: return self._execute_query("SELECT * FROM Examenes WHERE id_examen = %s", (exam_id,), fetch='one')
-    def add_exam(self, data: dict): return self._execute_query("INSERT INTO Examenes (id_cliente, fecha, diagnostico, receta, observaciones) VALUES (%s, %s, %s, %s, %s)", tuple(data.values()))
-    def update_exam(self, exam_id: int, data: dict): return self._execute_query("UPDATE Examenes SET id_cliente=%s, fecha=%s, diagnostico=%s, receta=%s, observaciones=%s WHERE id_examen=%s", tuple(data.values()) + (exam_id,))
-    def delete_exam(self, exam_id: int): return self._generic_delete("Examenes", "id_examen", exam_id, "Receta eliminada.")
-
-    def create_sale(self, client_id: int, total: int, vendedor: str, details: list):
-        if not self.connection or not self.connection.is_connected(): return None
-        cursor = self.connection.cursor()
-        try:
-            query = "INSERT INTO Ordenes (id_cliente, fecha, total, vendedor, estado) VALUES (%s, %s, %s, %s, %s)"
-            cursor.execute(query, (client_id, datetime.datetime.now().date(), total, vendedor, 'Pagada'))
-            order_id = cursor.lastrowid
-            for detail in details:
-                cursor.execute("INSERT INTO DetalleOrden (id_orden, id_producto, cantidad, precio) VALUES (%s, %s, %s, %s)", (order_id, detail['id_producto'], detail['cantidad'], detail['precio_venta']))
-                cursor.execute("UPDATE Productos SET stock = stock - %s WHERE id_producto = %s", (detail['cantidad'], detail['id_producto']))
-            self.connection.commit(); return order_id
-        except mysql.connector.Error as err:
-            self.connection.rollback(); QMessageBox.critical(None, "Error en Venta", f"No se pudo completar la transacción.\n{err}"); return None
-        finally: cursor.close()
-    
-    def create_purchase(self, supplier_id: int, total: int, details: list):
-        if not self.connection or not self.connection.is_connected(): return None
-        cursor = self.connection.cursor()
-        try:
-            query = "INSERT INTO Compras (id_proveedor, fecha, total) VALUES (%s, %s, %s)"
-            cursor.execute(query, (supplier_id, datetime.datetime.now().date(), total))
-            purchase_id = cursor.lastrowid
-            for detail in details:
-                cursor.execute("INSERT INTO DetalleCompra (id_compra, id_producto, cantidad, precio_unitario) VALUES (%s, %s, %s, %s)", (purchase_id, detail['id_producto'], detail['cantidad'], detail['precio_compra']))
-                cursor.execute("UPDATE Productos SET stock = stock + %s WHERE id_producto = %s", (detail['cantidad'], detail['id_producto']))
-            self.connection.commit(); return purchase_id
-        except mysql.connector.Error as err:
-            self.connection.rollback(); QMessageBox.critical(None, "Error en Compra", f"No se pudo completar la transacción.\n{err}"); return None
-        finally: cursor.close()
-
-    def get_transactions_by_date(self, type: str, start_date, end_date) -> list:
-        if type == 'Venta': query = "SELECT o.id_orden, o.fecha, c.nombre, c.apellido, o.vendedor, o.total FROM Ordenes o JOIN Clientes c ON o.id_cliente = c.id_cliente WHERE o.fecha BETWEEN %s AND %s ORDER BY o.fecha DESC"
-        else: query = "SELECT c.id_compra, c.fecha, p.nombre, c.total FROM Compras c JOIN Proveedores p ON c.id_proveedor = p.id_proveedor WHERE c.fecha BETWEEN %s AND %s ORDER BY c.fecha DESC"
-        return self._execute_query(query, (start_date, end_date), fetch='all')
-
-    def delete_transaction(self, type: str, transaction_id: int):
-        if not self.connection or not self.connection.is_connected(): return {"success": False, "message": "Sin conexión."}
-        cursor = self.connection.cursor(dictionary=True)
-        detail_table, main_table, id_col_main, stock_op = ("DetalleOrden", "Ordenes", "id_orden", "+") if type == 'Venta' else ("DetalleCompra", "Compras", "id_compra", "-")
-        try:
-            cursor.execute(f"SELECT id_producto, cantidad FROM {detail_table} WHERE {id_col_main} = %s", (transaction_id,)); details_to_revert = cursor.fetchall()
-            for detail in details_to_revert: cursor.execute(f"UPDATE Productos SET stock = stock {stock_op} %s WHERE id_producto = %s", (detail['cantidad'], detail['id_producto']))
-            cursor.execute(f"DELETE FROM {detail_table} WHERE {id_col_main} = %s", (transaction_id,)); cursor.execute(f"DELETE FROM {main_table} WHERE {id_col_main} = %s", (transaction_id,))
-            self.connection.commit(); return {"success": True}
-        except mysql.connector.Error as err:
-            self.connection.rollback(); return {"success": False, "message": f"No se pudo eliminar la transacción.\n{err}"}
-        finally: cursor.close()
-
-    def get_unique_sellers(self) -> list:
-        query = "SELECT DISTINCT vendedor FROM Ordenes WHERE vendedor IS NOT NULL AND vendedor != '' ORDER BY vendedor"
-        return self._execute_query(query, fetch='all')
-
-    def get_sales_by_month(self, year: int, month: int, vendedor: str = None) -> list:
-        query = "SELECT fecha, id_orden, vendedor, total FROM Ordenes WHERE YEAR(fecha) = %s AND MONTH(fecha) = %s"
-        params = [year, month]
-        if vendedor:
-            query += " AND vendedor = %s"
-            params.append(vendedor)
-        query += " ORDER BY fecha ASC"
-        return self._execute_query(query, params, fetch='all')
-        
+        except (OSError, ImportError) as err: self._notify('critical', "Error de Exportación", f"No se pudo exportar.\n{err}"); return None
+
+    def sync_status(self) -> str: return f"Conectado al servidor {self.host}:{self.port}"
+    def request_sync(self): pass
     def close(self):
-        if self.connection and self.connection.is_connected(): self.connection.close()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None: conn.close()
 
 class LoginWindow(QDialog):
     def __init__(self, db_instance):
@@ -185,22 +170,228 @@ class LoginWindow(QDialog):
         connect_btn.clicked.connect(self.try_connect); layout.addWidget(QLabel("Host:"), 0, 0); layout.addWidget(self.host_input, 0, 1)
         layout.addWidget(QLabel("Usuario:"), 1, 0); layout.addWidget(self.user_input, 1, 1); layout.addWidget(QLabel("Contraseña:"), 2, 0)
         layout.addWidget(self.pass_input, 2, 1); layout.addWidget(connect_btn, 3, 1)
+        if isinstance(self.db, RemoteDatabase): self.host_input.setText(self.db.url); self.host_input.setEnabled(False); self.user_input.setText(platform.node()); self.pass_input.setPlaceholderText("Clave del servicio")
     def try_connect(self):
         if self.db.connect(user=self.user_input.text(), password=self.pass_input.text(), host=self.host_input.text()): self.accept()
 
-def populate_table(table: QTableWidget, data: list, hidden_id_col=True):
-    table.clear(); table.setRowCount(0); table.setColumnCount(0)
-    if not data: return
-    headers = list(data[0].keys()); table.setColumnCount(len(headers)); table.setHorizontalHeaderLabels([h.replace('_',' ').title() for h in headers]); table.setRowCount(len(data))
-    for r, row_data in enumerate(data):
-        for c, h in enumerate(headers):
-            value = row_data[h]; item = QTableWidgetItem()
-            if isinstance(value, datetime.date): value = value.strftime('%Y-%m-%d')
-            item.setData(Qt.DisplayRole, str(value) if value is not None else ""); 
-            if h.startswith('id_'): item.setData(Qt.UserRole, value)
-            table.setItem(r, c, item)
-    table.resizeColumnsToContents(); table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-    if hidden_id_col and headers and headers[0].startswith('id_'): table.hideColumn(0)
+class RowTableModel(QAbstractTableModel):
+    """
+    Modelo de solo lectura sobre filas guardadas como tuplas: no crea un objeto por celda y el texto
+    se formatea recién cuando la vista pide la celda en data() (solo las visibles).
+    Qt.UserRole entrega el valor original y SortRole una versión comparable por QSortFilterProxyModel.
+    """
+    SortRole = Qt.UserRole + 1
+    def __init__(self, parent=None): super().__init__(parent); self.headers = []; self.labels = None; self._rows = []
+    def set_rows(self, data, labels=None):
+        """`data` es una lista de diccionarios con las mismas llaves; `labels` reemplaza los títulos derivados de ellas."""
+        self.beginResetModel(); self.headers = list(data[0].keys()) if data else []; self.labels = labels; self._rows = [tuple(row.values()) for row in data]; self.endResetModel()
+    def update_row(self, row, values): self._rows[row] = tuple(values); self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount() - 1))
+    def rowCount(self, parent=QModelIndex()): return 0 if parent.isValid() else len(self._rows)
+    def columnCount(self, parent=QModelIndex()): return 0 if parent.isValid() else len(self.labels or self.headers)
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid(): return None
+        value = self._rows[index.row()][index.column()]
+        if role == Qt.DisplayRole: return format_cell(value)
+        if role == Qt.UserRole: return value
+        if role == self.SortRole: return float(value) if isinstance(value, Decimal) else value
+        return None
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal and section < self.columnCount(): return self.labels[section] if self.labels else self.headers[section].replace('_',' ').title()
+        return super().headerData(section, orientation, role)
+    def raw(self, row, column=0): return self._rows[row][column]
+    def display_row(self, row): return {h: format_cell(v) for h, v in zip(self.headers, self._rows[row])}
+
+class LazyTableModel(RowTableModel):
+    """
+    RowTableModel que carga las filas por páginas a medida que el usuario se desplaza
+    (canFetchMore/fetchMore), de modo que abrir una tabla grande solo trae la primera página.
+    `fetch_page(after, limit)` devuelve una lista de diccionarios; `key` nombra las columnas que
+    forman la llave de paginación (por defecto, la primera columna) o es ROW_OFFSET para paginar
+    por desplazamiento los resultados ordenados por relevancia.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent); self._fetch_page = None; self._key_idx = (0,); self._exhausted = True; self.page_size = PAGE_SIZE
+    def set_source(self, fetch_page, key=None, page_size=PAGE_SIZE, first_page=None):
+        """`first_page` permite entregar la primera página ya consultada en un hilo de fondo (ver AsyncQuery)."""
+        self.beginResetModel(); self._fetch_page, self.page_size = fetch_page, page_size
+        page = (fetch_page(None, page_size) if first_page is None else first_page) or []
+        self.headers = list(page[0].keys()) if page else []
+        self._key_idx = None if key == ROW_OFFSET else tuple(self.headers.index(k) for k in key) if key and self.headers else (0,)
+        self._rows = [tuple(row.values()) for row in page]; self._exhausted = len(page) < page_size
+        self.endResetModel()
+    def clear(self): self.beginResetModel(); self.headers, self._rows, self._fetch_page, self._exhausted = [], [], None, True; self.endResetModel()
+    def canFetchMore(self, parent=QModelIndex()): return not parent.isValid() and not self._exhausted
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self._exhausted or not self._rows: return
+        if self._key_idx is None: after = len(self._rows)
+        else: after = tuple(self._rows[-1][i] for i in self._key_idx); after = after if len(after) > 1 else after[0]
+        page = self._fetch_page(after, self.page_size) or []
+        self._exhausted = len(page) < self.page_size
+        if not page: return
+        self.beginInsertRows(QModelIndex(), len(self._rows), len(self._rows) + len(page) - 1); self._rows.extend(tuple(row.values()) for row in page); self.endInsertRows()
+
+def _setup_view(view, model, selection_mode):
+    view.setModel(model); view.setEditTriggers(QAbstractItemView.NoEditTriggers); view.setSelectionBehavior(QAbstractItemView.SelectRows); view.setSelectionMode(selection_mode)
+    view.horizontalHeader().setStretchLastSection(True); return view
+
+def create_lazy_view(selection_mode=QAbstractItemView.SingleSelection):
+    view = QTableView(); return _setup_view(view, LazyTableModel(view), selection_mode)
+
+def create_table_view(sortable=True, selection_mode=QAbstractItemView.SingleSelection):
+    """Vista sobre un RowTableModel; si es ordenable, se intercala un QSortFilterProxyModel que ordena índices sin copiar las filas."""
+    view = QTableView(); model = RowTableModel(view)
+    if not sortable: return _setup_view(view, model, selection_mode)
+    proxy = QSortFilterProxyModel(view); proxy.setSourceModel(model); proxy.setSortRole(RowTableModel.SortRole); _setup_view(view, proxy, selection_mode)
+    view.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder); view.setSortingEnabled(True)  # Sin orden inicial: se respeta el de la consulta.
+    return view
+
+def source_model(view): model = view.model(); return model.sourceModel() if isinstance(model, QSortFilterProxyModel) else model
+
+def fit_columns(view, sample=SIZE_SAMPLE):
+    """Ancho de cada columna según el título y las primeras `sample` filas (resizeColumnsToContents mide todas las celdas)."""
+    model, metrics = view.model(), view.fontMetrics(); rows = min(sample, model.rowCount())
+    for c in range(model.columnCount()):
+        texts = [model.headerData(c, Qt.Horizontal)] + [model.index(r, c).data() for r in range(rows)]
+        view.setColumnWidth(c, min(MAX_COLUMN_WIDTH, max(metrics.horizontalAdvance(t or "") for t in texts) + 24))
+
+def populate_table(view: QTableView, data: list, hidden_id_col=True, labels=None):
+    with METRICS.timer("ui.populate_table", len(data or ())):
+        model = source_model(view); model.set_rows(data or [], labels)
+        if model.headers: view.setColumnHidden(0, hidden_id_col and model.headers[0].startswith('id_'))
+        fit_columns(view)
+
+def populate_lazy_table(view: QTableView, fetch_page, key=None, hidden_id_col=True, first_page=None):
+    with METRICS.timer("ui.populate_lazy_table", len(first_page or ())):
+        model = view.model(); model.set_source(fetch_page, key, first_page=first_page)
+        if model.headers: view.setColumnHidden(0, hidden_id_col and model.headers[0].startswith('id_'))
+        fit_columns(view)
+
+def selected_row(view: QTableView):
+    rows = view.selectionModel().selectedRows()
+    return rows[0].row() if rows else None
+
+def selected_value(view: QTableView, column=0):
+    """Valor original (Qt.UserRole) de la columna `column` de la fila seleccionada, pase o no la vista por un proxy de orden."""
+    rows = view.selectionModel().selectedRows(column)
+    return rows[0].data(Qt.UserRole) if rows else None
+
+def select_source_row(view: QTableView, row):
+    model = view.model(); index = source_model(view).index(row, 0)
+    view.selectRow((model.mapFromSource(index) if model is not source_model(view) else index).row())
+
+class _QuerySignals(QObject):
+    done = Signal(int, object)
+
+class _QueryRunnable(QRunnable):
+    def __init__(self, generation, fn, args):
+        super().__init__(); self.generation, self.fn, self.args = generation, fn, args; self.signals = _QuerySignals()
+        self.setAutoDelete(False)  # La referencia la guarda AsyncQuery hasta que llega `done`; así tryTake nunca toca un objeto ya borrado
+    def run(self):
+        try: result = self.fn(*self.args)
+        except Exception: traceback.print_exc(); result = None
+        self.signals.done.emit(self.generation, result)
+
+class AsyncQuery(QObject):
+    """
+    Ejecuta llamadas a Database en el QThreadPool global para no bloquear la interfaz.
+    Las llamadas con `debounce` esperan `delay_ms` sin nuevas pulsaciones antes de salir; cada
+    envío invalida al anterior (si aún no empezó se retira de la cola y si ya está en curso su
+    resultado se descarta), de modo que `result_ready(resultado, contexto)` solo entrega el último.
+    """
+    result_ready = Signal(object, object)
+    def __init__(self, parent=None, delay_ms=250):
+        super().__init__(parent); self._generation = 0; self._pending = None; self._queued = None; self._running = set()
+        self._timer = QTimer(self); self._timer.setSingleShot(True); self._timer.setInterval(delay_ms); self._timer.timeout.connect(self._launch)
+    def submit(self, fn, *args, context=None, debounce=False):
+        self.cancel(); self._pending = (fn, args, context)
+        if debounce: self._timer.start()
+        else: self._launch()
+    def busy(self): return self._pending is not None or self._queued is not None
+    def cancel(self):
+        self._generation += 1; self._timer.stop(); self._pending = None
+        if self._queued is not None:
+            if QThreadPool.globalInstance().tryTake(self._queued): self._running.discard(self._queued)
+            self._queued = None
+    def _launch(self):
+        if self._pending is None: return
+        fn, args, context = self._pending; self._pending = None
+        runnable = _QueryRunnable(self._generation, fn, args); runnable.signals.done.connect(lambda generation, result: self._deliver(runnable, generation, result, context))
+        self._running.add(runnable); self._queued = runnable; QThreadPool.globalInstance().start(runnable)
+    def _deliver(self, runnable, generation, result, context):
+        self._running.discard(runnable)
+        if generation != self._generation: return
+        self._queued = None; self.result_ready.emit(result, context)
+
+class _ProgressSignals(QObject):
+    progress = Signal(int, int)
+
+def run_with_progress(parent, label, fn, on_done):
+    """
+    Ejecuta `fn(progress)` en el QThreadPool mostrando un QProgressDialog. `progress(hechas, total)` se puede llamar
+    desde el hilo de fondo (la señal se encola) y devuelve False si el usuario canceló; `on_done(resultado)` corre en la interfaz.
+    """
+    dialog = QProgressDialog(label, "Cancelar", 0, 0, parent); dialog.setWindowModality(Qt.WindowModal); dialog.setMinimumDuration(300); dialog.setAutoReset(False)
+    signals = _ProgressSignals(dialog); cancelled = threading.Event(); dialog.canceled.connect(cancelled.set)
+    signals.progress.connect(lambda done, total: (dialog.setMaximum(max(total, 1)), dialog.setValue(min(done, max(total, 1)))))
+    def progress(done, total): signals.progress.emit(done, total); return not cancelled.is_set()
+    def finish(result, _context): dialog.close(); dialog.deleteLater(); on_done(result)
+    query = AsyncQuery(dialog); query.result_ready.connect(finish); query.submit(fn, progress); return dialog
+
+def check_openpyxl(parent, path):
+    """Avisa antes de empezar si se eligió un archivo Excel y openpyxl (dependencia opcional) no está instalado."""
+    if path.lower().endswith('.xlsx') and importlib.util.find_spec('openpyxl') is None:
+        QMessageBox.warning(parent, "Falta Dependencia", "Para trabajar con archivos Excel instale openpyxl:\npip install openpyxl"); return False
+    return True
+
+def export_transactions_dialog(parent, db, type, start, end, vendedor=None):
+    """Pide el archivo y exporta con Database.export_transactions en segundo plano, con barra de progreso."""
+    path, _ = QFileDialog.getSaveFileName(parent, "Exportar Historial", f"{'ventas' if type == 'Venta' else 'compras'}_{start}_{end}.csv", "CSV (*.csv);;Excel (*.xlsx);;PDF (*.pdf)")
+    if not path: return
+    if not path.lower().endswith(('.csv', '.xlsx', '.pdf')): QMessageBox.warning(parent, "Formato no Soportado", "Elija un archivo .csv, .xlsx o .pdf."); return
+    if not check_openpyxl(parent, path): return
+    def done(rows):
+        if rows is not None: QMessageBox.information(parent, "Exportación", f"Se exportaron {rows:,} líneas a {path}.")
+    run_with_progress(parent, "Exportando historial...", lambda progress: db.export_transactions(type, start, end, path, progress, vendedor), done)
+
+class ProductCatalog(QObject):
+    """
+    Caché del catálogo de productos compartida por las ventanas de venta y compra. Mantiene un índice
+    id -> fila y una clave de búsqueda normalizada por producto, y se refresca cada `interval_ms` en
+    segundo plano trayendo solo las filas con `updated_at` reciente (las ventas de otras terminales
+    también lo actualizan). `changed` entrega el conjunto de ids modificados, nuevos o eliminados.
+    """
+    changed = Signal(object)
+    SYNC_OVERLAP = datetime.timedelta(seconds=60)  # Cubre transacciones cuyo commit llega después de fijar updated_at.
+    def __init__(self, db, interval_ms=5000, parent=None):
+        super().__init__(parent); self.db = db; self.by_id = {}; self._keys = {}; self._last_sync = None; self.loaded = False
+        self._query = AsyncQuery(self); self._query.result_ready.connect(self._apply)
+        # La primera carga también va en segundo plano: la ventana se muestra de inmediato y las filas llegan con `changed`.
+        self._timer = QTimer(self); self._timer.setInterval(interval_ms); self._timer.timeout.connect(lambda: self._query.busy() or self.refresh())
+        self.refresh(full=True); self._timer.start()
+    def refresh(self, full=False):
+        since = None if full or self._last_sync is None else self._last_sync - self.SYNC_OVERLAP
+        self._query.submit(self.db.get_product_changes, since, context='full' if since is None else 'delta')
+    def _apply(self, result, mode):
+        if result is None: return
+        rows, total = result; changed = set()
+        if mode == 'full':
+            removed = set(self.by_id) - {row['id_producto'] for row in rows}
+            for product_id in removed: del self.by_id[product_id]; del self._keys[product_id]
+            changed |= removed
+        for row in rows:
+            updated_at = row.pop('updated_at'); self._last_sync = max(self._last_sync or updated_at, updated_at)
+            if self.by_id.get(row['id_producto']) != row:
+                self.by_id[row['id_producto']] = row; self._keys[row['id_producto']] = normalize_text(f"{row['nombre']} {row['tipo']} {row['marca'] or ''}"); changed.add(row['id_producto'])
+        if mode == 'delta' and total != len(self.by_id): self.refresh(full=True)  # Se eliminó un producto en otra terminal.
+        if mode == 'full': self.loaded = True
+        if changed: self.changed.emit(changed)
+    def get(self, product_id): return self.by_id.get(product_id)
+    def rows(self): return list(self.by_id.values())
+    def matches(self, product_id, term):
+        key = self._keys.get(product_id); return key is not None and all(w in key for w in normalize_text(term).split())
+    def search(self, term):
+        words = normalize_text(term).split()
+        return [self.by_id[product_id] for product_id, key in self._keys.items() if all(w in key for w in words)]
 
 class GenericManagerWidget(QWidget):
     def __init__(self, db, entity_name, fields, get_method, add_method, update_method, delete_method, parent=None):
@@ -208,20 +399,26 @@ class GenericManagerWidget(QWidget):
         self.get_method, self.add_method, self.update_method, self.delete_method = get_method, add_method, update_method, delete_method
         self.setWindowTitle(f"Gestionar {self.entity_name}"); self.setMinimumSize(800, 600)
         main_layout = QVBoxLayout(self); action_layout = QHBoxLayout()
-        self.search_input = QLineEdit(); self.search_input.setPlaceholderText(f"Buscar..."); self.search_input.textChanged.connect(self.load_data)
+        self.search_input = QLineEdit(); self.search_input.setPlaceholderText(f"Buscar..."); self.search_input.textChanged.connect(lambda: self.load_data(debounce=True))
         add_btn, self.edit_btn, self.delete_btn = QPushButton("➕ Agregar"), QPushButton("✏️ Editar"), QPushButton("🗑️ Eliminar")
         add_btn.clicked.connect(self.add_item); self.edit_btn.clicked.connect(self.edit_item); self.delete_btn.clicked.connect(self.delete_item)
         action_layout.addWidget(self.search_input); action_layout.addWidget(add_btn); action_layout.addWidget(self.edit_btn); action_layout.addWidget(self.delete_btn)
-        self.table = QTableWidget(); self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
-        self.table.setSelectionBehavior(QAbstractItemView.SelectRows); self.table.setSelectionMode(QAbstractItemView.SingleSelection)
-        self.table.itemSelectionChanged.connect(self.update_button_state); main_layout.addLayout(action_layout); main_layout.addWidget(self.table)
+        self.import_btn, self.export_btn = QPushButton("📥 Importar"), QPushButton("📤 Exportar"); self.import_btn.clicked.connect(self.import_items); self.export_btn.clicked.connect(self.export_items)
+        self.io_query = AsyncQuery(self); self.io_query.result_ready.connect(self.show_io_result)
+        if self.entity_name in IMPORT_SPECS: action_layout.addWidget(self.import_btn); action_layout.addWidget(self.export_btn)
+        self.table = create_lazy_view(); self.table.selectionModel().selectionChanged.connect(self.update_button_state); main_layout.addLayout(action_layout); main_layout.addWidget(self.table)
+        self.query = AsyncQuery(self); self.query.result_ready.connect(self.show_page)
         self.load_data(); self.update_button_state()
-    def load_data(self): populate_table(self.table, getattr(self.db, self.get_method)(self.search_input.text())); self.update_button_state()
-    def update_button_state(self): has_selection = bool(self.table.selectedItems()); self.edit_btn.setEnabled(has_selection); self.delete_btn.setEnabled(has_selection)
+    def load_data(self, debounce=False):
+        search_term = self.search_input.text(); get_page = getattr(self.db, self.get_method)
+        fetch_page = lambda after, limit: get_page(search_term, after, limit)
+        self.query.submit(fetch_page, None, PAGE_SIZE, context=(fetch_page, ROW_OFFSET if search_term else None), debounce=debounce)
+    def show_page(self, page, context): populate_lazy_table(self.table, context[0], key=context[1], first_page=page); self.update_button_state()
+    def update_button_state(self): has_selection = self.table.selectionModel().hasSelection(); self.edit_btn.setEnabled(has_selection); self.delete_btn.setEnabled(has_selection)
     def get_selected_id(self):
-        selected_rows = self.table.selectionModel().selectedRows()
-        if not selected_rows: return None, None
-        return self.table.item(selected_rows[0].row(), 0).data(Qt.UserRole), selected_rows[0].row()
+        row = selected_row(self.table)
+        if row is None: return None, None
+        return self.table.model().raw(row, 0), row
     def add_item(self):
         dialog = GenericEditDialog(self.entity_name, self.fields); 
         if dialog.exec() == QDialog.Accepted:
@@ -230,7 +427,7 @@ class GenericManagerWidget(QWidget):
     def edit_item(self):
         item_id, row_index = self.get_selected_id()
         if item_id is None: return
-        current_data = {self.table.horizontalHeaderItem(i).text().lower().replace(' ', '_'): self.table.item(row_index, i).data(Qt.DisplayRole) for i in range(self.table.columnCount())}
+        current_data = self.table.model().display_row(row_index)
         dialog = GenericEditDialog(self.entity_name, self.fields, current_data)
         if dialog.exec() == QDialog.Accepted:
             new_data = dialog.validate_and_get_data()
@@ -242,6 +439,26 @@ class GenericManagerWidget(QWidget):
             result = getattr(self.db, self.delete_method)(item_id)
             if result['success']: QMessageBox.information(self, "Éxito", result['message']); self.load_data()
             else: QMessageBox.warning(self, "Error", result['message'])
+    def import_items(self):
+        path, _ = QFileDialog.getOpenFileName(self, f"Importar {self.entity_name}", "", "Planillas (*.csv *.xlsx)")
+        if not path or not check_openpyxl(self, path): return
+        self.import_btn.setEnabled(False); self.export_btn.setEnabled(False)
+        self.io_query.submit(lambda: self.db.import_entities(self.entity_name, read_spreadsheet(path)), context='import')
+    def export_items(self):
+        path, _ = QFileDialog.getSaveFileName(self, f"Exportar {self.entity_name}", f"{self.entity_name.lower()}.csv", "CSV (*.csv);;Excel (*.xlsx)")
+        if not path or not check_openpyxl(self, path): return
+        self.import_btn.setEnabled(False); self.export_btn.setEnabled(False)
+        self.io_query.submit(lambda: self.db.export_entity(self.entity_name, path), context='export')
+    def show_io_result(self, result, context):
+        self.import_btn.setEnabled(True); self.export_btn.setEnabled(True)
+        if result is None: QMessageBox.critical(self, "Error", "No se pudo completar la operación."); return
+        if context == 'export': QMessageBox.information(self, "Exportación", f"Se exportaron {result:,} filas."); return
+        errors = result['errores']; summary = f"Filas importadas: {result['procesadas']:,}\nFilas con errores: {len(errors):,}"
+        if errors:
+            detail = "\n".join(f"Línea {n}: {msg}" for n, msg in errors[:20]) + (f"\n... y {len(errors) - 20} más." if len(errors) > 20 else "")
+            QMessageBox.warning(self, "Importación", f"{summary}\n\n{detail}")
+        else: QMessageBox.information(self, "Importación", summary)
+        self.load_data()
 
 class GenericEditDialog(QDialog):
     def __init__(self, entity_name, fields, current_data=None, parent=None):
@@ -276,42 +493,63 @@ class GenericEditDialog(QDialog):
 
 class RecipeManagerWidget(QWidget):
     def __init__(self, db, parent=None):
-        super().__init__(parent); self.db = db; self.current_client_id = None
+        super().__init__(parent); self.db = db; self.current_client_id = None; self.profile = None
         self.setWindowTitle("Gestionar Recetas Médicas"); self.setMinimumSize(900, 700); main_layout = QVBoxLayout(self)
         search_layout = QHBoxLayout(); self.search_input = QLineEdit(); self.search_input.setPlaceholderText("Buscar cliente por nombre o RUT...")
         self.search_input.textChanged.connect(self.search_clients); search_layout.addWidget(QLabel("Buscar Cliente:")); search_layout.addWidget(self.search_input)
-        self.clients_table = QTableWidget(); self.clients_table.setSelectionBehavior(QAbstractItemView.SelectRows); self.clients_table.setSelectionMode(QAbstractItemView.SingleSelection)
-        self.clients_table.setEditTriggers(QAbstractItemView.NoEditTriggers); self.clients_table.itemSelectionChanged.connect(self.load_client_recipes)
-        self.recipes_table = QTableWidget(); self.recipes_table.setEditTriggers(QAbstractItemView.NoEditTriggers); self.recipes_table.setSelectionBehavior(QAbstractItemView.SelectRows)
-        self.recipes_table.setSelectionMode(QAbstractItemView.SingleSelection); self.recipes_table.itemSelectionChanged.connect(self.update_button_state)
+        self.client_query = AsyncQuery(self); self.client_query.result_ready.connect(lambda page, fetch_page: populate_lazy_table(self.clients_table, fetch_page, key=ROW_OFFSET, first_page=page))
+        self.clients_table = create_lazy_view(); self.clients_table.selectionModel().selectionChanged.connect(self.load_client_recipes)
+        self.recipes_table = create_lazy_view(); self.recipes_table.selectionModel().selectionChanged.connect(self.update_button_state)
+        self.orders_table = create_table_view(); self.summary_label = QLabel("Seleccione un cliente para ver su ficha."); self.summary_label.setWordWrap(True)
+        self.client_tabs = QTabWidget(); self.client_tabs.addTab(self.recipes_table, "Recetas"); self.client_tabs.addTab(self.orders_table, "Compras")
+        self.profile_query = AsyncQuery(self); self.profile_query.result_ready.connect(self.show_profile)
         action_layout = QHBoxLayout(); self.add_btn = QPushButton("➕ Agregar Receta"); self.edit_btn = QPushButton("✏️ Ver/Editar Receta"); self.delete_btn = QPushButton("🗑️ Eliminar Receta")
         self.add_btn.clicked.connect(self.add_recipe); self.edit_btn.clicked.connect(self.edit_recipe); self.delete_btn.clicked.connect(self.delete_recipe)
         action_layout.addStretch(); action_layout.addWidget(self.add_btn); action_layout.addWidget(self.edit_btn); action_layout.addWidget(self.delete_btn)
         main_layout.addLayout(search_layout); main_layout.addWidget(QLabel("Resultados de Búsqueda de Clientes:")); main_layout.addWidget(self.clients_table)
-        main_layout.addWidget(QLabel("Recetas del Cliente Seleccionado:")); main_layout.addWidget(self.recipes_table); main_layout.addLayout(action_layout)
+        main_layout.addWidget(self.summary_label); main_layout.addWidget(self.client_tabs); main_layout.addLayout(action_layout)
         self.update_button_state()
     def search_clients(self):
         search_term = self.search_input.text()
-        if len(search_term) > 1: populate_table(self.clients_table, self.db.get_clients(search_term))
-        else: self.clients_table.setRowCount(0)
+        if len(search_term) > 1:
+            fetch_page = lambda after, limit: self.db.get_clients(search_term, after, limit)
+            self.client_query.submit(fetch_page, None, PAGE_SIZE, context=fetch_page, debounce=True)
+        else: self.client_query.cancel(); self.clients_table.model().clear()
     def load_client_recipes(self):
-        selected_rows = self.clients_table.selectionModel().selectedRows()
-        if not selected_rows: self.current_client_id = None; self.recipes_table.setRowCount(0); self.update_button_state(); return
-        self.current_client_id = self.clients_table.item(selected_rows[0].row(), 0).data(Qt.UserRole)
-        if self.current_client_id: populate_table(self.recipes_table, self.db.get_exams_for_client(self.current_client_id))
-        else: self.recipes_table.setRowCount(0)
+        """Pide en segundo plano la ficha del cliente seleccionado (get_client_profile): recetas, compras y totales en una sola llamada."""
+        row = selected_row(self.clients_table); self.profile = None
+        self.current_client_id = client_id = self.clients_table.model().raw(row, 0) if row is not None else None
+        if not client_id:
+            self.profile_query.cancel(); self.recipes_table.model().clear(); populate_table(self.orders_table, []); self.summary_label.setText("Seleccione un cliente para ver su ficha.")
+        else: self.summary_label.setText("Cargando ficha del cliente..."); self.profile_query.submit(self.db.get_client_profile, client_id, context=client_id)
+        self.update_button_state()
+    def show_profile(self, profile, client_id):
+        if client_id != self.current_client_id: return  # Llegó la ficha de un cliente que ya no está seleccionado.
+        self.profile = profile
+        if not profile: self.recipes_table.model().clear(); populate_table(self.orders_table, []); self.summary_label.setText("No se pudo cargar la ficha del cliente."); return
+        client, orders = profile['cliente'], profile['ordenes']
+        summary = f"<b>{client['nombre']} {client['apellido']}</b> (RUT: {client['rut']}) · {client['num_examenes']} recetas"
+        if orders is None: summary += " · Historial de compras no disponible sin conexión."
+        else: summary += f" · {client['num_ordenes']} compras por $ {client['gasto_total']:,}" + (f" · Primera: {client['primera_compra']} · Última: {client['ultima_compra']}" if client['num_ordenes'] else "")
+        self.summary_label.setText(summary)
+        first_page = [{k: e[k] for k in ('id_examen', 'fecha', 'diagnostico', 'observaciones')} for e in profile['examenes']]  # Las siguientes páginas, si hay, se piden al bajar.
+        populate_lazy_table(self.recipes_table, lambda after, limit: self.db.get_exams_for_client(client_id, after, limit), key=('fecha', 'id_examen'), first_page=first_page)
+        rows = [{'id_orden': o['id_orden'], 'fecha': o['fecha'], 'vendedor': o['vendedor'], 'total': f"${o['total']:,}", 'productos': ", ".join(f"{d['cantidad']} x {d['nombre']}" for d in o['detalles'])} for o in orders or []]
+        populate_table(self.orders_table, rows, hidden_id_col=False, labels=["N° Orden", "Fecha", "Vendedor", "Total", "Productos"])
+        if orders and client['num_ordenes'] > len(orders): self.client_tabs.setTabText(1, f"Compras (últimas {len(orders)} de {client['num_ordenes']})")
+        else: self.client_tabs.setTabText(1, "Compras")
         self.update_button_state()
     def update_button_state(self):
-        client_selected = self.current_client_id is not None; recipe_selected = bool(self.recipes_table.selectedItems())
+        client_selected = self.current_client_id is not None; recipe_selected = self.recipes_table.selectionModel().hasSelection()
         self.add_btn.setEnabled(client_selected); self.edit_btn.setEnabled(client_selected and recipe_selected); self.delete_btn.setEnabled(client_selected and recipe_selected)
-    def get_selected_recipe_id(self): return self.recipes_table.item(self.recipes_table.selectionModel().selectedRows()[0].row(), 0).data(Qt.UserRole) if self.recipes_table.selectionModel().selectedRows() else None
+    def get_selected_recipe_id(self): row = selected_row(self.recipes_table); return self.recipes_table.model().raw(row, 0) if row is not None else None
     def add_recipe(self):
-        dialog = RecipeDialog(self.db, self.current_client_id); 
+        dialog = RecipeDialog(self.db, self.current_client_id, profile=self.profile)
         if dialog.exec() == QDialog.Accepted: self.load_client_recipes()
     def edit_recipe(self):
         recipe_id = self.get_selected_recipe_id()
         if recipe_id:
-            dialog = RecipeDialog(self.db, self.current_client_id, recipe_id)
+            dialog = RecipeDialog(self.db, self.current_client_id, recipe_id, profile=self.profile)
             if dialog.exec() == QDialog.Accepted: self.load_client_recipes()
     def delete_recipe(self):
         recipe_id = self.get_selected_recipe_id()
@@ -321,9 +559,11 @@ class RecipeManagerWidget(QWidget):
             else: QMessageBox.warning(self, "Error", result['message'])
 
 class RecipeDialog(QDialog):
-    def __init__(self, db, client_id, exam_id=None, parent=None):
+    def __init__(self, db, client_id, exam_id=None, parent=None, profile=None):
+        """`profile` es la ficha ya cargada (get_client_profile): si trae el cliente y el examen, no se vuelven a consultar."""
         super().__init__(parent); self.db = db; self.client_id = client_id; self.exam_id = exam_id; self.is_edit_mode = exam_id is not None
-        client_data = self.db._execute_query("SELECT nombre, apellido, rut FROM Clientes WHERE id_cliente = %s", (client_id,), fetch='one')
+        self.profile = profile if profile and profile['cliente']['id_cliente'] == client_id else None
+        client_data = self.profile['cliente'] if self.profile else self.db.get_client(client_id)
         client_name = f"{client_data['nombre']} {client_data['apellido']}" if client_data else "Desconocido"; self.setWindowTitle(f"{'Editar' if self.is_edit_mode else 'Nueva'} Receta para: {client_name}"); self.setMinimumWidth(600)
         main_layout = QVBoxLayout(self); form_layout = QGridLayout(); self.fecha_edit = QDateEdit(QDate.currentDate()); self.rp_combo = QComboBox(); self.rp_combo.addItems(["-- Seleccione Tipo --", "Lejos", "Cerca", "Ambos"]); self.observaciones_edit = QTextEdit()
         form_layout.addWidget(QLabel("Paciente:"), 0, 0); form_layout.addWidget(QLabel(f"<b>{client_name}</b> (RUT: {client_data['rut']})"), 0, 1); form_layout.addWidget(QLabel("Fecha:"), 1, 0); form_layout.addWidget(self.fecha_edit, 1, 1); form_layout.addWidget(QLabel("Tipo (Rp):"), 2, 0); form_layout.addWidget(self.rp_combo, 2, 1)
@@ -339,10 +579,19 @@ class RecipeDialog(QDialog):
         return group_box
     def update_visible_groups(self): selection = self.rp_combo.currentText(); self.group_lejos.setVisible(selection in ["Lejos", "Ambos"]); self.group_cerca.setVisible(selection in ["Cerca", "Ambos"])
     def load_exam_data(self):
-        data = self.db.get_exam_details(self.exam_id)
+        exam = next((e for e in self.profile['examenes'] if e['id_examen'] == self.exam_id), None) if self.profile else None
+        data = exam or self.db.get_exam_details(self.exam_id)
         if not data: self.reject(); return
         self.fecha_edit.setDate(data['fecha']); self.rp_combo.setCurrentText(data['diagnostico']); self.observaciones_edit.setText(data['observaciones'])
-        try:
+        prescriptions = exam['graduaciones'] if exam else self.db.get_prescriptions(self.exam_id)
+        if prescriptions or not data['receta']:
+            groups = {'lejos': self.group_lejos, 'cerca': self.group_cerca}
+            for p in prescriptions or []:
+                inputs = groups[p['distancia']].inputs; inputs['dp'].setValue(p['dp'] or 0)
+                for v in ['esf', 'cil']: inputs[p['ojo']][v].setText(f"{p[v]:+.2f}" if p[v] is not None else "")
+                inputs[p['ojo']]['eje'].setText(str(p['eje']) if p['eje'] is not None else "")
+            return
+        try:  # Receta antigua en JSON, aún no migrada.
             receta_json = json.loads(data['receta']) if data['receta'] else {}
             if 'lejos' in receta_json:
                 for v in ['esf','cil','eje']: self.group_lejos.inputs['od'][v].setText(str(receta_json['lejos'].get('od',{}).get(v,''))); self.group_lejos.inputs['oi'][v].setText(str(receta_json['lejos'].get('oi',{}).get(v,'')))
@@ -354,32 +603,40 @@ class RecipeDialog(QDialog):
     def save_recipe(self):
         selection = self.rp_combo.currentText()
         if selection == "-- Seleccione Tipo --": QMessageBox.warning(self, "Campo Requerido", "Seleccione un tipo de receta."); return
-        receta_data = {}
-        if self.group_lejos.isVisible(): receta_data['lejos'] = {'dp':self.group_lejos.inputs['dp'].value(),'od':{v:self.group_lejos.inputs['od'][v].text() for v in ['esf','cil','eje']},'oi':{v:self.group_lejos.inputs['oi'][v].text() for v in ['esf','cil','eje']}}
-        if self.group_cerca.isVisible(): receta_data['cerca'] = {'dp':self.group_cerca.inputs['dp'].value(),'od':{v:self.group_cerca.inputs['od'][v].text() for v in ['esf','cil','eje']},'oi':{v:self.group_cerca.inputs['oi'][v].text() for v in ['esf','cil','eje']}}
-        final_data = {'id_cliente':self.client_id,'fecha':self.fecha_edit.date().toString("yyyy-MM-dd"),'diagnostico':selection,'receta':json.dumps(receta_data),'observaciones':self.observaciones_edit.toPlainText()}
-        result = self.db.update_exam(self.exam_id, final_data) if self.is_edit_mode else self.db.add_exam(final_data)
+        prescriptions = []
+        for distance, group in (('lejos', self.group_lejos), ('cerca', self.group_cerca)):
+            if not group.isVisible(): continue
+            for eye in ['od', 'oi']:
+                inputs = group.inputs[eye]
+                try:
+                    esf, cil = parse_diopter(inputs['esf'].text()), parse_diopter(inputs['cil'].text(), -10.0, 10.0)
+                    eje = int(inputs['eje'].text()) if inputs['eje'].text().strip() else None
+                    if eje is not None and not 0 <= eje <= 180: raise ValueError(eje)
+                except ValueError:
+                    QMessageBox.warning(self, "Formato Incorrecto", f"Revise la graduación {eye.upper()} de {distance}.\nESF y CIL son dioptrías (ej: -1.25) y EJE va de 0 a 180."); return
+                prescriptions.append({'distancia': distance, 'ojo': eye, 'esf': esf, 'cil': cil, 'eje': eje, 'dp': group.inputs['dp'].value()})
+        final_data = {'id_cliente':self.client_id,'fecha':self.fecha_edit.date().toString("yyyy-MM-dd"),'diagnostico':selection,'observaciones':self.observaciones_edit.toPlainText()}
+        result = self.db.update_exam(self.exam_id, final_data, prescriptions) if self.is_edit_mode else self.db.add_exam(final_data, prescriptions)
         if result is not None: QMessageBox.information(self, "Éxito", "Receta guardada."); self.accept()
         else: QMessageBox.critical(self, "Error", "No se pudo guardar la receta.")
 
 class TransactionWidget(QWidget):
-    def __init__(self, db, transaction_type, parent=None):
-        super().__init__(parent); self.db = db; self.transaction_type = transaction_type; self.cart = []; self.selected_entity_id = None; self.all_products = self.db.get_products() or []
+    def __init__(self, db, transaction_type, catalog=None, parent=None):
+        super().__init__(parent); self.db = db; self.transaction_type = transaction_type; self.cart = []; self.selected_entity_id = None; self.product_rows = {}
+        self.cart_id = str(uuid.uuid4()) if transaction_type == "Venta" else None  # Identifica las reservas de stock de este carrito.
+        self.catalog = catalog or ProductCatalog(db, parent=self); self.catalog.changed.connect(self.on_catalog_changed)
         self.entity_label = "Cliente" if self.transaction_type == "Venta" else "Proveedor"; self.setWindowTitle(f"Registrar Nueva {self.transaction_type}"); self.setMinimumSize(1000, 750)
         main_layout = QHBoxLayout(self); left_panel = QVBoxLayout(); right_panel = QVBoxLayout()
         entity_group = QGroupBox(f"1. Buscar y Seleccionar {self.entity_label}"); entity_layout = QVBoxLayout(); self.entity_search_input = QLineEdit()
-        self.entity_search_input.setPlaceholderText(f"Buscar {self.entity_label.lower()} por nombre o RUT..."); self.entity_results_table = QTableWidget()
-        self.entity_results_table.setSelectionBehavior(QAbstractItemView.SelectRows); self.entity_results_table.setSelectionMode(QAbstractItemView.SingleSelection); self.entity_results_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.entity_search_input.setPlaceholderText(f"Buscar {self.entity_label.lower()} por nombre o RUT..."); self.entity_results_table = create_table_view()
         entity_layout.addWidget(self.entity_search_input); entity_layout.addWidget(self.entity_results_table); entity_group.setLayout(entity_layout)
         product_group = QGroupBox("2. Buscar y Agregar Producto"); product_layout = QVBoxLayout(); self.product_search_input = QLineEdit()
-        self.product_search_input.setPlaceholderText("Filtrar producto por nombre, tipo o marca..."); self.product_results_table = QTableWidget()
-        self.product_results_table.setSelectionBehavior(QAbstractItemView.SelectRows); self.product_results_table.setSelectionMode(QAbstractItemView.SingleSelection); self.product_results_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.product_search_input.setPlaceholderText("Filtrar producto por nombre, tipo o marca..."); self.product_results_table = create_table_view()
         add_product_layout = QHBoxLayout(); add_product_layout.addWidget(QLabel("Cantidad:")); self.quantity_spin = CustomSpinBox(); self.quantity_spin.setRange(1, 999)
         self.add_to_cart_btn = QPushButton("➕ Agregar al Carrito"); add_product_layout.addWidget(self.quantity_spin); add_product_layout.addWidget(self.add_to_cart_btn)
         product_layout.addWidget(self.product_search_input); product_layout.addWidget(self.product_results_table); product_layout.addLayout(add_product_layout); product_group.setLayout(product_layout)
         left_panel.addWidget(entity_group); left_panel.addWidget(product_group)
-        cart_group = QGroupBox("3. Carrito de la Transacción"); cart_layout = QVBoxLayout(); self.cart_table = QTableWidget(); self.cart_table.setColumnCount(5); self.cart_table.setHorizontalHeaderLabels(["ID Prod", "Nombre", "Cantidad", "Precio Unitario", "Subtotal"])
-        self.cart_table.setEditTriggers(QAbstractItemView.NoEditTriggers); 
+        cart_group = QGroupBox("3. Carrito de la Transacción"); cart_layout = QVBoxLayout(); self.cart_table = create_table_view(sortable=False)
         
         finalize_layout = QGridLayout(); 
         if self.transaction_type == "Venta":
@@ -395,50 +652,66 @@ class TransactionWidget(QWidget):
         
         cart_layout.addWidget(self.cart_table); cart_layout.addLayout(finalize_layout); cart_group.setLayout(cart_layout)
         right_panel.addWidget(cart_group); main_layout.addLayout(left_panel, 1); main_layout.addLayout(right_panel, 1)
-        self.entity_search_input.textChanged.connect(self.search_entity); self.entity_results_table.itemSelectionChanged.connect(self.update_selected_entity)
+        self.entity_query = AsyncQuery(self); self.entity_query.result_ready.connect(self.show_entity_results)
+        self.reserve_query = AsyncQuery(self); self.reserve_query.result_ready.connect(self.on_stock_reserved)
+        self.entity_search_input.textChanged.connect(self.search_entity); self.entity_results_table.selectionModel().selectionChanged.connect(self.update_selected_entity)
         self.product_search_input.textChanged.connect(self.filter_products_table); self.add_to_cart_btn.clicked.connect(self.add_to_cart); self.finalize_btn.clicked.connect(self.finalize_transaction)
-        self.populate_product_table(); self.update_button_states()
+        if not self.catalog.loaded: self.product_search_input.setPlaceholderText("Cargando catálogo de productos...")
+        self.populate_product_table(); self.update_cart_table()
 
     def search_entity(self):
         search_term = self.entity_search_input.text()
-        if len(search_term) < 2: self.entity_results_table.setRowCount(0); return
-        results = self.db.get_clients(search_term) if self.transaction_type == "Venta" else self.db.get_suppliers(search_term)
-        populate_table(self.entity_results_table, results); self.entity_results_table.resizeColumnsToContents()
-    def update_selected_entity(self):
-        selected_rows = self.entity_results_table.selectionModel().selectedRows()
-        self.selected_entity_id = self.entity_results_table.item(selected_rows[0].row(), 0).data(Qt.UserRole) if selected_rows else None
-        self.update_button_states()
-    def populate_product_table(self, products_to_show=None): populate_table(self.product_results_table, products_to_show if products_to_show is not None else self.all_products)
+        if len(search_term) < 2: self.entity_query.cancel(); self.show_entity_results([], None); return
+        self.entity_query.submit(self.db.get_clients if self.transaction_type == "Venta" else self.db.get_suppliers, search_term, None, PAGE_SIZE, debounce=True)
+    def show_entity_results(self, results, _context): populate_table(self.entity_results_table, results); self.update_selected_entity()
+    def update_selected_entity(self): self.selected_entity_id = selected_value(self.entity_results_table); self.update_button_states()
+    def populate_product_table(self, products_to_show=None):
+        products = products_to_show if products_to_show is not None else self.catalog.rows(); selected_id = self.selected_product_id()
+        populate_table(self.product_results_table, products); self.product_rows = {p['id_producto']: r for r, p in enumerate(products)}
+        if selected_id in self.product_rows: select_source_row(self.product_results_table, self.product_rows[selected_id])
     def filter_products_table(self):
-        search_term = self.product_search_input.text().lower()
-        if not search_term: self.populate_product_table(self.all_products); return
-        filtered = [p for p in self.all_products if search_term in p['nombre'].lower() or search_term in p['tipo'].lower() or (p['marca'] and search_term in p['marca'].lower())]
-        self.populate_product_table(filtered)
+        search_term = self.product_search_input.text()
+        with METRICS.timer("ui.filter_products_table"): self.populate_product_table(self.catalog.search(search_term) if search_term.strip() else self.catalog.rows())
+    def on_catalog_changed(self, product_ids):
+        """Actualiza en su lugar las filas visibles que cambiaron; si aparece o desaparece un producto del filtro actual, vuelve a filtrar."""
+        self.product_search_input.setPlaceholderText("Filtrar producto por nombre, tipo o marca..."); term = self.product_search_input.text(); visible = [i for i in product_ids if i in self.product_rows]
+        if any(not self.catalog.get(i) for i in visible) or any(i not in self.product_rows and self.catalog.matches(i, term) for i in product_ids): self.filter_products_table(); return
+        if not visible: return
+        model = source_model(self.product_results_table)
+        for product_id in visible: model.update_row(self.product_rows[product_id], self.catalog.get(product_id).values())
+    def selected_product_id(self): return selected_value(self.product_results_table)
     def add_to_cart(self):
-        selected_rows = self.product_results_table.selectionModel().selectedRows()
-        if not selected_rows: QMessageBox.warning(self, "Sin Selección", "Por favor, seleccione un producto de la tabla."); return
-        product_id = self.product_results_table.item(selected_rows[0].row(), 0).data(Qt.UserRole); quantity_to_add = self.quantity_spin.value()
-        product_info = next((p for p in self.all_products if p['id_producto'] == product_id), None)
+        product_id = self.selected_product_id()
+        if product_id is None: QMessageBox.warning(self, "Sin Selección", "Por favor, seleccione un producto de la tabla."); return
+        quantity_to_add = self.quantity_spin.value(); product_info = self.catalog.get(product_id)
         if not product_info: return
         if self.transaction_type == "Venta":
             quantity_in_cart = sum(item['cantidad'] for item in self.cart if item['id_producto'] == product_id)
             available_stock = product_info['stock'] - quantity_in_cart
             if quantity_to_add > available_stock:
                 QMessageBox.warning(self, "Stock Insuficiente", f"No hay suficiente stock para '{product_info['nombre']}'.\nStock: {product_info['stock']}, En Carrito: {quantity_in_cart}, Puede Agregar: {available_stock}."); return
-        
+            # El catálogo puede estar atrasado: el servidor decide. La reserva (con reintentos) corre en segundo plano y la línea
+            # se agrega al llegar el resultado; mientras tanto no se puede agregar otra ni finalizar.
+            self.reserve_query.submit(self.db.reserve_stock, self.cart_id, product_id, quantity_to_add, context=(product_id, quantity_to_add, product_info)); self.update_button_states(); return
+        self.append_to_cart(product_id, quantity_to_add, product_info)
+    def on_stock_reserved(self, reservation, context):
+        product_id, quantity, product_info = context; self.update_button_states()
+        if not reservation: return
+        if not reservation['success']: QMessageBox.warning(self, "Stock Insuficiente", f"No se pudo reservar '{product_info['nombre']}'.\n{reservation['message']}"); self.catalog.refresh(); return
+        self.append_to_cart(product_id, quantity, product_info)
+    def append_to_cart(self, product_id, quantity, product_info):
         price_key = 'precio_venta' if self.transaction_type == "Venta" else 'precio_compra'
-        item = {"id_producto": product_id, "nombre": product_info['nombre'], "cantidad": quantity_to_add, "precio_venta": product_info['precio_venta'], "precio_compra": product_info['precio_compra'], "subtotal": quantity_to_add * product_info[price_key]}
+        item = {"id_producto": product_id, "nombre": product_info['nombre'], "cantidad": quantity, "precio_venta": product_info['precio_venta'], "precio_compra": product_info['precio_compra'], "subtotal": quantity * product_info[price_key]}
         self.cart.append(item); self.update_cart_table()
     def update_cart_table(self):
-        self.cart_table.setRowCount(len(self.cart)); total = 0
-        for row, item in enumerate(self.cart):
-            price_to_show = item['precio_venta'] if self.transaction_type == 'Venta' else item['precio_compra']
-            self.cart_table.setItem(row, 0, QTableWidgetItem(str(item['id_producto']))); self.cart_table.setItem(row, 1, QTableWidgetItem(item['nombre'])); self.cart_table.setItem(row, 2, QTableWidgetItem(str(item['cantidad'])))
-            self.cart_table.setItem(row, 3, QTableWidgetItem(f"${price_to_show:,}")); self.cart_table.setItem(row, 4, QTableWidgetItem(f"${item['subtotal']:,}")); total += item['subtotal']
+        price_key = 'precio_venta' if self.transaction_type == 'Venta' else 'precio_compra'; total = sum(item['subtotal'] for item in self.cart)
+        rows = [{'id_producto': item['id_producto'], 'nombre': item['nombre'], 'cantidad': item['cantidad'], 'precio': f"${item[price_key]:,}", 'subtotal': f"${item['subtotal']:,}"} for item in self.cart]
+        populate_table(self.cart_table, rows, hidden_id_col=False, labels=["ID Prod", "Nombre", "Cantidad", "Precio Unitario", "Subtotal"])
         if self.transaction_type == "Venta": self.total_input.setValue(total)
         else: self.total_label.setText(f"Total: $ {total:,}")
         self.update_button_states()
-    def update_button_states(self): self.finalize_btn.setEnabled(self.selected_entity_id is not None and bool(self.cart))
+    def update_button_states(self):
+        reserving = self.reserve_query.busy(); self.add_to_cart_btn.setEnabled(not reserving); self.finalize_btn.setEnabled(self.selected_entity_id is not None and bool(self.cart) and not reserving)
     def finalize_transaction(self):
         if not self.selected_entity_id: QMessageBox.warning(self, "Falta Información", f"Debe seleccionar un {self.entity_label.lower()}."); return
         if not self.cart: QMessageBox.warning(self, "Carrito Vacío", "Debe agregar productos."); return
@@ -447,11 +720,22 @@ class TransactionWidget(QWidget):
         if self.transaction_type == "Venta":
             final_total = self.total_input.value(); vendedor_name = self.vendedor_input.text().strip()
             if not vendedor_name: QMessageBox.warning(self, "Campo Requerido", "Por favor, ingrese el nombre del vendedor."); return
-            result = self.db.create_sale(self.selected_entity_id, final_total, vendedor_name, details_for_db)
+            result = self.db.create_sale(self.selected_entity_id, final_total, vendedor_name, details_for_db, cart=self.cart_id)
         else:
             total = sum(item['subtotal'] for item in self.cart)
             result = self.db.create_purchase(self.selected_entity_id, total, details_for_db)
-        if result: QMessageBox.information(self, "Éxito", f"{self.transaction_type} registrada con ID: {result}"); self.close()
+        if not result:
+            # Falta de stock o error: el carrito se conserva pero sin reservas, para no retener esas unidades RESERVATION_TTL_S;
+            # el stock se vuelve a validar al finalizar de nuevo.
+            if self.cart_id: self.db.release_stock(self.cart_id); self.catalog.refresh()
+            return
+        self.cart = []; self.catalog.refresh()
+        if str(result).startswith("L"): QMessageBox.information(self, "Registrada sin Conexión", f"{self.transaction_type} guardada en la copia local (N° {result}). Se enviará al servidor cuando vuelva la conexión.")
+        else: QMessageBox.information(self, "Éxito", f"{self.transaction_type} registrada con ID: {result}")
+        self.close()
+    def closeEvent(self, event):
+        if self.cart_id: self.reserve_query.cancel(); self.db.release_stock(self.cart_id)  # Aunque el carrito se haya vaciado: las unidades vuelven a estar disponibles.
+        event.accept()
 
 class TransactionViewerWidget(QWidget):
     def __init__(self, db, parent=None):
@@ -460,46 +744,139 @@ class TransactionViewerWidget(QWidget):
     def _create_tab(self, type):
         tab = QWidget(); layout = QVBoxLayout(tab); date_layout = QHBoxLayout(); start_date = QDateEdit(QDate.currentDate().addMonths(-1)); end_date = QDateEdit(QDate.currentDate())
         search_btn = QPushButton("🔎 Buscar"); date_layout.addWidget(QLabel("Desde:")); date_layout.addWidget(start_date); date_layout.addWidget(QLabel("Hasta:")); date_layout.addWidget(end_date); date_layout.addWidget(search_btn); date_layout.addStretch()
-        table = QTableWidget(); table.setEditTriggers(QAbstractItemView.NoEditTriggers); delete_btn = QPushButton("🗑️ Eliminar Transacción"); delete_btn.setEnabled(False)
-        layout.addLayout(date_layout); layout.addWidget(table); btn_layout = QHBoxLayout(); btn_layout.addStretch(); btn_layout.addWidget(delete_btn); layout.addLayout(btn_layout)
-        search_btn.clicked.connect(lambda: self.load_transactions(type, table, start_date.date(), end_date.date())); table.itemSelectionChanged.connect(lambda: delete_btn.setEnabled(bool(table.selectedItems())))
+        table = create_lazy_view(QAbstractItemView.ExtendedSelection); delete_btn = QPushButton("🗑️ Eliminar Seleccionadas"); delete_btn.setEnabled(False); export_btn = QPushButton("📤 Exportar con Detalle")
+        export_btn.clicked.connect(lambda: self.export_transactions(type, start_date.date(), end_date.date()))
+        layout.addLayout(date_layout); layout.addWidget(table); btn_layout = QHBoxLayout(); btn_layout.addWidget(export_btn); btn_layout.addStretch(); btn_layout.addWidget(delete_btn); layout.addLayout(btn_layout)
+        search_btn.clicked.connect(lambda: self.load_transactions(type, table, start_date.date(), end_date.date())); table.selectionModel().selectionChanged.connect(lambda: delete_btn.setEnabled(table.selectionModel().hasSelection()))
         delete_btn.clicked.connect(lambda: self.delete_transaction(type, table, start_date.date(), end_date.date())); self.load_transactions(type, table, start_date.date(), end_date.date()); return tab
-    def load_transactions(self, type, table, start_date, end_date): populate_table(table, self.db.get_transactions_by_date(type, start_date.toString("yyyy-MM-dd"), end_date.toString("yyyy-MM-dd")))
+    def load_transactions(self, type, table, start_date, end_date):
+        start, end = start_date.toString("yyyy-MM-dd"), end_date.toString("yyyy-MM-dd")
+        populate_lazy_table(table, lambda after, limit: self.db.get_transactions_by_date(type, start, end, after, limit), key=('fecha', 'id_orden' if type == 'Venta' else 'id_compra'))
+    def export_transactions(self, type, start_date, end_date): export_transactions_dialog(self, self.db, type, start_date.toString("yyyy-MM-dd"), end_date.toString("yyyy-MM-dd"))
     def delete_transaction(self, type, table, start_date, end_date):
-        selected_rows = table.selectionModel().selectedRows()
-        if not selected_rows: return
-        item_id = table.item(selected_rows[0].row(), 0).data(Qt.UserRole)
-        if QMessageBox.question(self, "Confirmar", f"¿Seguro que quieres eliminar esta {type.lower()}?\n¡El stock será revertido!", QMessageBox.Yes|QMessageBox.No) == QMessageBox.Yes:
-            result = self.db.delete_transaction(type, item_id)
-            if result['success']: QMessageBox.information(self, "Éxito", f"{type} eliminada."); self.load_transactions(type, table, start_date, end_date)
-            else: QMessageBox.critical(self, "Error", result['message'])
+        """Anula todas las filas seleccionadas (Ctrl/Mayús + clic) con una sola llamada a delete_transactions."""
+        ids = [table.model().raw(index.row(), 0) for index in table.selectionModel().selectedRows()]
+        if not ids: return
+        question = f"¿Seguro que quieres eliminar esta {type.lower()}?" if len(ids) == 1 else f"¿Seguro que quieres eliminar {len(ids)} {'ventas' if type == 'Venta' else 'compras'}?"
+        if QMessageBox.question(self, "Confirmar", question + "\n¡El stock será revertido!", QMessageBox.Yes|QMessageBox.No) == QMessageBox.Yes:
+            result = self.db.delete_transactions(type, ids)
+            if result and result['success']: QMessageBox.information(self, "Éxito", result['message']); self.load_transactions(type, table, start_date, end_date)
+            elif result: QMessageBox.critical(self, "Error", result['message'])
 
 class MonthlyReportWidget(QWidget):
     def __init__(self, db, parent=None):
         super().__init__(parent); self.db = db; self.setWindowTitle("📈 Reporte Mensual de Ventas"); self.setMinimumSize(800, 600)
         main_layout = QVBoxLayout(self); filter_layout = QHBoxLayout(); current_date = QDate.currentDate()
         self.year_spin = QSpinBox(); self.year_spin.setRange(2020, 2050); self.year_spin.setValue(current_date.year())
-        self.month_combo = QComboBox(); self.month_combo.addItems(["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"])
+        self.month_combo = QComboBox(); self.month_combo.addItems(MONTH_NAMES)
         self.month_combo.setCurrentIndex(current_date.month() - 1)
         self.seller_combo = QComboBox()
         report_btn = QPushButton("📊 Generar Reporte"); report_btn.clicked.connect(self.generate_report)
+        self.rebuild_btn = QPushButton("🔄 Recalcular Resúmenes"); self.rebuild_btn.clicked.connect(self.rebuild_summaries)
+        export_btn = QPushButton("📤 Exportar"); export_btn.clicked.connect(self.export_report)
         filter_layout.addWidget(QLabel("Año:")); filter_layout.addWidget(self.year_spin); filter_layout.addWidget(QLabel("Mes:")); filter_layout.addWidget(self.month_combo)
-        filter_layout.addWidget(QLabel("Vendedor:")); filter_layout.addWidget(self.seller_combo); filter_layout.addWidget(report_btn); filter_layout.addStretch()
-        self.report_table = QTableWidget(); self.total_label = QLabel("Total de Ventas del Mes: $ 0"); font = self.total_label.font(); font.setPointSize(16); font.setBold(True); self.total_label.setFont(font)
-        main_layout.addLayout(filter_layout); main_layout.addWidget(self.report_table); main_layout.addWidget(self.total_label, 0, Qt.AlignRight)
-        self.populate_sellers(); self.generate_report()
-
-    def populate_sellers(self):
-        self.seller_combo.clear(); self.seller_combo.addItem("Todos los vendedores")
-        sellers = self.db.get_unique_sellers()
+        filter_layout.addWidget(QLabel("Vendedor:")); filter_layout.addWidget(self.seller_combo); filter_layout.addWidget(report_btn); filter_layout.addWidget(export_btn); filter_layout.addStretch(); filter_layout.addWidget(self.rebuild_btn)
+        self.report_table = create_table_view(); self.top_products_table = create_table_view(); self.yoy_table = create_table_view()
+        self.tabs = QTabWidget(); self.tabs.addTab(self.report_table, "Órdenes del Mes"); self.tabs.addTab(self.top_products_table, "Productos Más Vendidos"); self.tabs.addTab(self.yoy_table, "Comparación Anual")
+        self.total_label = QLabel("Total de Ventas del Mes: $ 0"); font = self.total_label.font(); font.setPointSize(16); font.setBold(True); self.total_label.setFont(font)
+        self.rebuild_query = AsyncQuery(self); self.rebuild_query.result_ready.connect(self.on_summaries_rebuilt)
+        self.sellers_query = AsyncQuery(self); self.sellers_query.result_ready.connect(self.show_sellers)
+        self.report_query = AsyncQuery(self); self.report_query.result_ready.connect(self.show_report)
+        main_layout.addLayout(filter_layout); main_layout.addWidget(self.tabs); main_layout.addWidget(self.total_label, 0, Qt.AlignRight)
+        self.seller_combo.addItem("Todos los vendedores"); self.populate_sellers(); self.generate_report()
+
+    def populate_sellers(self): self.sellers_query.submit(self.db.get_unique_sellers)
+    def show_sellers(self, sellers, _context):
+        current = self.seller_combo.currentText(); self.seller_combo.clear(); self.seller_combo.addItem("Todos los vendedores")
         if sellers: self.seller_combo.addItems([s['vendedor'] for s in sellers])
+        self.seller_combo.setCurrentIndex(max(0, self.seller_combo.findText(current)))
 
     def generate_report(self):
         year = self.year_spin.value(); month = self.month_combo.currentIndex() + 1
         seller = self.seller_combo.currentText() if self.seller_combo.currentIndex() > 0 else None
-        sales_data = self.db.get_sales_by_month(year, month, seller); populate_table(self.report_table, sales_data)
-        total_sales = sum(item['total'] for item in sales_data) if sales_data else 0
-        self.total_label.setText(f"Total de Ventas del Período: $ {total_sales:,}")
+        self.total_label.setText("Cargando reporte..."); self.report_query.submit(self._load_report, year, month, seller)
+    def _load_report(self, year, month, seller):
+        """Corre en el QThreadPool: solo consulta, los widgets se llenan en show_report."""
+        start, end = self.db._month_range(year, month)
+        return (self.db.get_sales_by_month(year, month, seller), self.db.get_top_products(start, end), self.db.get_year_over_year(year, seller),
+                self.db.get_sales_summary(start, end, seller) or {'num_ordenes': 0, 'total': 0})
+    def show_report(self, result, _context):
+        if result is None: self.total_label.setText("No se pudo cargar el reporte."); return
+        sales, top_products, year_over_year, summary = result
+        populate_table(self.report_table, sales); populate_table(self.top_products_table, top_products); populate_table(self.yoy_table, year_over_year, hidden_id_col=False)
+        self.total_label.setText(f"Total de Ventas del Período: $ {int(summary['total']):,} ({int(summary['num_ordenes'])} órdenes)")
+
+    def export_report(self):
+        """Ventas del mes (y vendedor) elegido con sus líneas de detalle, exportadas en bloques desde un hilo de fondo."""
+        year = self.year_spin.value(); month = self.month_combo.currentIndex() + 1; start, end = self.db._month_range(year, month)
+        seller = self.seller_combo.currentText() if self.seller_combo.currentIndex() > 0 else None
+        export_transactions_dialog(self, self.db, 'Venta', start.isoformat(), (end - datetime.timedelta(days=1)).isoformat(), seller)
+    def rebuild_summaries(self):
+        if QMessageBox.question(self, "Confirmar", "¿Recalcular los resúmenes de ventas a partir de todo el historial?", QMessageBox.Yes|QMessageBox.No) != QMessageBox.Yes: return
+        self.rebuild_btn.setEnabled(False); self.rebuild_query.submit(self.db.rebuild_sales_summaries)
+    def on_summaries_rebuilt(self, result, _context):
+        self.rebuild_btn.setEnabled(True)
+        if result: self.populate_sellers(); self.generate_report(); QMessageBox.information(self, "Éxito", "Resúmenes recalculados.")
+
+class MetricsWidget(QWidget):
+    """Ventana de diagnóstico: activa o desactiva la medición, muestra los histogramas por método y el registro de consultas lentas."""
+    def __init__(self, db, parent=None):
+        super().__init__(parent); self.db = db; self.metrics = db.metrics; self.setWindowTitle("🩺 Diagnóstico de Rendimiento"); self.setMinimumSize(1000, 600)
+        main_layout = QVBoxLayout(self); controls = QHBoxLayout()
+        self.enabled_check = QCheckBox("Medir consultas"); self.enabled_check.setChecked(self.metrics.enabled); self.enabled_check.toggled.connect(self.toggle_metrics)
+        self.slow_spin = QSpinBox(); self.slow_spin.setRange(1, 600000); self.slow_spin.setSuffix(" ms"); self.slow_spin.setValue(int(self.metrics.slow_ms)); self.slow_spin.valueChanged.connect(lambda v: setattr(self.metrics, 'slow_ms', float(v)))
+        self.serve_check = QCheckBox(f"Publicar en http://127.0.0.1:{METRICS_PORT}/metrics"); self.serve_check.setChecked(self.metrics.server is not None); self.serve_check.toggled.connect(self.toggle_server)
+        export_btn = QPushButton("💾 Exportar..."); export_btn.clicked.connect(self.export_metrics); reset_btn = QPushButton("🧹 Reiniciar"); reset_btn.clicked.connect(lambda: (self.metrics.reset(), self.refresh()))
+        controls.addWidget(self.enabled_check); controls.addWidget(QLabel("Consulta lenta desde:")); controls.addWidget(self.slow_spin); controls.addWidget(self.serve_check); controls.addStretch(); controls.addWidget(reset_btn); controls.addWidget(export_btn)
+        self.methods_table = create_table_view(); self.slow_table = create_table_view(); self.cache_label = QLabel()
+        tabs = QTabWidget(); tabs.addTab(self.methods_table, "Por Método"); tabs.addTab(self.slow_table, "Consultas Lentas")
+        main_layout.addLayout(controls); main_layout.addWidget(tabs); main_layout.addWidget(self.cache_label)
+        self.timer = QTimer(self); self.timer.timeout.connect(self.refresh); self.timer.start(2000); self.refresh()
+
+    def toggle_metrics(self, enabled): self.metrics.enabled = enabled; self.refresh()
+    def toggle_server(self, enabled):
+        if not enabled: self.metrics.stop_serving(); return
+        try: self.metrics.serve()
+        except OSError as err: QMessageBox.warning(self, "Métricas", f"No se pudo abrir el puerto {METRICS_PORT}.\n{err}"); self.serve_check.setChecked(False)
+    def export_metrics(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Exportar Métricas", "metricas_optica.json", "JSON (*.json)")
+        if not path: return
+        try: self.metrics.export(path); QMessageBox.information(self, "Éxito", f"Métricas guardadas en {path}.")
+        except OSError as err: QMessageBox.critical(self, "Error", f"No se pudieron guardar las métricas.\n{err}")
+    def refresh(self):
+        if not self.isVisible() and self.methods_table.model().rowCount(): return
+        snapshot = self.metrics.snapshot()
+        populate_table(self.methods_table, [{'metodo': name, 'tipo': e['tipo'], 'llamadas': e['llamadas'], 'consultas': e['consultas'], 'consultas_por_llamada': round(e['consultas'] / e['llamadas'], 1) if e['llamadas'] else 0,
+                                             'filas': e['filas'], 'total_ms': e['total_ms'], 'media_ms': e['media_ms'], 'p50_ms': e['p50_ms'], 'p95_ms': e['p95_ms'], 'p99_ms': e['p99_ms'], 'max_ms': e['max_ms']}
+                                            for name, e in snapshot['metodos'].items()], hidden_id_col=False)
+        plan = lambda p: p if isinstance(p, str) or p is None else "; ".join(f"{r['table']}: {r['type']} {r['key'] or '-'} ({r['rows']} filas)" for r in p)
+        populate_table(self.slow_table, [{'fecha': e['fecha'], 'metodo': e['metodo'], 'ms': e['ms'], 'filas': e['filas'], 'consulta': e['consulta'], 'parametros': e['parametros'], 'plan': plan(e['plan'])} for e in reversed(snapshot['lentas'])], hidden_id_col=False)
+        stats = self.db.cache.stats(); self.cache_label.setText(f"Caché de consultas: {stats['hits']} aciertos, {stats['misses']} fallos ({stats['tasa_aciertos']:.0%}), {stats['entradas']} entradas, {stats['desalojos']} desalojos, {stats['invalidaciones']} invalidaciones")
+
+class SyncWidget(QWidget):
+    """Transacciones registradas sin conexión que aún no llegan al servidor, y resolución de las que quedaron en conflicto."""
+    def __init__(self, db, parent=None):
+        super().__init__(parent); self.db = db; self.setWindowTitle("🔄 Sincronización"); self.setMinimumSize(900, 500)
+        main_layout = QVBoxLayout(self); self.status_label = QLabel(); self.table = create_table_view(); btn_layout = QHBoxLayout()
+        sync_btn = QPushButton("🔄 Sincronizar Ahora"); sync_btn.clicked.connect(self.db.request_sync)
+        self.apply_btn = QPushButton("✅ Enviar Igual"); self.apply_btn.clicked.connect(lambda: self.resolve(True))
+        self.discard_btn = QPushButton("🗑️ Descartar"); self.discard_btn.clicked.connect(lambda: self.resolve(False))
+        btn_layout.addWidget(sync_btn); btn_layout.addStretch(); btn_layout.addWidget(self.apply_btn); btn_layout.addWidget(self.discard_btn)
+        main_layout.addWidget(self.status_label); main_layout.addWidget(self.table); main_layout.addLayout(btn_layout)
+        self.table.selectionModel().selectionChanged.connect(self.update_button_state)
+        self.timer = QTimer(self); self.timer.timeout.connect(self.refresh); self.timer.start(3000); self.refresh()
+    def refresh(self):
+        self.status_label.setText(self.db.sync_status())
+        if self.db.replica: populate_table(self.table, self.db.replica.entries(), hidden_id_col=False); self.update_button_state()
+    def update_button_state(self):
+        rows = self.table.selectionModel().selectedRows(4); in_conflict = bool(rows) and rows[0].data() == 'conflicto'
+        self.apply_btn.setEnabled(in_conflict); self.discard_btn.setEnabled(in_conflict)
+    def resolve(self, apply):
+        entry_id = selected_value(self.table)
+        if entry_id is None: return
+        question = "¿Enviar esta venta aunque el servidor indique stock insuficiente? El stock quedará negativo hasta corregirlo." if apply else "¿Descartar esta transacción? No se registrará en el servidor."
+        if QMessageBox.question(self, "Confirmar", question, QMessageBox.Yes|QMessageBox.No) != QMessageBox.Yes: return
+        self.db.replica.resolve(entry_id, apply); self.db.request_sync(); self.refresh()
 
 class MainWindow(QMainWindow):
     def __init__(self, db_instance):
@@ -510,32 +887,41 @@ class MainWindow(QMainWindow):
             "📝 Gestionar Recetas": self.open_recipe_manager, "🚚 Gestionar Proveedores": self.open_supplier_manager,
             "🛒 Registrar Nueva Venta": self.open_sale_widget, "📦 Registrar Nueva Compra": self.open_purchase_widget,
             "🧾 Historial de Transacciones": self.open_transaction_viewer, "📈 Reporte Mensual de Ventas": self.open_monthly_report,
+            "🩺 Diagnóstico de Rendimiento": self.open_metrics, "🔄 Sincronización": self.open_sync,
         }
-        positions = [(i, j) for i in range(4) for j in range(2)]
+        positions = [(i, j) for i in range(5) for j in range(2)]
         for (text, action), pos in zip(buttons.items(), positions):
             btn = QPushButton(text); btn.setMinimumHeight(60); btn.clicked.connect(action); layout.addWidget(btn, pos[0], pos[1])
-        self.sub_windows = {}
+        self.sub_windows = {}; self.catalog = None
+        self.status_timer = QTimer(self); self.status_timer.timeout.connect(lambda: self.statusBar().showMessage(self.db.sync_status())); self.status_timer.start(3000); self.statusBar().showMessage(self.db.sync_status())
     def closeEvent(self, event): self.db.close(); event.accept()
     def open_window(self, key, widget_class, *constructor_args):
         if key not in self.sub_windows or not self.sub_windows[key].isVisible():
             self.sub_windows[key] = widget_class(*constructor_args)
             self.sub_windows[key].show()
         else: self.sub_windows[key].activateWindow(); self.sub_windows[key].raise_()
-    def open_client_manager(self): self.open_window('clients', GenericManagerWidget, self.db, "Clientes", {'nombre':str,'apellido':str,'rut':str,'telefono':str,'correo':str,'direccion':str},'get_clients','add_client','update_client','delete_client')
+    def open_client_manager(self): self.open_window('clients', GenericManagerWidget, self.db, "Clientes", ENTITY_FIELDS["Clientes"],'get_clients','add_client','update_client','delete_client')
     def open_product_manager(self):
-        fields = {'nombre':str, 'tipo':str, 'marca':str, 'stock':int, 'precio_compra':int, 'precio_venta':int}
-        self.open_window('products', GenericManagerWidget, self.db, "Productos", fields, 'get_products', 'add_product', 'update_product', 'delete_product')
-    def open_supplier_manager(self): self.open_window('suppliers', GenericManagerWidget, self.db, "Proveedores", {'nombre':str,'contacto':str,'telefono':str,'direccion':str},'get_suppliers','add_supplier','update_supplier','delete_supplier')
+        self.open_window('products', GenericManagerWidget, self.db, "Productos", ENTITY_FIELDS["Productos"], 'get_products', 'add_product', 'update_product', 'delete_product')
+    def open_supplier_manager(self): self.open_window('suppliers', GenericManagerWidget, self.db, "Proveedores", ENTITY_FIELDS["Proveedores"],'get_suppliers','add_supplier','update_supplier','delete_supplier')
     def open_recipe_manager(self): self.open_window('recipes', RecipeManagerWidget, self.db)
     def open_transaction_viewer(self): self.open_window('viewer', TransactionViewerWidget, self.db)
-    def open_sale_widget(self): self.open_window('sale', TransactionWidget, self.db, "Venta")
-    def open_purchase_widget(self): self.open_window('purchase', TransactionWidget, self.db, "Compra")
+    def product_catalog(self):
+        if self.catalog is None: self.catalog = ProductCatalog(self.db, parent=self)
+        return self.catalog
+    def open_sale_widget(self): self.open_window('sale', TransactionWidget, self.db, "Venta", self.product_catalog())
+    def open_purchase_widget(self): self.open_window('purchase', TransactionWidget, self.db, "Compra", self.product_catalog())
     def open_monthly_report(self): self.open_window('monthly_report', MonthlyReportWidget, self.db)
+    def open_metrics(self): self.open_window('metrics', MetricsWidget, self.db)
+    def open_sync(self): self.open_window('sync', SyncWidget, self.db)
 
 if __name__ == "__main__":
     app = QApplication.instance(); 
     if not app: app = QApplication(sys.argv)
-    db = Database()
+    # --servidor=URL (o la variable OPTICA_SERVIDOR) usa servidor_optica.py en vez de conectarse directo a MySQL.
+    server_url = next((arg.split("=", 1)[1] for arg in sys.argv[1:] if arg.startswith("--servidor=")), os.environ.get("OPTICA_SERVIDOR"))
+    if server_url: db = RemoteDatabase(server_url)
+    else: db = Database(notifier=DatabaseNotifier()); db.enable_replica()
     if LoginWindow(db).exec() == QDialog.Accepted:
         main_window = MainWindow(db)
         main_window.show()
@@ -1,5 +1,6 @@
 -- 1. Crear la base de datos si no existe y seleccionarla
-CREATE DATABASE IF NOT EXISTS bbdd_optica;
+-- utf8mb4_unicode_ci compara sin distinguir tildes ni mayúsculas ("Nuñez" = "nunez"), también en las búsquedas FULLTEXT.
+CREATE DATABASE IF NOT EXISTS bbdd_optica CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
 USE bbdd_optica;
 
 -- 2. Desactivar temporalmente la revisión de llaves foráneas para poder borrar las tablas sin problemas de orden
@@ -11,9 +12,14 @@ DROP TABLE IF EXISTS Compras;
 DROP TABLE IF EXISTS DetalleCompra;
 DROP TABLE IF EXISTS DetalleOrden;
 DROP TABLE IF EXISTS Examenes;
+DROP TABLE IF EXISTS Graduaciones;
 DROP TABLE IF EXISTS Ordenes;
 DROP TABLE IF EXISTS Productos;
 DROP TABLE IF EXISTS Proveedores;
+DROP TABLE IF EXISTS ResumenVentasDiario;
+DROP TABLE IF EXISTS ResumenProductosDiario;
+DROP TABLE IF EXISTS ReservasStock;
+DROP TABLE IF EXISTS SchemaVersion;
 
 -- 4. Reactivar la revisión de llaves foráneas
 SET FOREIGN_KEY_CHECKS=1;
@@ -27,7 +33,10 @@ CREATE TABLE Clientes (
     rut VARCHAR(15) NOT NULL UNIQUE,
     telefono VARCHAR(20),
     correo VARCHAR(100),
-    direccion VARCHAR(255)
+    direccion VARCHAR(255),
+    INDEX idx_clientes_nombre (nombre),
+    INDEX idx_clientes_apellido (apellido),
+    FULLTEXT INDEX ft_clientes (nombre, apellido)
 );
 
 CREATE TABLE Proveedores (
@@ -35,7 +44,10 @@ CREATE TABLE Proveedores (
     nombre VARCHAR(100) NOT NULL,
     contacto VARCHAR(100),
     telefono VARCHAR(20),
-    direccion VARCHAR(255)
+    direccion VARCHAR(255),
+    INDEX idx_proveedores_nombre (nombre),
+    INDEX idx_proveedores_contacto (contacto),
+    FULLTEXT INDEX ft_proveedores (nombre, contacto)
 );
 
 CREATE TABLE Productos (
@@ -45,7 +57,14 @@ CREATE TABLE Productos (
     marca VARCHAR(100),
     stock INT NOT NULL,
     precio_compra INT NOT NULL,  -- CAMBIADO A INT
-    precio_venta INT NOT NULL   -- CAMBIADO A INT
+    precio_venta INT NOT NULL,  -- CAMBIADO A INT
+    updated_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),  -- Para refrescar la caché del catálogo solo con lo que cambió
+    version INT NOT NULL DEFAULT 0,  -- Sube con cada cambio de stock o reserva, y las reservas la comparan antes de escribir
+    INDEX idx_productos_updated_at (updated_at),
+    INDEX idx_productos_nombre (nombre),
+    INDEX idx_productos_tipo (tipo),
+    INDEX idx_productos_marca (marca),
+    FULLTEXT INDEX ft_productos (nombre, tipo, marca)
 );
 
 CREATE TABLE Ordenes (
@@ -55,6 +74,11 @@ CREATE TABLE Ordenes (
     total INT,  -- CAMBIADO A INT
     vendedor VARCHAR(100),
     estado ENUM('Pendiente', 'Pagada', 'Entregada') DEFAULT 'Pendiente',
+    ref_local CHAR(36) NULL,  -- Venta registrada sin conexión (evita duplicarla al sincronizar)
+    UNIQUE INDEX uq_ordenes_ref_local (ref_local),
+    INDEX idx_ordenes_fecha (fecha),  -- Páginas del historial en orden (fecha, id_orden), que el índice con vendedor no da
+    INDEX idx_ordenes_fecha_vendedor (fecha, vendedor),
+    INDEX idx_ordenes_cliente_fecha (id_cliente, fecha),  -- Ficha del cliente: sus compras y totales
     FOREIGN KEY (id_cliente) REFERENCES Clientes(id_cliente)
 );
 
@@ -64,6 +88,7 @@ CREATE TABLE DetalleOrden (
     id_producto INT NOT NULL,
     cantidad INT NOT NULL,
     precio INT NOT NULL,  -- CAMBIADO A INT
+    costo INT NOT NULL DEFAULT 0,  -- Precio de compra al momento de la venta, para calcular márgenes
     FOREIGN KEY (id_orden) REFERENCES Ordenes(id_orden) ON DELETE CASCADE,
     FOREIGN KEY (id_producto) REFERENCES Productos(id_producto)
 );
@@ -73,6 +98,9 @@ CREATE TABLE Compras (
     id_proveedor INT NOT NULL,
     fecha DATE NOT NULL,
     total INT,  -- CAMBIADO A INT
+    ref_local CHAR(36) NULL,  -- Compra registrada sin conexión
+    UNIQUE INDEX uq_compras_ref_local (ref_local),
+    INDEX idx_compras_fecha (fecha),
     FOREIGN KEY (id_proveedor) REFERENCES Proveedores(id_proveedor)
 );
 
@@ -91,7 +119,74 @@ CREATE TABLE Examenes (
     id_cliente INT NOT NULL,
     fecha DATE NOT NULL,
     diagnostico TEXT,
-    receta TEXT,
+    receta TEXT,  -- Formato antiguo (JSON). Las recetas nuevas se guardan en Graduaciones
     observaciones TEXT,
+    INDEX idx_examenes_cliente_fecha (id_cliente, fecha),
+    INDEX idx_examenes_fecha (fecha),
     FOREIGN KEY (id_cliente) REFERENCES Clientes(id_cliente)
 );
+
+-- Una fila por examen, distancia y ojo, con columnas numéricas para poder filtrar en SQL (campañas de control).
+CREATE TABLE Graduaciones (
+    id_examen INT NOT NULL,
+    distancia ENUM('lejos', 'cerca') NOT NULL,
+    ojo ENUM('od', 'oi') NOT NULL,
+    esf DECIMAL(5,2),
+    cil DECIMAL(5,2),
+    eje SMALLINT,
+    dp TINYINT,
+    PRIMARY KEY (id_examen, distancia, ojo),
+    INDEX idx_graduaciones_cil (cil),
+    INDEX idx_graduaciones_esf (esf),
+    FOREIGN KEY (id_examen) REFERENCES Examenes(id_examen) ON DELETE CASCADE
+);
+
+-- 6. Resúmenes diarios de ventas. create_sale y delete_transaction los mantienen al día dentro de la misma
+--    transacción. Si se desalinean, "Recalcular Resúmenes" en el reporte mensual los reconstruye desde Ordenes.
+CREATE TABLE ResumenVentasDiario (
+    fecha DATE NOT NULL,
+    vendedor VARCHAR(100) NOT NULL DEFAULT '',
+    num_ordenes INT NOT NULL DEFAULT 0,
+    total BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (fecha, vendedor),
+    INDEX idx_resumen_ventas_vendedor (vendedor, fecha)
+);
+
+CREATE TABLE ResumenProductosDiario (
+    fecha DATE NOT NULL,
+    id_producto INT NOT NULL,
+    cantidad INT NOT NULL DEFAULT 0,
+    ingresos BIGINT NOT NULL DEFAULT 0,
+    costo BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (fecha, id_producto),
+    INDEX idx_resumen_productos_producto (id_producto, fecha)
+);
+
+-- 7. Reservas de stock de los carritos abiertos. Una reserva vencida (terminal cerrada sin liberarla) ya no cuenta.
+CREATE TABLE ReservasStock (
+    carrito CHAR(36) NOT NULL,
+    id_producto INT NOT NULL,
+    cantidad INT NOT NULL,
+    expira DATETIME(6) NOT NULL,
+    PRIMARY KEY (carrito, id_producto),
+    INDEX idx_reservas_producto (id_producto, expira),
+    FOREIGN KEY (id_producto) REFERENCES Productos(id_producto) ON DELETE CASCADE
+);
+
+-- 8. Versión del esquema. Este script ya crea la estructura final, así que todas las migraciones de
+--    MIGRATIONS (Proyecto.py) quedan registradas como aplicadas. Al agregar una migración, súmela aquí también.
+CREATE TABLE SchemaVersion (
+    version INT PRIMARY KEY,
+    descripcion VARCHAR(255) NOT NULL,
+    aplicada_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO SchemaVersion (version, descripcion) VALUES
+    (1, 'Búsqueda indexada y comparación sin tildes'),
+    (2, 'Productos.updated_at para la caché del catálogo'),
+    (3, 'Resúmenes diarios de ventas'),
+    (4, 'Graduaciones en columnas numéricas'),
+    (5, 'Índices por fecha para el historial de transacciones'),
+    (6, 'Referencia local de ventas y compras registradas sin conexión'),
+    (7, 'Versión de stock y reservas de carritos'),
+    (8, 'Índice de ventas por cliente para su ficha');
@@ -0,0 +1,622 @@
+# benchmark_optica.py
+# Mide el rendimiento de la capa Database contra una base de datos de prueba (bbdd_optica_bench).
+# ¡No usar sobre la base de producción! El esquema se recrea desde bbdd_optica.sql en cada carga.
+#
+#   python benchmark_optica.py busqueda --password ... --clientes 100000
+#   python benchmark_optica.py transacciones --password ... --lineas 30
+#   python benchmark_optica.py auditoria --password ...   (EXPLAIN de cada consulta de Database; sale con código 1 si hay recorridos completos)
+#   python benchmark_optica.py suite --password ... --ordenes 2000000 --salida resultados.json [--comparar base.json]
+#       Latencias p50/p95/p99 y throughput de cada operación, guardadas en JSON; con --comparar sale con código 1
+#       si alguna operación empeora su p95 más de --tolerancia por ciento respecto de la corrida base.
+#   python benchmark_optica.py tabla --filas 50000
+#       Tiempo y memoria de mostrar un historial de --filas filas con QTableWidget (antes) y con RowTableModel (ahora).
+#       No necesita base de datos; cada variante corre en su propio proceso para que la memoria medida sea comparable.
+#   python benchmark_optica.py anulacion --password ... --anular 500 --lineas 3
+#       Anula --anular ventas recién creadas con el bucle anterior (un UPDATE por línea y una transacción por venta)
+#       y con Database.delete_transactions (sentencias por conjunto en una sola transacción).
+#   python benchmark_optica.py exportacion --password ... --sin-cargar
+#       Tiempo y pico de memoria (tracemalloc) de exportar el historial de ventas con detalle para rangos de 30 días a 2 años,
+#       cargando todo con fetchall (antes) y con Database.export_transactions en bloques (ahora).
+#   python benchmark_optica.py estres --password ... --procesos 8 --calientes 5 --stock 100 --duracion 20 --sin-cargar
+#       --procesos procesos venden a la vez los mismos --calientes productos hasta agotarlos: con la ruta anterior (stock leído
+#       antes y descuento sin condición) y con reservas y descuento condicional (ahora). Sale con código 1 si la ruta nueva
+#       vende más de lo que hay o si el stock final no cuadra con lo vendido.
+#   python benchmark_optica.py ficha --password ... --repeticiones 200 --sin-cargar
+#       Abrir la ficha de clientes al azar: con las llamadas anteriores (cliente, exámenes, un SELECT por examen y por
+#       graduación, sondeos de delete_client) y con get_client_profile, sin caché y con la caché ya cargada.
+#   python benchmark_optica.py arranque --repeticiones 20 [--ventanas --password ...]
+#       Tiempo de importar Proyecto y de mostrar LoginWindow en procesos nuevos, con los módulos pesados importados al inicio (antes)
+#       y con csv y mysql.connector importados recién donde se usan (ahora). Con --ventanas mide además, sobre la base de benchmark, cuándo se ven la venta y el reporte y cuándo llegan sus datos.
+#   python benchmark_optica.py servicio --password ... --concurrencia 32 --duracion 30 --lineas 3
+#       Ventas por segundo sostenidas con --concurrencia terminales simultáneas: directo contra MySQL (un Database compartido)
+#       y a través de servidor_optica.py, que se levanta en un proceso aparte sobre la base de benchmark.
+
+import os
+import ast
+import sys
+import json
+import time
+import platform
+import subprocess
+import datetime
+import random
+import secrets
+import uuid
+import multiprocessing
+import threading
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+import mysql.connector
+
+BENCH_DB = "bbdd_optica_bench"
+PAGE = 200
+NOMBRES = ["José", "María", "Ángela", "Raúl", "Sofía", "Matías", "Benjamín", "Martín", "Inés", "Tomás", "Lucía", "Agustín", "Florencia", "Joaquín", "Valentina", "Camila"]
+APELLIDOS = ["González", "Muñoz", "Rojas", "Díaz", "Pérez", "Soto", "Contreras", "Silva", "Martínez", "Sepúlveda", "Morales", "Rodríguez", "López", "Fuentes", "Hernández", "Núñez"]
+
+def sql_statements(script):
+    """Separa un script SQL en sentencias: descarta los comentarios -- (de línea completa o al final de una línea) y solo corta en ';' fuera de comillas."""
+    statements, current, quote, i = [], [], None, 0
+    while i < len(script):
+        char = script[i]
+        if quote:
+            current.append(char)
+            if char == "\\" and i + 1 < len(script): current.append(script[i + 1]); i += 1
+            elif char == quote: quote = None
+        elif char in "'\"`": quote = char; current.append(char)
+        elif script.startswith("--", i) and (i + 2 == len(script) or script[i + 2] in " \t\r\n"):
+            end = script.find("\n", i); i = len(script) if end < 0 else end; continue
+        elif char == ";": statements.append("".join(current).strip()); current = []
+        else: current.append(char)
+        i += 1
+    statements.append("".join(current).strip())
+    return [s for s in statements if s]
+
+def load_schema(conn):
+    """Ejecuta bbdd_optica.sql sobre la base de benchmark."""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "bbdd_optica.sql"), encoding="utf-8") as f: script = f.read().replace("bbdd_optica", BENCH_DB)
+    cursor = conn.cursor()
+    for statement in sql_statements(script): cursor.execute(statement)
+    conn.commit(); cursor.close()
+
+def insert_batches(conn, query, rows, batch_size=5000):
+    cursor = conn.cursor()
+    for i in range(0, len(rows), batch_size): cursor.executemany(query, rows[i:i + batch_size]); conn.commit()
+    cursor.close()
+
+def seed_clients(conn, n, chunk=100000):
+    """Clientes generados e insertados por tramos de `chunk`, como seed_orders."""
+    for start in range(0, n, chunk):
+        rows = [(random.choice(NOMBRES), f"{random.choice(APELLIDOS)} {random.choice(APELLIDOS)}", f"{10000000 + i}-{random.choice('0123456789K')}", f"+569{random.randint(10000000, 99999999)}", f"cliente{i}@correo.cl", f"Calle {i}") for i in range(start, min(n, start + chunk))]
+        insert_batches(conn, "INSERT INTO Clientes (nombre, apellido, rut, telefono, correo, direccion) VALUES (%s, %s, %s, %s, %s, %s)", rows)
+
+def seed_products(conn, n):
+    tipos, marcas = ["Marco", "Lente", "Lente de contacto", "Estuche", "Líquido"], ["Ray-Ban", "Oakley", "Essilor", "Zeiss", "Hoya", "Vogue"]
+    rows = [(f"Producto {i}", random.choice(tipos), random.choice(marcas), 1000000, random.randint(1000, 50000), random.randint(60000, 150000)) for i in range(n)]
+    insert_batches(conn, "INSERT INTO Productos (nombre, tipo, marca, stock, precio_compra, precio_venta) VALUES (%s, %s, %s, %s, %s, %s)", rows)
+
+def seed_suppliers(conn, n):
+    insert_batches(conn, "INSERT INTO Proveedores (nombre, contacto, telefono, direccion) VALUES (%s, %s, %s, %s)", [(f"Proveedor {i}", random.choice(NOMBRES), "+5622222222", f"Av. {i}") for i in range(n)])
+
+def seed_orders(conn, n_orders, n_clients, n_products, lines=3, days=730, chunk=100000):
+    """
+    Órdenes repartidas en los últimos `days` días, con 1 a 2*`lines`-1 líneas de detalle cada una (promedio `lines`).
+    Se generan por tramos de `chunk` órdenes para poder cargar millones de filas sin tenerlas todas en memoria.
+    """
+    sellers, today = [f"Vendedor {i}" for i in range(8)], datetime.date.today()
+    cursor = conn.cursor(); cursor.execute("SELECT COALESCE(MAX(id_orden), 0) FROM Ordenes"); first_id = cursor.fetchone()[0] + 1; cursor.close()
+    for start in range(0, n_orders, chunk):
+        order_rows = [(first_id + i, random.randint(1, n_clients), today - datetime.timedelta(days=random.randint(0, days)), random.randint(50000, 500000), random.choice(sellers), 'Pagada') for i in range(start, min(n_orders, start + chunk))]
+        insert_batches(conn, "INSERT INTO Ordenes (id_orden, id_cliente, fecha, total, vendedor, estado) VALUES (%s, %s, %s, %s, %s, %s)", order_rows)
+        detail_rows = [(order_id, product_id, random.randint(1, 3), random.randint(60000, 150000), random.randint(1000, 50000))
+                       for order_id, *_ in order_rows for product_id in random.sample(range(1, n_products + 1), random.randint(1, 2 * lines - 1))]
+        insert_batches(conn, "INSERT INTO DetalleOrden (id_orden, id_producto, cantidad, precio, costo) VALUES (%s, %s, %s, %s, %s)", detail_rows)
+
+def seed_purchases(conn, n_purchases, n_suppliers, n_products, lines=5, days=730, chunk=100000):
+    today = datetime.date.today(); cursor = conn.cursor(); cursor.execute("SELECT COALESCE(MAX(id_compra), 0) FROM Compras"); first_id = cursor.fetchone()[0] + 1; cursor.close()
+    for start in range(0, n_purchases, chunk):
+        rows = [(first_id + i, random.randint(1, n_suppliers), today - datetime.timedelta(days=random.randint(0, days)), random.randint(100000, 5000000)) for i in range(start, min(n_purchases, start + chunk))]
+        insert_batches(conn, "INSERT INTO Compras (id_compra, id_proveedor, fecha, total) VALUES (%s, %s, %s, %s)", rows)
+        insert_batches(conn, "INSERT INTO DetalleCompra (id_compra, id_producto, cantidad, precio_unitario) VALUES (%s, %s, %s, %s)", [(purchase_id, random.randint(1, n_products), random.randint(5, 50), random.randint(1000, 50000)) for purchase_id, *_ in rows for _ in range(lines)])
+
+def seed_exams(conn, n_exams, n_clients, days=1460, json_fraction=0.0, chunk=100000):
+    """
+    Exámenes con su graduación de lejos, por tramos de `chunk`. Una fracción `json_fraction` se guarda en el formato antiguo
+    (JSON en Examenes.receta, como lo dejaba RecipeDialog) para medir migrate_json_prescriptions y la lectura de respaldo.
+    """
+    today = datetime.date.today(); cursor = conn.cursor(); cursor.execute("SELECT COALESCE(MAX(id_examen), 0) FROM Examenes"); first_id = cursor.fetchone()[0] + 1; cursor.close()
+    diopter = lambda low, high: f"{random.randint(int(low * 4), int(high * 4)) / 4:+.2f}"
+    for start in range(0, n_exams, chunk):
+        exams, graduations = [], []
+        for i in range(start, min(n_exams, start + chunk)):
+            exam_id, eyes = first_id + i, {eye: {'esf': diopter(-8, 4), 'cil': diopter(-4, 0), 'eje': str(random.randint(0, 180))} for eye in ('od', 'oi')}; dp = random.randint(56, 70)
+            receta = json.dumps({'lejos': dict(eyes, dp=str(dp))}) if random.random() < json_fraction else None
+            exams.append((exam_id, random.randint(1, n_clients), today - datetime.timedelta(days=random.randint(0, days)), "Lejos", receta, "Control anual"))
+            if receta is None: graduations += [(exam_id, 'lejos', eye, v['esf'], v['cil'], v['eje'], dp) for eye, v in eyes.items()]
+        insert_batches(conn, "INSERT INTO Examenes (id_examen, id_cliente, fecha, diagnostico, receta, observaciones) VALUES (%s, %s, %s, %s, %s, %s)", exams)
+        insert_batches(conn, "INSERT INTO Graduaciones (id_examen, distancia, ojo, esf, cil, eje, dp) VALUES (%s, %s, %s, %s, %s, %s, %s)", graduations)
+
+def percentile(samples, p):
+    ordered = sorted(samples); return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def latency_stats(samples):
+    """Resumen de una serie de latencias en ms: percentiles y operaciones por segundo (llamadas en serie)."""
+    return {"n": len(samples), "p50_ms": round(percentile(samples, 50), 3), "p95_ms": round(percentile(samples, 95), 3), "p99_ms": round(percentile(samples, 99), 3),
+            "max_ms": round(max(samples), 3), "media_ms": round(statistics.fmean(samples), 3), "ops_s": round(1000 * len(samples) / sum(samples), 2)}
+
+def timed(fn, repetitions):
+    """Devuelve (latencias en ms, último resultado) de `repetitions` llamadas a `fn`."""
+    samples, result = [], None
+    for _ in range(repetitions):
+        start = time.perf_counter(); result = fn(); samples.append((time.perf_counter() - start) * 1000)
+    return samples, result
+
+def like_search(conn, term):
+    """Ruta anterior: LIKE '%term%' sobre tres columnas (recorre toda la tabla)."""
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute("SELECT id_cliente, nombre, apellido, rut, telefono, correo, direccion FROM Clientes WHERE nombre LIKE %s OR apellido LIKE %s OR rut LIKE %s", (f"%{term}%",)*3)
+    rows = cursor.fetchall(); cursor.close(); return rows
+
+def bench_search(args, conn, db):
+    terms = ["muñoz", "munoz", "jose gonz", "sofía", "núñez rojas", "1000123", "ma"]
+    print(f"{'término':<14}{'LIKE p50 ms':>14}{'FULLTEXT p50 ms':>18}{'filas LIKE':>12}{'filas FT':>10}")
+    for term in terms:
+        like_ms, like_rows = timed(lambda: like_search(conn, term), args.repeticiones)
+        ft_ms, ft_rows = timed(lambda: db.get_clients(term, limit=200), args.repeticiones)
+        print(f"{term:<14}{statistics.median(like_ms):>14.2f}{statistics.median(ft_ms):>18.2f}{len(like_rows or []):>12}{len(ft_rows or []):>10}")
+
+def legacy_create_sale(conn, client_id, total, vendedor, details):
+    """Ruta anterior: un INSERT y un UPDATE por línea del carrito."""
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO Ordenes (id_cliente, fecha, total, vendedor, estado) VALUES (%s, %s, %s, %s, %s)", (client_id, datetime.date.today(), total, vendedor, 'Pagada')); order_id = cursor.lastrowid
+    for d in details:
+        cursor.execute("INSERT INTO DetalleOrden (id_orden, id_producto, cantidad, precio) VALUES (%s, %s, %s, %s)", (order_id, d['id_producto'], d['cantidad'], d['precio_venta']))
+        cursor.execute("UPDATE Productos SET stock = stock - %s WHERE id_producto = %s", (d['cantidad'], d['id_producto']))
+    conn.commit(); cursor.close(); return order_id
+
+def legacy_delete_transaction(conn, db, order_id):
+    """Ruta anterior: lee el detalle y revierte el stock con un UPDATE por línea, en una transacción por venta."""
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute("SELECT * FROM DetalleOrden WHERE id_orden = %s", (order_id,)); details = cursor.fetchall()
+    cursor.execute("SELECT fecha, vendedor, total FROM Ordenes WHERE id_orden = %s FOR UPDATE", (order_id,)); order = cursor.fetchone()
+    if order: db._update_sales_summary(cursor, order['fecha'], order['vendedor'], order['total'], [(d['id_producto'], d['cantidad'], d['precio'], d['costo']) for d in details], -1)
+    for d in details: cursor.execute("UPDATE Productos SET stock = stock + %s WHERE id_producto = %s", (d['cantidad'], d['id_producto']))
+    cursor.execute("DELETE FROM DetalleOrden WHERE id_orden = %s", (order_id,)); cursor.execute("DELETE FROM Ordenes WHERE id_orden = %s", (order_id,))
+    conn.commit(); cursor.close()
+
+def random_cart(products, lines):
+    return [{'id_producto': p['id_producto'], 'cantidad': random.randint(1, 3), 'precio_venta': p['precio_venta'], 'precio_compra': p['precio_compra']} for p in random.sample(products, lines)]
+
+def bench_transactions(args, conn, db):
+    products = db.get_products() or []
+    clients = [c['id_cliente'] for c in db.get_clients(limit=1000) or []]
+    suppliers = [s['id_proveedor'] for s in db.get_suppliers(limit=100) or []]
+    runs = {
+        "venta (bucle por línea)": lambda: legacy_create_sale(conn, random.choice(clients), 0, "bench", random_cart(products, args.lineas)),
+        "venta (lote)": lambda: db.create_sale(random.choice(clients), 0, "bench", random_cart(products, args.lineas)),
+        "compra (lote)": lambda: db.create_purchase(random.choice(suppliers), 0, random_cart(products, args.lineas)),
+    }
+    print(f"{args.lineas} líneas por transacción, {args.repeticiones} transacciones por ruta")
+    print(f"{'ruta':<26}{'p50 ms':>10}{'p95 ms':>10}{'tx/s':>10}")
+    for name, run in runs.items():
+        samples, _ = timed(run, args.repeticiones)
+        print(f"{name:<26}{percentile(samples, 50):>10.2f}{percentile(samples, 95):>10.2f}{1000 * len(samples) / sum(samples):>10.1f}")
+
+def bench_void(args, conn, db):
+    """Crea dos tandas de --anular ventas y anula una con el bucle anterior y la otra con delete_transactions; verifica que el stock vuelva a su valor."""
+    products = db.get_products() or []; clients = [c['id_cliente'] for c in db.get_clients(limit=1000) or []]
+    stock = lambda: {p['id_producto']: p['stock'] for p in db.get_products() or []}
+    print(f"{args.anular} ventas de {args.lineas} líneas por ruta")
+    print(f"{'ruta':<28}{'total ms':>12}{'ventas/s':>12}{'stock ok':>10}")
+    for name in ("bucle por línea", "delete_transactions"):
+        before = stock(); ids = [db.create_sale(random.choice(clients), 0, "bench", random_cart(products, args.lineas)) for _ in range(args.anular)]
+        start = time.perf_counter()
+        if name == "bucle por línea":
+            for order_id in ids: legacy_delete_transaction(conn, db, order_id)
+        else: db.delete_transactions('Venta', ids)
+        elapsed = time.perf_counter() - start; db.cache.clear()
+        print(f"{name:<28}{elapsed * 1000:>12.1f}{len(ids) / elapsed:>12.1f}{'sí' if stock() == before else 'NO':>10}")
+
+def legacy_checkout(conn, client_id, vendedor, cart):
+    """Ruta anterior: compara con el stock leído al armar el carrito (como la interfaz con su catálogo) y descuenta sin condición."""
+    cursor = conn.cursor(); ids = [d['id_producto'] for d in cart]
+    cursor.execute(f"SELECT id_producto, stock FROM Productos WHERE id_producto IN ({', '.join(['%s'] * len(ids))})", ids); stock = dict(cursor.fetchall()); cursor.close()
+    if any(stock[d['id_producto']] < d['cantidad'] for d in cart): return None
+    return legacy_create_sale(conn, client_id, 0, vendedor, cart)
+
+def reserved_checkout(db, client_id, vendedor, cart):
+    """Ruta nueva, como TransactionWidget: reserva cada línea al agregarla y registra la venta con el carrito."""
+    cart_id = str(uuid.uuid4())
+    for d in cart:
+        reservation = db.reserve_stock(cart_id, d['id_producto'], d['cantidad'])
+        if not reservation or not reservation['success']: db.release_stock(cart_id); return None
+    return db.create_sale(client_id, 0, vendedor, cart, cart=cart_id)
+
+def stress_worker(args, mode, vendedor, hot, clients, deadline, results):
+    """Un proceso de la prueba de estrés: vende hasta `deadline` y deja en `results` (latencias ms de las ventas, latencias de las rechazadas)."""
+    from datos_optica import Database
+    db = Database(cache_size=0); db._notify = lambda level, title, text: None; conn = None
+    if not db.connect(args.user, args.password, args.host, BENCH_DB, pool_size=2): results.put(None); return
+    if mode == "antes": conn = mysql.connector.connect(host=args.host, user=args.user, password=args.password, database=BENCH_DB, autocommit=True)
+    sold, rejected = [], []
+    try:
+        while time.time() < deadline:
+            cart = [dict(p, cantidad=random.randint(1, 3)) for p in random.sample(hot, min(2, len(hot)))]
+            start = time.perf_counter()
+            order_id = legacy_checkout(conn, random.choice(clients), vendedor, cart) if mode == "antes" else reserved_checkout(db, random.choice(clients), vendedor, cart)
+            (sold if order_id else rejected).append((time.perf_counter() - start) * 1000)
+    finally:
+        db.close()
+        if conn: conn.close()
+    results.put((sold, rejected))
+
+def bench_stress(args, conn, db):
+    """Devuelve True si la ruta nueva vendió más de lo que había o si el stock no cuadra con el detalle de las ventas."""
+    clients = [c['id_cliente'] for c in db.get_clients(limit=1000) or []]
+    hot = [{'id_producto': p['id_producto'], 'precio_venta': p['precio_venta'], 'precio_compra': p['precio_compra']} for p in db.get_products(limit=args.calientes) or []]
+    ids = [p['id_producto'] for p in hot]; in_list = ", ".join(["%s"] * len(ids)); context = multiprocessing.get_context("spawn"); failed = False
+    print(f"{args.procesos} procesos, {len(hot)} productos con stock {args.stock}, hasta {args.duracion:.0f} s por ruta")
+    print(f"{'ruta':<8}{'ventas':>8}{'rechazos':>10}{'vendidas':>10}{'sobreventa':>12}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'cuadra':>8}")
+    for mode in ("antes", "ahora"):
+        cursor = conn.cursor(); cursor.execute(f"UPDATE Productos SET stock = %s, version = version + 1 WHERE id_producto IN ({in_list})", [args.stock] + ids)
+        cursor.execute("DELETE FROM ReservasStock"); conn.commit(); cursor.close()
+        vendedor = f"estres-{mode}-{secrets.token_hex(3)}"; results = context.Queue(); deadline = time.time() + args.duracion
+        processes = [context.Process(target=stress_worker, args=(args, mode, vendedor, hot, clients, deadline, results)) for _ in range(args.procesos)]
+        for p in processes: p.start()
+        outcomes = [results.get() for _ in processes]
+        for p in processes: p.join()
+        if None in outcomes: sys.exit("Un proceso no pudo conectarse a la base de benchmark.")
+        sold = [ms for ok, _ in outcomes for ms in ok]; rejected = sum(len(no) for _, no in outcomes)
+        conn.commit(); cursor = conn.cursor()  # commit: lectura nueva, no la instantánea de la transacción anterior.
+        cursor.execute(f"SELECT id_producto, stock FROM Productos WHERE id_producto IN ({in_list})", ids); final = dict(cursor.fetchall())
+        cursor.execute("SELECT d.id_producto, SUM(d.cantidad) FROM DetalleOrden d JOIN Ordenes o ON o.id_orden = d.id_orden WHERE o.vendedor = %s GROUP BY d.id_producto", (vendedor,))
+        units = {i: int(n) for i, n in cursor.fetchall()}; cursor.close()
+        oversold = sum(max(0, -final[i]) for i in ids); consistent = all(final[i] == args.stock - units.get(i, 0) for i in ids)
+        stats = latency_stats(sold) if sold else {"p50_ms": 0, "p95_ms": 0, "p99_ms": 0}
+        print(f"{mode:<8}{len(sold):>8}{rejected:>10}{sum(units.values()):>10}{oversold:>12}{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}{'sí' if consistent else 'NO':>8}")
+        if mode == "ahora" and (oversold or not consistent): failed = True
+    return failed
+
+def legacy_client_view(db, client_id):
+    """Ruta anterior: RecipeManagerWidget y RecipeDialog consultan el cliente, la lista de exámenes y luego cada examen por separado."""
+    db.get_client(client_id); exams = db.get_exams_for_client(client_id, None, PAGE) or []
+    for exam in exams: db.get_exam_details(exam['id_examen']); db.get_prescriptions(exam['id_examen'])
+    db._execute_query("SELECT 1 FROM Examenes WHERE id_cliente = %s", (client_id,), fetch='one', cache=False); db._execute_query("SELECT 1 FROM Ordenes WHERE id_cliente = %s", (client_id,), fetch='one', cache=False)
+
+def bench_profile(args, conn, db):
+    cursor = conn.cursor(); cursor.execute("SELECT id_cliente FROM Examenes GROUP BY id_cliente ORDER BY COUNT(*) DESC LIMIT 500"); clients = [row[0] for row in cursor.fetchall()]; cursor.close()
+    runs = {
+        "llamadas separadas": lambda: (db.cache.clear(), legacy_client_view(db, random.choice(clients))),
+        "get_client_profile (sin caché)": lambda: (db.cache.clear(), db.get_client_profile(random.choice(clients))),
+        "get_client_profile (en caché)": lambda: db.get_client_profile(random.choice(clients[:20])),
+    }
+    print(f"{len(clients)} clientes con más exámenes, {args.repeticiones} fichas por ruta")
+    print(f"{'ruta':<34}{'p50 ms':>10}{'p95 ms':>10}{'fichas/s':>10}")
+    for name, run in runs.items():
+        samples, _ = timed(run, args.repeticiones); stats = latency_stats(samples)
+        print(f"{name:<34}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['ops_s']:>10.1f}")
+
+def bench_export(args, conn, db):
+    """Exporta a CSV el historial de ventas de rangos crecientes; con la ruta por bloques el pico de memoria no debería crecer con el rango."""
+    from datos_optica import write_spreadsheet
+    today = datetime.date.today(); path = os.path.join(tempfile.mkdtemp(), "historial.csv")
+    def fetch_all(start):
+        query, params = db._transaction_lines_query('Venta', start, today)
+        rows = db._execute_query(query, params, fetch='all', cache=False) or []
+        return write_spreadsheet(path, [(list(rows[0]), [tuple(r.values()) for r in rows])] if rows else [])
+    print(f"{'días':>6}{'ruta':>10}{'filas':>12}{'segundos':>10}{'pico MB':>10}")
+    for days in (30, 180, 365, 730):
+        start = today - datetime.timedelta(days=days)
+        for name, run in (("antes", lambda: fetch_all(start)), ("ahora", lambda: db.export_transactions('Venta', start, today, path))):
+            tracemalloc.start(); begin = time.perf_counter(); rows = run(); elapsed = time.perf_counter() - begin; peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+            print(f"{days:>6}{name:>10}{rows or 0:>12}{elapsed:>10.2f}{peak / 2**20:>10.1f}")
+    os.remove(path)
+
+def suite_operations(args, conn, db):
+    """Operaciones que mide la suite; cada una recibe argumentos aleatorios distintos en cada llamada para no medir solo cachés."""
+    today = datetime.date.today(); products = db.get_products() or []
+    clients = [c['id_cliente'] for c in db.get_clients(limit=5000) or []]; suppliers = [s['id_proveedor'] for s in db.get_suppliers(limit=100) or []]
+    sellers = [s["vendedor"] for s in db.get_unique_sellers() or []] or ["Vendedor 1"]; terms = ["muñoz", "jose gonz", "núñez rojas", "sofía", "ma", "1000123"]; product_terms = ["lente", "zeiss marco", "ray-ban", "es"]
+    recent = lambda days: (today - datetime.timedelta(days=days), today)
+    def delete_sale():
+        # Se mide sobre ventas recién creadas por la suite, para no ir vaciando los datos generados.
+        order_id = db.create_sale(random.choice(clients), 0, "bench", random_cart(products, args.lineas)); start = time.perf_counter()
+        db.delete_transaction('Venta', order_id); return time.perf_counter() - start
+    return {
+        "get_clients (búsqueda)": lambda: db.get_clients(random.choice(terms), limit=PAGE),
+        "get_clients (página)": lambda: db.get_clients("", random.choice(clients), PAGE),
+        "get_products (búsqueda)": lambda: db.get_products(random.choice(product_terms), limit=PAGE),
+        "create_sale": lambda: db.create_sale(random.choice(clients), 0, "bench", random_cart(products, args.lineas)),
+        "create_purchase": lambda: db.create_purchase(random.choice(suppliers), 0, random_cart(products, args.lineas)),
+        "delete_transaction": delete_sale,
+        "get_client_profile": lambda: db.get_client_profile(random.choice(clients)),
+        "get_transactions_by_date (30 días)": lambda: db.get_transactions_by_date('Venta', *recent(30), None, PAGE),
+        "get_transactions_by_date (1 año)": lambda: db.get_transactions_by_date('Venta', *recent(365), None, PAGE),
+        "get_sales_by_month": lambda: db.get_sales_by_month(today.year - random.randint(0, 1), random.randint(1, 12), random.choice(sellers)),
+    }
+
+def table_counts(conn):
+    cursor = conn.cursor(); counts = {}
+    for table in ("Clientes", "Productos", "Proveedores", "Ordenes", "DetalleOrden", "Compras", "DetalleCompra", "Examenes", "Graduaciones"):
+        cursor.execute(f"SELECT COUNT(*) FROM {table}"); counts[table] = cursor.fetchone()[0]
+    cursor.close(); return counts
+
+def git_revision():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError): return None
+
+def compare_runs(current, baseline, tolerance):
+    """Lista de operaciones cuyo p95 empeoró más de `tolerance` por ciento respecto de `baseline`."""
+    regressions = []
+    for name, stats in current["operaciones"].items():
+        base = baseline.get("operaciones", {}).get(name)
+        if base and base["p95_ms"] > 0 and stats["p95_ms"] > base["p95_ms"] * (1 + tolerance / 100): regressions.append((name, base["p95_ms"], stats["p95_ms"]))
+    return regressions
+
+def bench_suite(args, conn, db):
+    """Mide cada operación de suite_operations (con --calentamiento llamadas previas descartadas) y guarda los resultados en JSON."""
+    results = {"fecha": datetime.datetime.now().isoformat(timespec="seconds"), "commit": git_revision(), "servidor": conn.get_server_info(), "python": platform.python_version(),
+               "parametros": {"repeticiones": args.repeticiones, "lineas": args.lineas, "calentamiento": args.calentamiento, "cache": args.cache}, "filas": table_counts(conn), "operaciones": {}}
+    print(f"{'operación':<36}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>10}")
+    for name, run in suite_operations(args, conn, db).items():
+        for _ in range(args.calentamiento): run()
+        if name == "delete_transaction": samples = [run() * 1000 for _ in range(args.repeticiones)]  # Solo el borrado, sin la venta que lo prepara.
+        else: samples, _ = timed(run, args.repeticiones)
+        stats = results["operaciones"][name] = latency_stats(samples)
+        print(f"{name:<36}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['ops_s']:>10.1f}")
+    results["cache"] = db.cache.stats()
+    print(f"Caché de consultas: {results['cache']}")
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f: json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nResultados guardados en {args.salida}")
+    if not args.comparar: return []
+    with open(args.comparar, encoding="utf-8") as f: regressions = compare_runs(results, json.load(f), args.tolerancia)
+    for name, before, after in regressions: print(f"REGRESIÓN {name}: p95 {before:.2f} ms -> {after:.2f} ms")
+    if not regressions: print(f"Sin regresiones de p95 mayores a {args.tolerancia}% respecto de {args.comparar}.")
+    return regressions
+
+def legacy_populate_table(table, data, hidden_id_col=True):
+    """Ruta anterior: un QTableWidgetItem por celda y resizeColumnsToContents, que mide todas las filas."""
+    from PySide6.QtCore import Qt
+    from PySide6.QtWidgets import QTableWidgetItem, QHeaderView
+    table.clear(); table.setRowCount(0); table.setColumnCount(0)
+    if not data: return
+    headers = list(data[0].keys()); table.setColumnCount(len(headers)); table.setHorizontalHeaderLabels([h.replace('_',' ').title() for h in headers]); table.setRowCount(len(data))
+    for r, row_data in enumerate(data):
+        for c, h in enumerate(headers):
+            value = row_data[h]; item = QTableWidgetItem()
+            if isinstance(value, datetime.date): value = value.strftime('%Y-%m-%d')
+            item.setData(Qt.DisplayRole, str(value) if value is not None else "")
+            if h.startswith('id_'): item.setData(Qt.UserRole, value)
+            table.setItem(r, c, item)
+    table.resizeColumnsToContents(); table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+    if hidden_id_col and headers and headers[0].startswith('id_'): table.hideColumn(0)
+
+def rss_mb():
+    """Memoria residente del proceso en MB (Linux); NaN donde /proc no existe."""
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError): return float("nan")
+
+def bench_table_variant(args):
+    """Llena y dibuja una tabla con --filas ventas sintéticas usando una sola variante; imprime una línea JSON con el resultado."""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PySide6.QtWidgets import QApplication, QTableWidget
+    from Proyecto import create_table_view, populate_table
+    app = QApplication.instance() or QApplication([]); today = datetime.date.today()
+    rows = [{'id_orden': i, 'fecha': today - datetime.timedelta(days=i % 730), 'nombre': random.choice(NOMBRES), 'apellido': random.choice(APELLIDOS), 'vendedor': f"Vendedor {i % 8}", 'total': random.randint(50000, 500000)} for i in range(args.filas)]
+    make, fill = (QTableWidget, legacy_populate_table) if args.variante == "antes" else (create_table_view, populate_table)
+    table = make(); table.resize(900, 700); table.show(); app.processEvents(); before = rss_mb()
+    start = time.perf_counter(); fill(table, rows); filled = time.perf_counter(); app.processEvents(); shown = time.perf_counter()
+    print(json.dumps({"variante": args.variante, "llenado_ms": round((filled - start) * 1000, 1), "dibujo_ms": round((shown - filled) * 1000, 1), "memoria_mb": round(rss_mb() - before, 1)}))
+
+def bench_table(args):
+    print(f"{args.filas} filas")
+    print(f"{'variante':<10}{'llenado ms':>12}{'dibujo ms':>12}{'memoria MB':>12}")
+    for variant in ("antes", "ahora"):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "tabla", "--variante", variant, "--filas", str(args.filas)], capture_output=True, text=True, check=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        print(f"{variant:<10}{result['llenado_ms']:>12.1f}{result['dibujo_ms']:>12.1f}{result['memoria_mb']:>12.1f}")
+
+# Corre con `python -c` en un proceso nuevo, para que nada de este script (que ya importa json y mysql.connector) esté cargado.
+STARTUP_PROBE = r'''
+import sys, time
+start = time.perf_counter()
+if sys.argv[1] == "antes": import csv, json, uuid, hashlib, inspect, http.client, mysql.connector
+import Proyecto
+imported = time.perf_counter(); deferred = sum(name not in sys.modules for name in ("csv", "mysql.connector"))
+from PySide6.QtWidgets import QApplication
+app = QApplication.instance() or QApplication([]); db = Proyecto.Database(); db._notify = lambda level, title, text: print(title, text, file=sys.stderr)
+login = Proyecto.LoginWindow(db); login.show(); app.processEvents(); shown = time.perf_counter()
+result = {"importar_ms": (imported - start) * 1000, "login_visible_ms": (shown - start) * 1000, "diferidos": deferred}
+def wait(condition, timeout=120):
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline: app.processEvents(); time.sleep(0.001)
+    return time.perf_counter()
+if len(sys.argv) > 2:
+    host, user, password, name = sys.argv[2:6]
+    if not db.connect(user, password, host, name): sys.exit(1)
+    window = Proyecto.MainWindow(db); t = time.perf_counter(); window.show(); app.processEvents(); result["principal_visible_ms"] = (time.perf_counter() - t) * 1000
+    t = time.perf_counter(); window.open_sale_widget(); app.processEvents(); result["venta_visible_ms"] = (time.perf_counter() - t) * 1000
+    result["venta_catalogo_ms"] = (wait(lambda: window.catalog.loaded) - t) * 1000
+    t = time.perf_counter(); window.open_monthly_report(); app.processEvents(); result["reporte_visible_ms"] = (time.perf_counter() - t) * 1000
+    report = window.sub_windows["monthly_report"]; result["reporte_datos_ms"] = (wait(lambda: not report.report_query.busy() and not report.sellers_query.busy()) - t) * 1000
+    db.close()
+print(repr(result))
+'''
+
+def bench_startup(args):
+    """Arranca Proyecto --repeticiones veces por variante, cada vez en un proceso nuevo, y compara las medianas."""
+    cwd, env = os.path.dirname(os.path.abspath(__file__)), dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    db_args = [args.host, args.user, args.password, BENCH_DB] if args.ventanas else []; results = {}
+    for variant in ("antes", "ahora"):
+        runs = [subprocess.run([sys.executable, "-c", STARTUP_PROBE, variant] + db_args, capture_output=True, text=True, check=True, cwd=cwd, env=env).stdout for _ in range(args.repeticiones)]
+        results[variant] = [ast.literal_eval(out.strip().splitlines()[-1]) for out in runs]
+    print(f"{args.repeticiones} arranques por variante; módulos diferidos al importar: {results['ahora'][0]['diferidos']}")
+    print(f"{'medición':<24}{'antes p50':>12}{'ahora p50':>12}{'ahora p95':>12}")
+    for metric in results["ahora"][0]:
+        if metric == "diferidos": continue
+        before, after = [r[metric] for r in results["antes"]], [r[metric] for r in results["ahora"]]
+        print(f"{metric:<24}{statistics.median(before):>12.1f}{statistics.median(after):>12.1f}{percentile(after, 95):>12.1f}")
+
+class RecordingCursor:
+    """Envuelve un cursor real y anota cada sentencia que ejecuta, para auditarlas después con EXPLAIN."""
+    def __init__(self, cursor, log): self._cursor, self._log = cursor, log
+    def execute(self, operation, params=None, *args, **kwargs): self._log.append((operation, params)); return self._cursor.execute(operation, params, *args, **kwargs)
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        seq_params = list(seq_params)
+        if seq_params: self._log.append((operation, seq_params[0]))
+        return self._cursor.executemany(operation, seq_params, *args, **kwargs)
+    def __getattr__(self, name): return getattr(self._cursor, name)
+    def __iter__(self): return iter(self._cursor)
+
+def record_queries(db):
+    """Hace que las conexiones que presta el pool entreguen cursores que anotan sus sentencias; devuelve la lista donde quedan."""
+    log, acquire = [], db.pool.acquire
+    def recording_acquire():
+        conn = acquire()
+        if not getattr(conn, "_audit_wrapped", False):
+            real_cursor = conn.cursor; conn.cursor = lambda *a, **kw: RecordingCursor(real_cursor(*a, **kw), log); conn._audit_wrapped = True
+        return conn
+    db.pool.acquire = recording_acquire
+    return log
+
+def audit_calls(conn, db):
+    """Llamadas representativas a cada método de lectura y escritura de Database."""
+    today = datetime.date.today(); year_ago = today - datetime.timedelta(days=365)
+    products = db.get_products(limit=40); cart = random_cart(products, 30)
+    cursor = conn.cursor(); cursor.execute("SELECT id_cliente FROM Ordenes LIMIT 1"); client_with_orders = cursor.fetchone()[0]; cursor.close()
+    return [
+        ("get_clients", lambda: db.get_clients()), ("get_clients (página)", lambda: db.get_clients("", 5000, 200)),
+        ("get_clients (texto)", lambda: db.get_clients("muñoz rojas", 0, 200)), ("get_clients (palabra corta)", lambda: db.get_clients("jo", 0, 200)),
+        ("get_clients (RUT)", lambda: db.get_clients("1000123", 0, 200)), ("get_products (texto)", lambda: db.get_products("lente zeiss", 0, 200)),
+        ("get_suppliers (texto)", lambda: db.get_suppliers("proveedor", 0, 200)), ("get_exams_for_client", lambda: db.get_exams_for_client(1, None, 200)),
+        ("get_client_profile", lambda: (db.cache.clear(), db.get_client_profile(client_with_orders))),
+        ("get_transactions_by_date Venta", lambda: db.get_transactions_by_date('Venta', year_ago, today, (today, 10**9), 200)),
+        ("get_transactions_by_date Compra", lambda: db.get_transactions_by_date('Compra', year_ago, today, None, 200)),
+        ("get_unique_sellers", db.get_unique_sellers), ("get_sales_by_month", lambda: db.get_sales_by_month(today.year, today.month, "Vendedor 1")),
+        ("get_sales_summary", lambda: db.get_sales_summary(year_ago, today)), ("get_year_over_year", lambda: db.get_year_over_year(today.year)),
+        ("get_top_products", lambda: db.get_top_products(year_ago, today)), ("find_prescriptions", lambda: db.find_prescriptions(cil_max=-2.0, since=year_ago)),
+        ("get_product_changes", lambda: db.get_product_changes(datetime.datetime.now() - datetime.timedelta(minutes=5))),
+        ("delete_client (con ventas)", lambda: db.delete_client(client_with_orders)), ("delete_product (con ventas)", lambda: db.delete_product(products[0]['id_producto'])),
+        ("create_sale", lambda: db.create_sale(1, 0, "Vendedor 1", cart)), ("create_purchase", lambda: db.create_purchase(1, 0, cart)),
+        ("delete_transaction", lambda: db.delete_transaction('Venta', db.get_transactions_by_date('Venta', today, today, None, 1)[0]['id_orden'])),
+    ]
+
+def explain(conn, statement, params):
+    cursor = conn.cursor(dictionary=True)
+    try: cursor.execute("EXPLAIN " + statement, params or ()); return cursor.fetchall()
+    finally: cursor.close()
+
+def bench_audit(args, conn, db):
+    """Ejecuta EXPLAIN sobre cada sentencia emitida por Database y marca los recorridos completos sobre tablas grandes."""
+    problems, log = 0, record_queries(db)
+    print(f"{'método':<34}{'tabla':<24}{'tipo':<10}{'índice':<32}{'filas':>10}  nota")
+    for name, call in audit_calls(conn, db):
+        log.clear(); call(); seen = set()
+        for statement, params in log:
+            verb = statement.lstrip().split(None, 1)[0].upper()
+            if verb not in ("SELECT", "UPDATE", "DELETE") or statement in seen: continue
+            seen.add(statement)
+            for row in explain(conn, statement, params):
+                full_scan = row['type'] in ('ALL', 'index') and (row['rows'] or 0) > args.umbral_filas
+                note = "RECORRIDO COMPLETO" if full_scan else ("filesort" if "filesort" in (row.get('Extra') or '') else "")
+                problems += full_scan
+                print(f"{name:<34}{str(row['table']):<24}{str(row['type']):<10}{str(row['key']):<32}{row['rows'] or 0:>10}  {note}")
+    print(f"\n{problems} recorridos completos sobre más de {args.umbral_filas} filas.")
+    return problems
+
+def sustained_sales(args, db, clients, products):
+    """--concurrencia hilos registrando ventas durante --duracion segundos; devuelve (latencias ms de las exitosas, fallidas, segundos)."""
+    samples, failures, lock = [], [0], threading.Lock(); deadline = time.perf_counter() + args.duracion
+    def worker():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter(); order_id = db.create_sale(random.choice(clients), 0, "bench", random_cart(products, args.lineas)); ms = (time.perf_counter() - start) * 1000
+            with lock:
+                if order_id: samples.append(ms)
+                else: failures[0] += 1
+    start = time.perf_counter(); threads = [threading.Thread(target=worker) for _ in range(args.concurrencia)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return samples, failures[0], time.perf_counter() - start
+
+def start_service(args, token):
+    """Levanta servidor_optica.py sobre la base de benchmark y espera a que responda /salud."""
+    import http.client
+    env = dict(os.environ, OPTICA_TOKEN=token, OPTICA_BD_CLAVE=args.password)
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "servidor_optica.py"), "--host", "127.0.0.1", "--puerto", str(args.puerto),
+                                "--bd-host", args.host, "--bd-usuario", args.user, "--bd", BENCH_DB, "--pool", str(args.pool)], env=env)
+    for _ in range(100):
+        if process.poll() is not None: sys.exit("servidor_optica.py terminó al iniciar.")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", args.puerto, timeout=1); conn.request("GET", "/salud", headers={"Authorization": f"Bearer {token}"})
+            if conn.getresponse().status == 200: conn.close(); return process
+        except OSError: time.sleep(0.3)
+    process.terminate(); sys.exit("servidor_optica.py no respondió.")
+
+def bench_service(args, conn, db):
+    from Proyecto import Database, RemoteDatabase
+    products = db.get_products() or []; clients = [c['id_cliente'] for c in db.get_clients(limit=5000) or []]
+    token = secrets.token_hex(16); process = start_service(args, token)
+    direct = Database(cache_size=512 if args.cache else 0); remote = RemoteDatabase(f"127.0.0.1:{args.puerto}")
+    messages = []; direct._notify = remote._notify = lambda level, title, text: messages.append(title)  # Sin QApplication no hay ventanas.
+    try:
+        if not direct.connect(args.user, args.password, args.host, BENCH_DB, pool_size=args.pool) or not remote.connect("benchmark", token): sys.exit(1)
+        print(f"{args.concurrencia} terminales simultáneas, {args.duracion} s por ruta, {args.lineas} líneas por venta, pool de {args.pool} conexiones")
+        print(f"{'ruta':<12}{'ventas/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'fallidas':>10}")
+        for name, target in (("directo", direct), ("servicio", remote)):
+            samples, failures, elapsed = sustained_sales(args, target, clients, products)
+            if not samples: print(f"{name:<12}{'sin ventas exitosas':>40}{failures:>10}"); continue
+            stats = latency_stats(samples)
+            print(f"{name:<12}{len(samples) / elapsed:>10.1f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}{failures:>10}")
+        status, health = remote._request("GET", "/salud")
+        print(f"\nServicio: {health['atendidas']} llamadas, {health['agrupadas']} agrupadas, {health['rechazadas']} rechazadas por exceso de carga")
+        if messages: print(f"Avisos: {', '.join(f'{t} x{messages.count(t)}' for t in sorted(set(messages)))}")
+    finally: remote.close(); direct.close(); process.terminate(); process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de la capa Database de la óptica.")
+    parser.add_argument("escenario", choices=["busqueda", "transacciones", "auditoria", "suite", "tabla", "servicio", "arranque", "anulacion", "exportacion", "estres", "ficha"])
+    parser.add_argument("--host", default="localhost"); parser.add_argument("--user", default="root"); parser.add_argument("--password", default="")
+    parser.add_argument("--clientes", type=int, default=200000); parser.add_argument("--repeticiones", type=int, default=20)
+    parser.add_argument("--productos", type=int, default=20000); parser.add_argument("--lineas", type=int, default=30)
+    parser.add_argument("--ordenes", type=int, default=1000000); parser.add_argument("--umbral-filas", type=int, default=1000)
+    parser.add_argument("--recetas-json", type=float, default=0.3, help="Fracción de exámenes generados con la receta en el formato JSON antiguo.")
+    parser.add_argument("--calentamiento", type=int, default=3); parser.add_argument("--salida", help="Archivo JSON donde guardar los resultados de la suite.")
+    parser.add_argument("--comparar", help="Resultados JSON de una corrida anterior contra los que comparar."); parser.add_argument("--tolerancia", type=float, default=20.0)
+    parser.add_argument("--filas", type=int, default=50000); parser.add_argument("--variante", choices=["antes", "ahora"], help=argparse.SUPPRESS)
+    parser.add_argument("--sin-cache", dest="cache", action="store_false", help="Desactiva la caché de consultas de Database para medir solo la base de datos.")
+    parser.add_argument("--sin-cargar", dest="cargar", action="store_false", help="Reutiliza los datos ya generados en la base de benchmark.")
+    parser.add_argument("--concurrencia", type=int, default=32); parser.add_argument("--duracion", type=float, default=30.0)
+    parser.add_argument("--pool", type=int, default=10); parser.add_argument("--puerto", type=int, default=8781)
+    parser.add_argument("--procesos", type=int, default=8); parser.add_argument("--calientes", type=int, default=5); parser.add_argument("--stock", type=int, default=100)
+    parser.add_argument("--anular", type=int, default=500); parser.add_argument("--ventanas", action="store_true", help="En 'arranque', mide también la ventana de venta y el reporte sobre la base de benchmark ya cargada.")
+    args = parser.parse_args()
+    if args.escenario == "tabla": bench_table_variant(args) if args.variante else bench_table(args); return
+    if args.escenario == "arranque": bench_startup(args); return
+    from datos_optica import Database
+    conn = mysql.connector.connect(host=args.host, user=args.user, password=args.password)
+    if args.cargar: load_schema(conn)
+    conn.database = BENCH_DB
+    if args.cargar:
+        seed_clients(conn, args.clientes); seed_products(conn, args.productos); seed_suppliers(conn, 100)
+        seed_orders(conn, args.ordenes, args.clientes, args.productos); seed_purchases(conn, args.ordenes // 20, 100, args.productos); seed_exams(conn, args.clientes // 2, args.clientes, json_fraction=args.recetas_json)
+        cursor = conn.cursor(); cursor.execute("ANALYZE TABLE Clientes, Productos, Proveedores, Ordenes, DetalleOrden, Compras, DetalleCompra, Examenes, Graduaciones"); cursor.fetchall(); cursor.close()
+    db = Database(cache_size=512 if args.cache else 0)
+    if not db.connect(args.user, args.password, args.host, BENCH_DB): sys.exit(1)
+    if args.cargar: db.rebuild_sales_summaries()
+    try:
+        if args.escenario == "busqueda": bench_search(args, conn, db)
+        elif args.escenario == "transacciones": bench_transactions(args, conn, db)
+        elif args.escenario == "auditoria" and bench_audit(args, conn, db): sys.exit(1)
+        elif args.escenario == "suite" and bench_suite(args, conn, db): sys.exit(1)
+        elif args.escenario == "servicio": bench_service(args, conn, db)
+        elif args.escenario == "anulacion": bench_void(args, conn, db)
+        elif args.escenario == "exportacion": bench_export(args, conn, db)
+        elif args.escenario == "estres" and bench_stress(args, conn, db): sys.exit(1)
+        elif args.escenario == "ficha": bench_profile(args, conn, db)
+    finally: db.close(); conn.close()
+
+if __name__ == "__main__":
+    main()
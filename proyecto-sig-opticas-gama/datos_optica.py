@@ -0,0 +1,1604 @@
+# datos_optica.py
+# Capa de datos de la óptica, sin Qt: Database con su pool de conexiones, caché, métricas, réplica local y
+# migraciones, más el formato JSON del servicio (wire_dumps/wire_loads). La importan Proyecto.py (la interfaz),
+# servidor_optica.py (el servicio sin interfaz) y benchmark_optica.py.
+
+import os
+import re
+import sys
+import sqlite3
+import time
+import queue
+import random
+import bisect
+import datetime
+import functools
+import json
+import uuid
+import hashlib
+import inspect
+import threading
+import contextvars
+import unicodedata
+from decimal import Decimal
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+# mysql.connector tarda en cargarse y no hace falta para mostrar LoginWindow: Database.connect() lo importa y enlaza este nombre.
+mysql = None
+
+PAGE_SIZE = 200  # Filas por página en las tablas con carga diferida.
+MONTH_NAMES = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
+FT_MIN_TOKEN = 3  # innodb_ft_min_token_size: las palabras más cortas se buscan como prefijo con LIKE.
+METRICS_PORT = 8765  # Puerto local (127.0.0.1) donde se publican las métricas en JSON, si se activa.
+REPLICA_PATH = os.path.join(os.path.expanduser("~"), ".optica_gama", "replica.sqlite3")  # Copia local para trabajar sin conexión.
+SYNC_INTERVAL_S = 15  # Cada cuánto se reintenta la conexión y se envía el diario de transacciones locales.
+REPLICA_REFRESH_S = 900  # Cada cuánto se vuelve a copiar el servidor en la réplica local.
+JOURNAL_BATCH = 50  # Transacciones locales enviadas por ciclo de sincronización.
+SERVICE_PORT = 8780  # Puerto por defecto de servidor_optica.py.
+SERVICE_IDLE_S = 30  # Una conexión al servicio sin usar por más tiempo se reabre (el servidor cierra las inactivas a los 60 s).
+# Métodos de Database que atiende el servicio. Las lecturas se pueden reintentar y agrupar entre terminales; las escrituras no.
+SERVICE_READ_METHODS = frozenset({
+    "get_clients", "get_client", "get_client_profile", "get_products", "get_product_changes", "get_suppliers", "get_exams_for_client", "get_exam_details", "get_prescriptions",
+    "find_prescriptions", "get_transactions_by_date", "count_transaction_lines", "get_transaction_lines", "get_unique_sellers", "get_sales_by_month", "get_sales_summary", "get_monthly_totals", "get_year_over_year", "get_top_products",
+})
+SERVICE_METHODS = SERVICE_READ_METHODS | {
+    "add_client", "update_client", "delete_client", "add_product", "update_product", "delete_product", "add_supplier", "update_supplier", "delete_supplier",
+    "import_entities", "add_exam", "update_exam", "delete_exam", "create_sale", "create_purchase", "delete_transaction", "delete_transactions", "rebuild_sales_summaries",
+    "reserve_stock", "release_stock",
+}
+
+# Campos editables de cada entidad: los usan GenericEditDialog y la importación masiva.
+ENTITY_FIELDS = {
+    "Clientes": {'nombre':str, 'apellido':str, 'rut':str, 'telefono':str, 'correo':str, 'direccion':str},
+    "Productos": {'nombre':str, 'tipo':str, 'marca':str, 'stock':int, 'precio_compra':int, 'precio_venta':int},
+    "Proveedores": {'nombre':str, 'contacto':str, 'telefono':str, 'direccion':str},
+}
+# Tabla, llave primaria y llave por la que se hace upsert al importar (los clientes se identifican por RUT).
+IMPORT_SPECS = {
+    "Clientes": {'table': "Clientes", 'id_col': "id_cliente", 'upsert_key': "rut"},
+    "Productos": {'table': "Productos", 'id_col': "id_producto", 'upsert_key': "id_producto"},
+    "Proveedores": {'table': "Proveedores", 'id_col': "id_proveedor", 'upsert_key': "id_proveedor"},
+}
+
+# Exportación del historial: columnas y FROM de cada tipo, una fila por línea de detalle (LEFT JOIN para incluir transacciones sin líneas).
+TRANSACTION_EXPORTS = {
+    'Venta': ("o.id_orden, o.fecha, CONCAT(c.nombre, ' ', c.apellido) AS cliente, o.vendedor, o.total, p.nombre AS producto, d.cantidad, d.precio, d.cantidad * d.precio AS subtotal",
+              "Ordenes o JOIN Clientes c ON c.id_cliente = o.id_cliente LEFT JOIN DetalleOrden d ON d.id_orden = o.id_orden LEFT JOIN Productos p ON p.id_producto = d.id_producto", "o", "id_orden"),
+    'Compra': ("o.id_compra, o.fecha, s.nombre AS proveedor, o.total, p.nombre AS producto, d.cantidad, d.precio_unitario, d.cantidad * d.precio_unitario AS subtotal",
+               "Compras o JOIN Proveedores s ON s.id_proveedor = o.id_proveedor LEFT JOIN DetalleCompra d ON d.id_compra = o.id_compra LEFT JOIN Productos p ON p.id_producto = d.id_producto", "o", "id_compra"),
+}
+# Tablas que escribe cada transacción de venta o compra; sus resultados en caché se invalidan al confirmar.
+SALE_TABLES = ("Ordenes", "DetalleOrden", "Productos", "ResumenVentasDiario", "ResumenProductosDiario")
+PURCHASE_TABLES = ("Compras", "DetalleCompra", "Productos")
+TABLE_RE = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE)\s+`?(\w+)', re.IGNORECASE)
+WRITE_VERBS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+POOL_WARM = 3  # Conexiones que se abren en segundo plano apenas se inicia sesión.
+PROFILE_ORDERS = 50  # Últimas ventas, con su detalle, que trae la ficha del cliente.
+RESERVATION_TTL_S = 900  # Vigencia de la reserva de stock de un carrito; si la terminal se cierra sin liberarla, vence sola.
+STOCK_RETRIES = 5  # Intentos de una reserva o venta ante conflicto de versión o interbloqueo.
+RETRY_ERRNOS = (1205, 1213)  # Espera de bloqueo agotada e interbloqueo: se reintenta la transacción completa.
+# Unidades de p.id_producto reservadas por otros carritos vigentes (el parámetro es el carrito propio, o NULL para no excluir ninguno).
+RESERVED_BY_OTHERS = "(SELECT COALESCE(SUM(r.cantidad), 0) FROM ReservasStock r WHERE r.id_producto = p.id_producto AND NOT r.carrito <=> %s AND r.expira > NOW(6))"
+
+def connection_errors():
+    """Errores que indican que el servidor no está alcanzable (no credenciales ni SQL inválido): activan el modo sin conexión."""
+    return (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError)
+
+def is_valid_rut(rut: str) -> bool:
+    """Valida el formato de un RUT chileno (sin puntos y con guion)."""
+    import re
+    return re.match(r'^\d{7,8}-[\dkK]$', rut.strip())
+
+# Migraciones versionadas del esquema: (versión, descripción, pasos). Cada paso es una sentencia SQL o una
+# función que recibe la Database (y devuelve None si falla). Las bases creadas con bbdd_optica.sql ya las traen
+# registradas en SchemaVersion; Database.migrate() aplica las que falten al conectarse, una terminal a la vez.
+MIGRATIONS = [
+    (1, "Búsqueda indexada y comparación sin tildes", [
+        "ALTER DATABASE CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci",
+        "ALTER TABLE Clientes CONVERT TO CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci",
+        "ALTER TABLE Productos CONVERT TO CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci",
+        "ALTER TABLE Proveedores CONVERT TO CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci",
+        "ALTER TABLE Clientes ADD INDEX idx_clientes_nombre (nombre)", "ALTER TABLE Clientes ADD INDEX idx_clientes_apellido (apellido)",
+        "ALTER TABLE Clientes ADD FULLTEXT INDEX ft_clientes (nombre, apellido)",
+        "ALTER TABLE Proveedores ADD INDEX idx_proveedores_nombre (nombre)", "ALTER TABLE Proveedores ADD INDEX idx_proveedores_contacto (contacto)",
+        "ALTER TABLE Proveedores ADD FULLTEXT INDEX ft_proveedores (nombre, contacto)",
+        "ALTER TABLE Productos ADD INDEX idx_productos_nombre (nombre)", "ALTER TABLE Productos ADD INDEX idx_productos_tipo (tipo)",
+        "ALTER TABLE Productos ADD INDEX idx_productos_marca (marca)", "ALTER TABLE Productos ADD FULLTEXT INDEX ft_productos (nombre, tipo, marca)",
+    ]),
+    (2, "Productos.updated_at para la caché del catálogo", [
+        "ALTER TABLE Productos ADD COLUMN updated_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)",
+        "ALTER TABLE Productos ADD INDEX idx_productos_updated_at (updated_at)",
+    ]),
+    (3, "Resúmenes diarios de ventas", [
+        "ALTER TABLE DetalleOrden ADD COLUMN costo INT NOT NULL DEFAULT 0",
+        "UPDATE DetalleOrden d JOIN Productos p ON p.id_producto = d.id_producto SET d.costo = p.precio_compra WHERE d.costo = 0",  # Mejor aproximación para el historial.
+        "ALTER TABLE Ordenes ADD INDEX idx_ordenes_fecha_vendedor (fecha, vendedor)",
+        "CREATE TABLE IF NOT EXISTS ResumenVentasDiario (fecha DATE NOT NULL, vendedor VARCHAR(100) NOT NULL DEFAULT '', num_ordenes INT NOT NULL DEFAULT 0, total BIGINT NOT NULL DEFAULT 0, "
+        "PRIMARY KEY (fecha, vendedor), INDEX idx_resumen_ventas_vendedor (vendedor, fecha))",
+        "CREATE TABLE IF NOT EXISTS ResumenProductosDiario (fecha DATE NOT NULL, id_producto INT NOT NULL, cantidad INT NOT NULL DEFAULT 0, ingresos BIGINT NOT NULL DEFAULT 0, costo BIGINT NOT NULL DEFAULT 0, "
+        "PRIMARY KEY (fecha, id_producto), INDEX idx_resumen_productos_producto (id_producto, fecha))",
+        lambda db: db.rebuild_sales_summaries(),
+    ]),
+    (4, "Graduaciones en columnas numéricas", [
+        "ALTER TABLE Examenes ADD INDEX idx_examenes_cliente_fecha (id_cliente, fecha)", "ALTER TABLE Examenes ADD INDEX idx_examenes_fecha (fecha)",
+        "CREATE TABLE IF NOT EXISTS Graduaciones (id_examen INT NOT NULL, distancia ENUM('lejos', 'cerca') NOT NULL, ojo ENUM('od', 'oi') NOT NULL, esf DECIMAL(5,2), cil DECIMAL(5,2), eje SMALLINT, dp TINYINT, "
+        "PRIMARY KEY (id_examen, distancia, ojo), INDEX idx_graduaciones_cil (cil), INDEX idx_graduaciones_esf (esf), FOREIGN KEY (id_examen) REFERENCES Examenes(id_examen) ON DELETE CASCADE)",
+        lambda db: db.migrate_json_prescriptions(),
+    ]),
+    (5, "Índices por fecha para el historial de transacciones", [
+        # No sobra frente a idx_ordenes_fecha_vendedor: fecha es DATE y muchas ventas comparten día. Con la llave primaria implícita
+        # este índice queda en orden (fecha, id_orden), el de las páginas del historial, mientras que (fecha, vendedor, id_orden)
+        # las desordena dentro del día y obliga a ordenar todo el rango antes del LIMIT.
+        "ALTER TABLE Ordenes ADD INDEX idx_ordenes_fecha (fecha)",
+        "ALTER TABLE Compras ADD INDEX idx_compras_fecha (fecha)",
+    ]),
+    (6, "Referencia local de ventas y compras registradas sin conexión", [
+        "ALTER TABLE Ordenes ADD COLUMN ref_local CHAR(36) NULL", "ALTER TABLE Ordenes ADD UNIQUE INDEX uq_ordenes_ref_local (ref_local)",
+        "ALTER TABLE Compras ADD COLUMN ref_local CHAR(36) NULL", "ALTER TABLE Compras ADD UNIQUE INDEX uq_compras_ref_local (ref_local)",
+    ]),
+    (7, "Versión de stock y reservas de carritos", [
+        "ALTER TABLE Productos ADD COLUMN version INT NOT NULL DEFAULT 0",
+        "CREATE TABLE IF NOT EXISTS ReservasStock (carrito CHAR(36) NOT NULL, id_producto INT NOT NULL, cantidad INT NOT NULL, expira DATETIME(6) NOT NULL, "
+        "PRIMARY KEY (carrito, id_producto), INDEX idx_reservas_producto (id_producto, expira), FOREIGN KEY (id_producto) REFERENCES Productos(id_producto) ON DELETE CASCADE)",
+    ]),
+    (8, "Índice de ventas por cliente para su ficha", [
+        "ALTER TABLE Ordenes ADD INDEX idx_ordenes_cliente_fecha (id_cliente, fecha)",
+    ]),
+]
+ALREADY_APPLIED_ERRNOS = (1050, 1060, 1061)  # Tabla, columna o índice ya existente: el paso se considera aplicado.
+MIGRATION_LOCK = "optica_migrate"  # GET_LOCK que serializa las migraciones entre terminales.
+MIGRATION_LOCK_TIMEOUT_S = 300  # Espera máxima a que otra terminal termine de migrar (la reconstrucción de resúmenes puede tardar).
+
+def normalize_text(text) -> str:
+    """Minúsculas y sin tildes, para que 'Óptica' coincida con 'optica'."""
+    return "".join(c for c in unicodedata.normalize('NFKD', str(text or '')) if not unicodedata.combining(c)).casefold()
+
+def parse_diopter(text, low=-30.0, high=30.0):
+    """Convierte '+1,25', '-0.75' o 'plano' a float; '' da None. Lanza ValueError si no es una graduación válida."""
+    text = str(text or '').strip().replace(',', '.').replace(' ', '').lower()
+    if not text: return None
+    if text in ('plano', 'pl', 'neutro', 'n'): return 0.0
+    value = float(text)
+    if not low <= value <= high: raise ValueError(text)
+    return value
+
+def normalize_header(name) -> str: return str(name or '').strip().lower().replace(' ', '_')
+
+def read_spreadsheet(path: str):
+    """Lee un CSV o XLSX fila a fila, sin cargarlo entero, y entrega (número de línea, {columna: valor})."""
+    if path.lower().endswith('.xlsx'):
+        from openpyxl import load_workbook  # Dependencia opcional: solo se necesita para planillas Excel.
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True); headers = [normalize_header(h) for h in next(rows, ())]
+            for line_no, values in enumerate(rows, start=2):
+                if any(v not in (None, '') for v in values): yield line_no, dict(zip(headers, values))
+        finally: workbook.close()
+        return
+    import csv
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        sample = f.read(4096); f.seek(0)
+        try: dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error: dialect = csv.excel
+        reader = csv.reader(f, dialect); headers = [normalize_header(h) for h in next(reader, [])]
+        for values in reader:
+            if any(v.strip() for v in values): yield reader.line_num, dict(zip(headers, values))
+
+def _wire_default(value):
+    if isinstance(value, datetime.datetime): return {"$fechahora": value.isoformat()}
+    if isinstance(value, datetime.date): return {"$fecha": value.isoformat()}
+    if isinstance(value, Decimal): return {"$decimal": str(value)}
+    raise TypeError(f"No se puede enviar un {type(value).__name__} al servicio")
+
+def _wire_object(obj):
+    if len(obj) == 1:
+        key, value = next(iter(obj.items()))
+        if key == "$fechahora": return datetime.datetime.fromisoformat(value)
+        if key == "$fecha": return datetime.date.fromisoformat(value)
+        if key == "$decimal": return Decimal(value)
+    return obj
+
+def wire_dumps(value) -> bytes:
+    """JSON del servicio: fechas y Decimal viajan etiquetados para que el otro lado reciba los mismos tipos que entrega Database."""
+    return json.dumps(value, default=_wire_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def wire_loads(data): return json.loads(data, object_hook=_wire_object)
+
+def write_spreadsheet(path: str, chunks) -> int:
+    """Escribe en CSV (separado por ';', como lo abre Excel en español) o XLSX a medida que llegan los bloques de Database.stream_query."""
+    total = 0
+    if path.lower().endswith('.xlsx'):
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True); sheet = workbook.create_sheet(); header_written = False
+        for columns, rows in chunks:
+            if not header_written: sheet.append([c.replace('_', ' ').title() for c in columns]); header_written = True
+            for row in rows: sheet.append(list(row))
+            total += len(rows)
+        workbook.save(path); return total
+    import csv
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f, delimiter=';'); header_written = False
+        for columns, rows in chunks:
+            if not header_written: writer.writerow(columns); header_written = True
+            writer.writerows(rows); total += len(rows)
+    return total
+
+def transactions_title(type, start_date, end_date, vendedor=None):
+    return f"{'Ventas' if type == 'Venta' else 'Compras'} del {start_date} al {end_date}" + (f" - Vendedor: {vendedor}" if vendedor else "")
+
+def format_cell(value):
+    if isinstance(value, datetime.date): return value.strftime('%Y-%m-%d')
+    return str(value) if value is not None else ""
+
+def write_pdf(path: str, chunks, title: str = "") -> int:
+    """
+    Tabla en PDF (A4 apaisado) dibujada con QPdfWriter a medida que llegan los bloques: cada página se
+    escribe al archivo al pasar a la siguiente, así que la memoria no crece con el número de filas.
+    """
+    from PySide6.QtCore import Qt, QRectF
+    from PySide6.QtGui import QPdfWriter, QPainter, QPageSize, QPageLayout, QFont
+    writer = QPdfWriter(path); writer.setPageSize(QPageSize(QPageSize.A4)); writer.setPageOrientation(QPageLayout.Landscape); writer.setResolution(96); writer.setTitle(title)
+    painter = QPainter(writer); regular, bold = QFont("Helvetica", 7), QFont("Helvetica", 7, QFont.Bold); painter.setFont(regular)
+    line_height = painter.fontMetrics().height() + 2; width, height = writer.width(), writer.height()
+    total, page, y, labels, col_width = 0, 1, 0, None, 0
+    def draw_row(values, font):
+        painter.setFont(font); metrics = painter.fontMetrics()
+        for i, value in enumerate(values):
+            painter.drawText(QRectF(i * col_width, y, col_width - 4, line_height), Qt.AlignLeft | Qt.AlignVCenter, metrics.elidedText(value, Qt.ElideRight, int(col_width - 4)))
+    def page_header():
+        nonlocal y
+        painter.setFont(bold); painter.drawText(QRectF(0, 0, width, line_height * 2), Qt.AlignLeft | Qt.AlignVCenter, title)
+        painter.drawText(QRectF(0, 0, width, line_height * 2), Qt.AlignRight | Qt.AlignVCenter, f"Página {page}")
+        y = line_height * 2; draw_row(labels, bold); y += line_height; painter.drawLine(0, y, width, y)
+    try:
+        for columns, rows in chunks:
+            if labels is None: labels = [c.replace('_', ' ').title() for c in columns]; col_width = width / len(labels); page_header()
+            for row in rows:
+                if y + line_height > height: writer.newPage(); page += 1; page_header()
+                draw_row([format_cell(v) for v in row], regular); y += line_height
+            total += len(rows)
+        if labels is None: painter.setFont(bold); painter.drawText(QRectF(0, 0, width, line_height * 2), Qt.AlignLeft | Qt.AlignVCenter, f"{title}: sin datos")
+    finally: painter.end()
+    return total
+
+def write_report(path: str, chunks, title: str = "") -> int:
+    """PDF si `path` termina en .pdf; si no, CSV o XLSX como write_spreadsheet."""
+    return write_pdf(path, chunks, title) if path.lower().endswith('.pdf') else write_spreadsheet(path, chunks)
+
+def with_progress(chunks, total, progress=None):
+    """Entrega los bloques tal cual y llama `progress(filas_hechas, total)` tras cada uno; si devuelve False se corta con InterruptedError."""
+    done = 0
+    for columns, rows in chunks:
+        yield columns, rows; done += len(rows)
+        if progress and progress(done, total) is False: raise InterruptedError("Exportación cancelada.")
+
+def parse_int(value) -> int:
+    """Acepta números de Excel y textos como '$ 12.990'."""
+    if isinstance(value, (int, float)): return int(value)
+    return int(str(value).replace('$', '').replace('.', '').replace(',', '').strip())
+
+def validate_entity_row(entity_name: str, raw: dict):
+    """Valida una fila importada con las mismas reglas que GenericEditDialog. Devuelve (datos, error)."""
+    spec, data = IMPORT_SPECS[entity_name], {}
+    if spec['id_col'] == spec['upsert_key'] and str(raw.get(spec['id_col']) or '').strip():
+        try: data[spec['id_col']] = parse_int(raw[spec['id_col']])
+        except ValueError: return None, f"'{spec['id_col']}' no es un número."
+    for name, ftype in ENTITY_FIELDS[entity_name].items():
+        value = raw.get(name); label = name.replace('_', ' ').title()
+        if value is None or not str(value).strip(): return None, f"El campo '{label}' no puede estar vacío."
+        if ftype == int:
+            try: value = parse_int(value)
+            except ValueError: return None, f"El campo '{label}' debe ser un número entero."
+            if value < 0: return None, f"El campo '{label}' no puede ser negativo."
+        else: value = str(value).strip()
+        if name == 'rut' and not is_valid_rut(value): return None, f"El RUT '{value}' no es válido."
+        data[name] = value
+    return data, None
+
+class ConnectionPool:
+    """
+    Pool acotado de conexiones MySQL. Cada hilo toma su propia conexión, de modo que
+    los cargadores en segundo plano y la interfaz pueden consultar al mismo tiempo.
+    La salud de la conexión solo se verifica (ping) si estuvo ociosa más de `idle_check` segundos.
+    """
+    def __init__(self, size=5, timeout=10.0, idle_check=30.0, connect_now=True, **conn_args):
+        self.size, self.timeout, self.idle_check = size, timeout, idle_check
+        self.conn_args = dict(conn_args, autocommit=True)
+        self._idle = queue.LifoQueue(); self._lock = threading.Lock(); self._created = 0; self._closed = False
+        if connect_now: self._idle.put((self._new_connection(), time.monotonic()))  # Valida las credenciales de inmediato.
+
+    def _new_connection(self):
+        with self._lock:
+            if self._created >= self.size: return None
+            self._created += 1
+        try: return mysql.connector.connect(**self.conn_args)
+        except mysql.connector.Error:
+            with self._lock: self._created -= 1
+            raise
+
+    def warm(self, count):
+        """Deja abiertas hasta `count` conexiones ociosas (sin pasar de `size`), para que las primeras consultas no paguen el handshake."""
+        while self._idle.qsize() < count:
+            try: conn = self._new_connection()
+            except mysql.connector.Error: return
+            if conn is None: return
+            self._idle.put((conn, time.monotonic()))
+
+    def _discard(self, conn):
+        with self._lock: self._created -= 1
+        try: conn.close()
+        except mysql.connector.Error: pass
+
+    def acquire(self):
+        if self._closed: raise mysql.connector.errors.PoolError("El pool de conexiones está cerrado.")
+        try: conn, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._new_connection()
+            if conn is not None: return conn
+            try: conn, last_used = self._idle.get(timeout=self.timeout)
+            except queue.Empty: raise mysql.connector.errors.PoolError(f"No hay conexiones libres tras esperar {self.timeout} s.")
+        if time.monotonic() - last_used > self.idle_check:
+            try: conn.ping(reconnect=True, attempts=2, delay=0)
+            except mysql.connector.Error:
+                self._discard(conn); conn = self._new_connection()
+                if conn is None: raise mysql.connector.errors.PoolError("No se pudo restablecer la conexión.")
+        return conn
+
+    def release(self, conn, broken=False):
+        if broken or self._closed: self._discard(conn); return
+        if conn.in_transaction:
+            try: conn.rollback()
+            except mysql.connector.Error: self._discard(conn); return
+        self._idle.put((conn, time.monotonic()))
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire(); broken = False
+        try: yield conn
+        except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError): broken = True; raise
+        finally: self.release(conn, broken)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try: conn, _ = self._idle.get_nowait()
+            except queue.Empty: break
+            self._discard(conn)
+
+class QueryCache:
+    """
+    Caché LRU acotada, con vencimiento (TTL), de los resultados de lectura de Database, indexada por consulta y parámetros.
+    Cada entrada recuerda las tablas que lee; una escritura sobre una tabla descarta todas sus entradas.
+    Las versiones por tabla evitan guardar un resultado leído mientras otro hilo escribía esa tabla.
+    Con `max_entries=0` queda desactivada. Los contadores de stats() sirven para ajustar tamaño y TTL.
+    """
+    def __init__(self, max_entries=512, ttl=30.0):
+        self.max_entries, self.ttl = max_entries, ttl
+        self._entries = OrderedDict(); self._by_table = {}; self._versions = {}; self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    @staticmethod
+    def _copy(value):
+        """Copia superficial, para que quien recibe el resultado pueda modificarlo sin alterar la caché."""
+        if isinstance(value, list): return [dict(row) if isinstance(row, dict) else row for row in value]
+        return dict(value) if isinstance(value, dict) else value
+
+    def _drop(self, key):
+        _, _, tables = self._entries.pop(key)
+        for table in tables: self._by_table.get(table, set()).discard(key)
+
+    def get(self, key):
+        """Devuelve (encontrado, valor)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None: self._drop(key)
+                self.misses += 1; return False, None
+            self._entries.move_to_end(key); self.hits += 1
+            return True, self._copy(entry[1])
+
+    def snapshot(self, tables):
+        with self._lock: return tuple(self._versions.get(t, 0) for t in tables)
+
+    def put(self, key, tables, value, snapshot):
+        if not self.max_entries or value is None: return
+        with self._lock:
+            if tuple(self._versions.get(t, 0) for t in tables) != snapshot: return  # Hubo una escritura durante la lectura.
+            if key in self._entries: self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, self._copy(value), tables)
+            for table in tables: self._by_table.setdefault(table, set()).add(key)
+            while len(self._entries) > self.max_entries: self._drop(next(iter(self._entries))); self.evictions += 1
+
+    def invalidate(self, tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                for key in list(self._by_table.pop(table, ())):
+                    if key in self._entries: self._drop(key); self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for table in list(self._versions) + list(self._by_table): self._versions[table] = self._versions.get(table, 0) + 1
+            self._entries.clear(); self._by_table.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "tasa_aciertos": round(self.hits / lookups, 3) if lookups else 0.0,
+                    "entradas": len(self._entries), "desalojos": self.evictions, "invalidaciones": self.invalidations}
+
+class QueryMetrics:
+    """
+    Instrumentación de la capa de datos y de la interfaz, activable en caliente (`enabled`).
+    Por cada método de Database acumula llamadas, consultas (idas y vueltas al servidor), filas y un
+    histograma de la duración de cada consulta; `timer()` mide igual el trabajo de la interfaz.
+    Las consultas que superan `slow_ms` quedan en un registro con sus parámetros y, si hay `explain`,
+    su plan de ejecución, que se obtiene en un hilo aparte para no demorar más al que la ejecutó.
+    """
+    BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+    def __init__(self, enabled=False, slow_ms=200.0, max_slow=200):
+        self.enabled, self.slow_ms, self.explain = enabled, slow_ms, None
+        self._lock = threading.Lock(); self._local = threading.local(); self._stats = {}; self._slow = deque(maxlen=max_slow)
+        self._explain_queue = None; self.server = None
+
+    def reset(self):
+        with self._lock: self._stats = {}; self._slow.clear()
+
+    def _entry(self, name, kind):
+        return self._stats.setdefault(name, {"tipo": kind, "llamadas": 0, "consultas": 0, "filas": 0, "total_ms": 0.0, "max_ms": 0.0, "histograma": [0] * (len(self.BUCKETS_MS) + 1)})
+
+    def _observe(self, entry, ms):
+        entry["total_ms"] += ms; entry["max_ms"] = max(entry["max_ms"], ms); entry["histograma"][bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+
+    def begin_call(self, name, call):
+        """
+        Cuenta una llamada nueva la primera vez que consulta `call`, la ficha [nombre, ya_contada] que metered_methods
+        deja en DB_CALL al entrar al método público de Database; sin ficha (None) la consulta cae en "otros".
+        """
+        if call is None:
+            if getattr(self._local, "other", False): return
+            self._local.other = True
+        else:
+            self._local.other = False
+            if call[1]: return
+            call[1] = True
+        with self._lock: self._entry(name, "bd")["llamadas"] += 1
+
+    def record_query(self, name, query, params, ms, rows):
+        with self._lock: entry = self._entry(name, "bd"); entry["consultas"] += 1; entry["filas"] += rows; self._observe(entry, ms)
+        if ms < self.slow_ms: return
+        slow = {"fecha": datetime.datetime.now().isoformat(timespec="seconds"), "metodo": name, "ms": round(ms, 1), "filas": rows, "consulta": query, "parametros": params, "plan": None}
+        with self._lock: self._slow.append(slow)
+        if self.explain and query.lstrip().split(None, 1)[0].upper() in ("SELECT", "UPDATE", "DELETE"):
+            with self._lock:  # Dos hilos con consultas lentas a la vez no deben crear cada uno su cola y su hilo.
+                if self._explain_queue is None: self._explain_queue = queue.Queue(); threading.Thread(target=self._explain_worker, daemon=True).start()
+            self._explain_queue.put(slow)
+
+    def _explain_worker(self):
+        while True: slow = self._explain_queue.get(); slow["plan"] = self.explain(slow["consulta"], slow["parametros"])
+
+    @contextmanager
+    def timer(self, name, rows=0):
+        if not self.enabled: yield; return
+        start = time.perf_counter()
+        try: yield
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            with self._lock: entry = self._entry(name, "ui"); entry["llamadas"] += 1; entry["filas"] += rows; self._observe(entry, ms)
+
+    def _percentile(self, entry, p):
+        """Percentil aproximado: límite superior del tramo del histograma donde cae."""
+        total, seen = sum(entry["histograma"]), 0
+        if not total: return 0.0
+        target = p / 100 * total
+        for bound, count in zip(self.BUCKETS_MS + (entry["max_ms"],), entry["histograma"]):
+            seen += count
+            if seen >= target: return round(min(bound, entry["max_ms"]), 2)
+        return round(entry["max_ms"], 2)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            methods = {}
+            for name, e in sorted(self._stats.items()):
+                samples = sum(e["histograma"])
+                methods[name] = dict(e, histograma=dict(zip([f"<={b}ms" for b in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"], e["histograma"])),
+                                     total_ms=round(e["total_ms"], 2), max_ms=round(e["max_ms"], 2), media_ms=round(e["total_ms"] / samples, 2) if samples else 0.0,
+                                     p50_ms=self._percentile(e, 50), p95_ms=self._percentile(e, 95), p99_ms=self._percentile(e, 99))
+            return {"fecha": datetime.datetime.now().isoformat(timespec="seconds"), "activa": self.enabled, "umbral_lento_ms": self.slow_ms, "metodos": methods, "lentas": [dict(s) for s in self._slow]}
+
+    def export(self, path):
+        with open(path, "w", encoding="utf-8") as f: json.dump(self.snapshot(), f, ensure_ascii=False, indent=2, default=str)
+
+    def serve(self, port=METRICS_PORT):
+        """Publica snapshot() en http://127.0.0.1:`port`/metrics (solo local) desde un hilo de fondo."""
+        if self.server: return self.server.server_address[1]
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') != "/metrics": self.send_error(404); return
+                body = json.dumps(metrics.snapshot(), ensure_ascii=False, default=str).encode("utf-8")
+                self.send_response(200); self.send_header("Content-Type", "application/json; charset=utf-8"); self.send_header("Content-Length", str(len(body))); self.end_headers(); self.wfile.write(body)
+            def log_message(self, *args): pass
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler); self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start(); return port
+
+    def stop_serving(self):
+        if self.server: self.server.shutdown(); self.server.server_close(); self.server = None
+
+METRICS = QueryMetrics()  # Compartida por Database y por las funciones de la interfaz.
+DB_CALL = contextvars.ContextVar("DB_CALL", default=None)  # Ficha del método público de Database más externo en curso.
+
+def metered_methods(cls):
+    """
+    Envuelve los métodos públicos de `cls` para que, con las métricas activas, el más externo deje su ficha en DB_CALL:
+    las consultas se atribuyen a get_year_over_year aunque las haga get_monthly_totals. Los generadores (stream_query)
+    la fijan solo mientras avanzan, para no atribuirle lo que haga entre bloque y bloque quien los recorre.
+    """
+    def wrap(name, fn):
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def wrapper(self, *args, **kwargs):
+                gen = fn(self, *args, **kwargs)
+                if not self.metrics.enabled or DB_CALL.get() is not None: return gen
+                return _metered_generator(gen, [name, False])
+        else:
+            @functools.wraps(fn)
+            def wrapper(self, *args, **kwargs):
+                if not self.metrics.enabled or DB_CALL.get() is not None: return fn(self, *args, **kwargs)
+                token = DB_CALL.set([name, False])
+                try: return fn(self, *args, **kwargs)
+                finally: DB_CALL.reset(token)
+        return wrapper
+    for name, fn in list(vars(cls).items()):
+        if inspect.isfunction(fn) and not name.startswith('_'): setattr(cls, name, wrap(name, fn))
+    return cls
+
+def _metered_generator(gen, call):
+    try:
+        while True:
+            token = DB_CALL.set(call)
+            try: item = next(gen)
+            except StopIteration: return
+            finally: DB_CALL.reset(token)
+            yield item
+    finally: gen.close()
+
+class MeteredCursor:
+    """Envuelve un cursor y reporta a QueryMetrics la duración (ejecución + lectura) y las filas de cada sentencia."""
+    def __init__(self, cursor, metrics, name):
+        self._cursor, self._metrics, self._name, self._pending = cursor, metrics, name, None
+    def _finish(self):
+        if self._pending is None: return
+        query, params, seconds, rows = self._pending; self._pending = None
+        self._metrics.record_query(self._name, query, params, seconds * 1000, rows if rows else max(self._cursor.rowcount or 0, 0))
+    def _timed(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        try: return getattr(self._cursor, method)(*args, **kwargs)
+        finally: self._pending[2] += time.perf_counter() - start
+    def execute(self, operation, params=None, *args, **kwargs):
+        self._finish(); self._pending = [operation, params, 0.0, 0]; return self._timed("execute", operation, params, *args, **kwargs)
+    def executemany(self, operation, seq_params, *args, **kwargs):
+        self._finish(); seq_params = list(seq_params); self._pending = [operation, seq_params[:1], 0.0, 0]; return self._timed("executemany", operation, seq_params, *args, **kwargs)
+    def fetchall(self): rows = self._timed("fetchall"); self._pending[3] += len(rows); return rows
+    def fetchmany(self, size=1): rows = self._timed("fetchmany", size); self._pending[3] += len(rows); return rows
+    def fetchone(self): row = self._timed("fetchone"); self._pending[3] += row is not None; return row
+    def close(self): self._finish(); return self._cursor.close()
+    def __getattr__(self, name): return getattr(self._cursor, name)
+
+class LocalReplica:
+    """
+    Copia local (SQLite) de Clientes, Productos, Proveedores, Examenes y Graduaciones que atiende las lecturas
+    cuando no hay conexión con el servidor, más un diario durable (WAL, synchronous=FULL) de las ventas y
+    compras registradas mientras tanto, que Database reenvía al servidor cuando vuelve la conexión.
+    Cada fila guarda además `busqueda`, el texto normalizado (sin tildes) por el que se filtra.
+    Un solo objeto se comparte entre hilos; todo acceso pasa por `_lock`.
+    """
+    # Tabla: (llave primaria, columnas, columnas de búsqueda)
+    TABLES = {
+        "Clientes": (("id_cliente",), ("id_cliente", "nombre", "apellido", "rut", "telefono", "correo", "direccion"), ("nombre", "apellido")),
+        "Productos": (("id_producto",), ("id_producto", "nombre", "tipo", "marca", "stock", "precio_compra", "precio_venta", "updated_at"), ("nombre", "tipo", "marca")),
+        "Proveedores": (("id_proveedor",), ("id_proveedor", "nombre", "contacto", "telefono", "direccion"), ("nombre", "contacto")),
+        "Examenes": (("id_examen",), ("id_examen", "id_cliente", "fecha", "diagnostico", "receta", "observaciones"), ()),
+        "Graduaciones": (("id_examen", "distancia", "ojo"), ("id_examen", "distancia", "ojo", "esf", "cil", "eje", "dp"), ()),
+    }
+    def __init__(self, path=REPLICA_PATH):
+        # La réplica guarda datos de clientes y el hash del último ingreso (remember_login): solo la lee el usuario del sistema.
+        # SQLite crea los archivos -wal y -shm con los mismos permisos que el principal.
+        directory = os.path.dirname(path); os.makedirs(directory, mode=0o700, exist_ok=True)
+        try: os.chmod(directory, 0o700)  # Instalaciones anteriores la crearon con los permisos por defecto.
+        except OSError: pass  # Carpeta ajena (una ruta compartida pasada a mano): se deja como está.
+        os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600)); os.chmod(path, 0o600)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None); self._lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL"); self.conn.execute("PRAGMA synchronous=FULL")
+        for table, (key, columns, _) in self.TABLES.items():
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)}, busqueda TEXT NOT NULL DEFAULT '', PRIMARY KEY ({', '.join(key)}))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_examenes_cliente_fecha ON Examenes (id_cliente, fecha)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_productos_updated_at ON Productos (updated_at)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS Meta (clave TEXT PRIMARY KEY, valor TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS Diario (id INTEGER PRIMARY KEY AUTOINCREMENT, ref TEXT NOT NULL UNIQUE, tipo TEXT NOT NULL, datos TEXT NOT NULL, creado_en TEXT NOT NULL, "
+                          "estado TEXT NOT NULL DEFAULT 'pendiente', intentos INTEGER NOT NULL DEFAULT 0, forzar INTEGER NOT NULL DEFAULT 0, mensaje TEXT, id_remoto INTEGER)")
+
+    @staticmethod
+    def _to_sqlite(value):
+        if isinstance(value, Decimal): return float(value)
+        if isinstance(value, (datetime.date, datetime.datetime)): return value.isoformat()
+        return value
+
+    @staticmethod
+    def _from_sqlite(column, value):
+        if value is None: return None
+        if column == "fecha": return datetime.date.fromisoformat(value)
+        if column == "updated_at": return datetime.datetime.fromisoformat(value)
+        return value
+
+    def _rows(self, query, params=()):
+        with self._lock:
+            cursor = self.conn.execute(query, params); columns = [d[0] for d in cursor.description]
+            return [{c: self._from_sqlite(c, v) for c, v in zip(columns, row)} for row in cursor.fetchall()]
+
+    def _meta(self, key):
+        with self._lock: row = self.conn.execute("SELECT valor FROM Meta WHERE clave = ?", (key,)).fetchone()
+        return row[0] if row else None
+    def _set_meta(self, key, value):
+        with self._lock: self.conn.execute("INSERT OR REPLACE INTO Meta (clave, valor) VALUES (?, ?)", (key, value))
+
+    def load(self, table, chunks):
+        """Reemplaza `table` con los bloques (columnas, filas) de Database.stream_query, en una sola transacción local."""
+        _, columns, search_cols = self.TABLES[table]; placeholders = ", ".join(["?"] * (len(columns) + 1))
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(f"DELETE FROM {table}")
+                for names, rows in chunks:
+                    search_idx = [names.index(c) for c in search_cols]
+                    self.conn.executemany(f"INSERT INTO {table} ({', '.join(names)}, busqueda) VALUES ({placeholders})",
+                                          [tuple(self._to_sqlite(v) for v in row) + (normalize_text(" ".join(str(row[i] or '') for i in search_idx)),) for row in rows])
+                self.conn.execute("COMMIT")
+            except BaseException: self.conn.execute("ROLLBACK"); raise
+
+    def last_refresh(self):
+        value = self._meta("sincronizado_en"); return datetime.datetime.fromisoformat(value) if value else None
+    def mark_refreshed(self): self._set_meta("sincronizado_en", datetime.datetime.now().isoformat())
+
+    def search(self, table, columns, search_term="", after=None, limit=None, prefix_col=None):
+        """Como Database._search/_keyset_query: sin término pagina por llave; con término filtra por palabras y pagina por desplazamiento."""
+        key = self.TABLES[table][0][0]; query, params = f"SELECT {', '.join(columns)} FROM {table}", []
+        if search_term:
+            if prefix_col and re.fullmatch(r'[\dkK.\-]+', search_term.strip()): query += f" WHERE {prefix_col} LIKE ?"; params.append(search_term.strip().replace('.', '') + "%")
+            else:
+                words = normalize_text(search_term).split()
+                if not words: return []
+                query += " WHERE " + " AND ".join(["busqueda LIKE ?"] * len(words)); params += [f"%{w}%" for w in words]
+            query += f" ORDER BY {key}"
+            if limit: query += " LIMIT ? OFFSET ?"; params += [limit, after or 0]
+        else:
+            if after is not None: query += f" WHERE {key} > ?"; params.append(after)
+            query += f" ORDER BY {key}"
+            if limit: query += " LIMIT ?"; params.append(limit)
+        return self._rows(query, params)
+
+    def get_exams_for_client(self, client_id, after=None, limit=None):
+        query, params = "SELECT id_examen, fecha, diagnostico, observaciones FROM Examenes WHERE id_cliente = ?", [client_id]
+        if after is not None: query += " AND (fecha < ? OR (fecha = ? AND id_examen < ?))"; params += [self._to_sqlite(after[0]), self._to_sqlite(after[0]), after[1]]
+        query += " ORDER BY fecha DESC, id_examen DESC"
+        if limit: query += " LIMIT ?"; params.append(limit)
+        return self._rows(query, params)
+    def get_client(self, client_id):
+        rows = self._rows("SELECT id_cliente, nombre, apellido, rut FROM Clientes WHERE id_cliente = ?", (client_id,)); return rows[0] if rows else None
+    def get_exam_details(self, exam_id):
+        rows = self._rows("SELECT id_examen, id_cliente, fecha, diagnostico, receta, observaciones FROM Examenes WHERE id_examen = ?", (exam_id,)); return rows[0] if rows else None
+    def get_client_profile(self, client_id, limit):
+        """Ficha sin conexión: la réplica no copia las ventas, así que solo trae el cliente y sus exámenes con graduaciones."""
+        clients = self._rows("SELECT id_cliente, nombre, apellido, rut, telefono, correo, direccion FROM Clientes WHERE id_cliente = ?", (client_id,))
+        if not clients: return None
+        exams = self._rows("SELECT id_examen, fecha, diagnostico, observaciones, receta FROM Examenes WHERE id_cliente = ? ORDER BY fecha DESC, id_examen DESC LIMIT ?", (client_id, limit)); by_exam = {}
+        for row in self._rows("SELECT g.id_examen, g.distancia, g.ojo, g.esf, g.cil, g.eje, g.dp FROM Graduaciones g JOIN Examenes e ON e.id_examen = g.id_examen WHERE e.id_cliente = ? ORDER BY g.distancia, g.ojo", (client_id,)):
+            by_exam.setdefault(row.pop('id_examen'), []).append(row)
+        for exam in exams: exam['graduaciones'] = by_exam.get(exam['id_examen'], [])
+        total = self._rows("SELECT COUNT(*) AS n FROM Examenes WHERE id_cliente = ?", (client_id,))[0]['n']
+        return {'cliente': dict(clients[0], num_examenes=total, num_ordenes=None, gasto_total=None, primera_compra=None, ultima_compra=None), 'examenes': exams, 'ordenes': None}
+    def get_prescriptions(self, exam_id): return self._rows("SELECT distancia, ojo, esf, cil, eje, dp FROM Graduaciones WHERE id_examen = ?", (exam_id,))
+    def get_product_changes(self, since=None):
+        query = "SELECT id_producto, nombre, tipo, marca, stock, precio_compra, precio_venta, updated_at FROM Productos"
+        rows = self._rows(query + " WHERE updated_at >= ?" if since else query, (since.isoformat(),) if since else ())
+        with self._lock: total = self.conn.execute("SELECT COUNT(*) FROM Productos").fetchone()[0]
+        return rows, total
+
+    def enqueue(self, kind, data):
+        """Guarda la transacción en el diario y aplica su efecto en el stock local, todo en una transacción durable. Devuelve el id del diario."""
+        sign = -1 if kind == 'Venta' else 1; now = datetime.datetime.now().isoformat()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                entry_id = self.conn.execute("INSERT INTO Diario (ref, tipo, datos, creado_en) VALUES (?, ?, ?, ?)", (data['ref'], kind, json.dumps(data, ensure_ascii=False, default=float), now)).lastrowid
+                self.conn.executemany("UPDATE Productos SET stock = stock + ?, updated_at = ? WHERE id_producto = ?", [(sign * d['cantidad'], now, d['id_producto']) for d in data['detalles']])
+                self.conn.execute("COMMIT"); return entry_id
+            except BaseException: self.conn.execute("ROLLBACK"); raise
+
+    def pending(self, limit=JOURNAL_BATCH): return self._rows("SELECT id, ref, tipo, datos, forzar FROM Diario WHERE estado = 'pendiente' ORDER BY id LIMIT ?", (limit,))
+    def entries(self): return self._rows("SELECT id, ref, tipo, creado_en, estado, intentos, mensaje, id_remoto FROM Diario WHERE estado != 'aplicada' ORDER BY id")
+    def counts(self):
+        with self._lock: return dict(self.conn.execute("SELECT estado, COUNT(*) FROM Diario GROUP BY estado").fetchall())
+    def mark(self, entry_id, state, message=None, remote_id=None):
+        with self._lock: self.conn.execute("UPDATE Diario SET estado = ?, mensaje = ?, id_remoto = ?, intentos = intentos + 1 WHERE id = ?", (state, message, remote_id, entry_id))
+    def resolve(self, entry_id, apply):
+        """Conflicto resuelto por el usuario: reenviarla aunque falte stock (`apply`) o descartarla."""
+        with self._lock:
+            if apply: self.conn.execute("UPDATE Diario SET estado = 'pendiente', forzar = 1 WHERE id = ? AND estado = 'conflicto'", (entry_id,))
+            else: self.conn.execute("UPDATE Diario SET estado = 'descartada' WHERE id = ? AND estado = 'conflicto'", (entry_id,))
+
+    @staticmethod
+    def _hash(user, host, password, salt): return hashlib.pbkdf2_hmac("sha256", f"{user}@{host}:{password}".encode("utf-8"), salt, 200000).hex()
+    def remember_login(self, user, host, password):
+        """
+        Guarda un hash (PBKDF2 con sal) del último ingreso válido, para permitir entrar sin conexión solo con las mismas
+        credenciales. Quien pueda leer la réplica puede atacar ese hash sin límite de intentos: por eso el archivo es 0600.
+        """
+        salt = os.urandom(16); self._set_meta("login", json.dumps({"sal": salt.hex(), "hash": self._hash(user, host, password, salt)}))
+    def check_login(self, user, host, password):
+        stored = self._meta("login")
+        if not stored or self.last_refresh() is None: return False
+        stored = json.loads(stored); return self._hash(user, host, password, bytes.fromhex(stored["sal"])) == stored["hash"]
+
+    def close(self):
+        with self._lock: self.conn.close()
+
+class _VersionConflict(Exception):
+    """El producto cambió entre la lectura y la escritura (otra versión): la transacción se repite."""
+
+@metered_methods
+class Database:
+    """
+    Gestiona todas las interacciones con la base de datos MySQL para la óptica.
+    """
+    def __init__(self, cache_size=512, cache_ttl=30.0, notifier=None):
+        self.pool = None; self.notifier = notifier; self.cache = QueryCache(cache_size, cache_ttl)
+        self.metrics = METRICS; self.metrics.explain = self._explain
+        self.replica = None; self.offline = False; self._sync_thread = None; self._sync_wakeup = threading.Event(); self._closing = False
+
+    def _notify(self, level, title, text):
+        """Los avisos van al `notifier` de la interfaz (DatabaseNotifier en Proyecto.py); sin él, a stderr."""
+        if self.notifier: self.notifier.message.emit(level, title, text)
+        else: print(f"[{level}] {title}: {text}", file=sys.stderr, flush=True)
+
+    def _cursor(self, conn, **kwargs):
+        """
+        Cursor de `conn`; con las métricas activas, uno medido y atribuido al método público de Database
+        más externo en curso (ver metered_methods).
+        """
+        cursor = conn.cursor(**kwargs)
+        if not self.metrics.enabled: return cursor
+        call = DB_CALL.get(); name = call[0] if call else "otros"
+        self.metrics.begin_call(name, call)
+        return MeteredCursor(cursor, self.metrics, name)
+
+    def _explain(self, query, params):
+        """Plan de ejecución de una consulta lenta, resumido por tabla; usa un cursor sin medir."""
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor(dictionary=True)
+                try: cursor.execute("EXPLAIN " + query, params or ()); return [{k: row[k] for k in ("table", "type", "key", "rows", "Extra")} for row in cursor.fetchall()]
+                finally: cursor.close()
+        except (mysql.connector.Error, AttributeError) as err: return f"EXPLAIN no disponible: {err}"
+
+    @staticmethod
+    def _tables(query): return tuple(sorted({t.lower() for t in TABLE_RE.findall(query)}))
+    def _invalidate(self, *tables): self.cache.invalidate([t.lower() for t in tables])
+    def _invalidate_client(self, *client_ids):
+        """Descarta la ficha en caché (get_client_profile) de esos clientes; sin ids, la de todos."""
+        self._invalidate(*([f"cliente:{i}" for i in client_ids if i is not None] or ["perfiles"]))
+
+    def connect(self, user, password, host="localhost", db_name="bbdd_optica", pool_size=5, pool_timeout=10.0, idle_check=30.0, connect_timeout=10):
+        """
+        Abre el pool. Si el servidor no responde pero hay réplica local y las credenciales coinciden con el último
+        ingreso válido, arranca sin conexión: el pool se crea vacío y el hilo de sincronización reintenta.
+        """
+        global mysql
+        import mysql.connector
+        conn_args = dict(host=host, user=user, password=password, database=db_name, connection_timeout=connect_timeout)
+        try:
+            self.pool = ConnectionPool(pool_size, pool_timeout, idle_check, **conn_args)
+        except mysql.connector.Error as err:
+            if not (self.replica and isinstance(err, connection_errors()) and self.replica.check_login(user, host, password)):
+                self._notify('critical', "Error de Conexión", f"No se pudo conectar.\nError: {err}"); return False
+            self.pool = ConnectionPool(pool_size, pool_timeout, idle_check, connect_now=False, **conn_args); self._go_offline(); self._start_sync(); return True
+        if self.replica: self.replica.remember_login(user, host, password)
+        self.migrate(); self._start_sync()
+        threading.Thread(target=self.pool.warm, args=(min(POOL_WARM, pool_size),), name="precalentar-pool", daemon=True).start(); return True
+
+    def enable_replica(self, path=REPLICA_PATH):
+        """Activa el modo sin conexión con una réplica SQLite en `path`. Se llama antes de connect()."""
+        try: self.replica = LocalReplica(path); return True
+        except (sqlite3.Error, OSError) as err: self._notify('warning', "Copia Local", f"No se pudo abrir la copia local; no habrá modo sin conexión.\n{err}"); return False
+
+    def _local(self): return self.replica if self.offline and self.replica else None
+
+    def _go_offline(self):
+        if self.offline or not self.replica: return
+        self.offline = True; self._invalidate(*LocalReplica.TABLES, *SALE_TABLES, *PURCHASE_TABLES)
+        self._notify('warning', "Sin Conexión", "No hay conexión con el servidor. Se trabajará con la copia local y las ventas y compras se enviarán cuando vuelva la conexión.")
+
+    def _start_sync(self):
+        if not self.replica or self._sync_thread: return
+        self._sync_thread = threading.Thread(target=self._sync_loop, name="sincronizacion", daemon=True); self._sync_thread.start()
+
+    def request_sync(self): self._sync_wakeup.set()
+
+    def _sync_loop(self):
+        """Hilo de fondo: detecta el regreso de la conexión, reenvía el diario local y refresca la réplica cada REPLICA_REFRESH_S."""
+        while not self._closing:
+            try:
+                if self.offline:
+                    with self.pool.connection() as conn: conn.ping()
+                    self.offline = False; self._invalidate(*LocalReplica.TABLES)
+                    self._notify('information', "Conexión Restablecida", "Se recuperó la conexión con el servidor. Enviando las transacciones registradas sin conexión.")
+                applied = self.replay_journal(); last = self.replica.last_refresh()
+                if applied or last is None or (datetime.datetime.now() - last).total_seconds() > REPLICA_REFRESH_S: self.refresh_replica()
+            except connection_errors(): self._go_offline()
+            except (mysql.connector.Error, sqlite3.Error) as err: self._notify('warning', "Sincronización", f"No se pudo sincronizar la copia local.\n{err}")
+            self._sync_wakeup.wait(SYNC_INTERVAL_S); self._sync_wakeup.clear()
+
+    def refresh_replica(self):
+        for table, (_, columns, _) in LocalReplica.TABLES.items(): self.replica.load(table, self.stream_query(f"SELECT {', '.join(columns)} FROM {table}"))
+        self.replica.mark_refreshed()
+
+    def replay_journal(self, batch=JOURNAL_BATCH):
+        """
+        Envía al servidor, en orden y por una sola conexión, hasta `batch` transacciones del diario local. Cada una va en
+        su propia transacción con su `ref_local` única, así que reenviar una que ya había llegado no la duplica.
+        Una venta sin stock suficiente en el servidor queda como 'conflicto' hasta que el usuario la fuerce o descarte.
+        """
+        entries = self.replica.pending(batch); applied = 0; clients = set()
+        if not entries: return 0
+        with self.pool.connection() as conn:
+            cursor = self._cursor(conn)
+            try:
+                for entry in entries:
+                    data = json.loads(entry['datos'], parse_float=Decimal)
+                    try:
+                        conn.start_transaction()
+                        if entry['tipo'] == 'Venta': remote_id, shortages = self._apply_sale(cursor, data, allow_shortage=bool(entry['forzar']))
+                        else: remote_id, shortages = self._apply_purchase(cursor, data), []
+                        if remote_id is None: conn.rollback(); self.replica.mark(entry['id'], 'conflicto', "Stock insuficiente en el servidor: " + ", ".join(shortages)); continue
+                        conn.commit(); self.replica.mark(entry['id'], 'aplicada', remote_id=remote_id); applied += 1
+                        if entry['tipo'] == 'Venta': clients.add(data['id_cliente'])
+                    except connection_errors(): raise
+                    except mysql.connector.IntegrityError as err:
+                        conn.rollback()
+                        if err.errno == 1062: self.replica.mark(entry['id'], 'aplicada', "Ya estaba registrada en el servidor.")
+                        else: self.replica.mark(entry['id'], 'conflicto', err.msg)
+                    except mysql.connector.Error as err: conn.rollback(); self.replica.mark(entry['id'], 'conflicto', err.msg)
+            finally: cursor.close()
+        if applied: self._invalidate(*SALE_TABLES, *PURCHASE_TABLES)
+        if clients: self._invalidate_client(*clients)
+        return applied
+
+    def sync_status(self) -> str:
+        if not self.replica: return "En línea" if self.pool else "Sin conexión"
+        counts = self.replica.counts(); pending, conflicts = counts.get('pendiente', 0), counts.get('conflicto', 0)
+        status = "⚠️ SIN CONEXIÓN: trabajando con la copia local" if self.offline else "En línea"
+        if pending: status += f" · {pending} transacciones por enviar"
+        if conflicts: status += f" · {conflicts} con conflicto (ver Sincronización)"
+        return status
+
+    @staticmethod
+    def _schema_versions(cursor):
+        try: cursor.execute("SELECT version FROM SchemaVersion")
+        except mysql.connector.Error as err:
+            if err.errno != 1146: raise  # 1146: la tabla aún no existe (base anterior a las migraciones).
+            return set()
+        return {row[0] for row in cursor.fetchall()}
+
+    def migrate(self):
+        """
+        Aplica en orden las migraciones de MIGRATIONS que aún no figuran en SchemaVersion. Devuelve las versiones aplicadas.
+        Con el esquema al día solo lee SchemaVersion. Si falta alguna, toma GET_LOCK(MIGRATION_LOCK) y vuelve a leer
+        SchemaVersion con el bloqueo tomado: si dos terminales arrancan a la vez tras una actualización, la segunda espera y
+        encuentra las versiones ya aplicadas, en vez de repetir la reconstrucción de resúmenes y chocar al registrarlas.
+        """
+        applied_now = []
+        try:
+            with self.pool.connection() as conn:
+                cursor = self._cursor(conn)
+                try:
+                    if self._schema_versions(cursor) >= {version for version, _, _ in MIGRATIONS}: return applied_now
+                    cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT_S))
+                    if cursor.fetchone()[0] != 1: raise mysql.connector.Error("Otra terminal está actualizando el esquema; vuelva a ingresar en unos minutos.")
+                    try:
+                        cursor.execute("CREATE TABLE IF NOT EXISTS SchemaVersion (version INT PRIMARY KEY, descripcion VARCHAR(255) NOT NULL, aplicada_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)")
+                        applied = self._schema_versions(cursor)
+                        for version, description, steps in MIGRATIONS:
+                            if version in applied: continue
+                            for step in steps:
+                                if callable(step):
+                                    if step(self) is None: raise mysql.connector.Error(f"Falló un paso de la migración {version}.")
+                                    continue
+                                try: cursor.execute(step)
+                                except mysql.connector.Error as err:
+                                    if err.errno not in ALREADY_APPLIED_ERRNOS: raise
+                            cursor.execute("INSERT INTO SchemaVersion (version, descripcion) VALUES (%s, %s)", (version, description)); applied_now.append(version)
+                    finally: cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,)); cursor.fetchall()
+                finally: cursor.close()
+            if applied_now: self.cache.clear()
+        except mysql.connector.Error as err:
+            self._notify('critical', "Error de Migración", f"No se pudo actualizar el esquema de la base de datos.\n\nError: {err}")
+        return applied_now
+
+    def _execute_query(self, query, params=None, fetch=None, cache=True):
+        """
+        Las lecturas con `fetch` pasan por la caché (salvo `cache=False`, para verificaciones que deben ver
+        el estado actual); las escrituras invalidan las entradas de las tablas que tocan.
+        """
+        if not self.pool or self._local(): return None
+        verb = query.lstrip().split(None, 1)[0].upper(); is_transactional = verb in WRITE_VERBS; tables = self._tables(query)
+        cacheable = cache and fetch and not is_transactional
+        if cacheable:
+            key = (query, fetch, tuple(params or ())); found, result = self.cache.get(key)
+            if found: return result
+            snapshot = self.cache.snapshot(tables)
+        for attempt in range(2):
+            try:
+                with self.pool.connection() as conn:
+                    cursor = self._cursor(conn, dictionary=True)
+                    try:
+                        cursor.execute(query, params or ())
+                        if is_transactional: self.cache.invalidate(tables); return cursor.lastrowid if verb == "INSERT" else cursor.rowcount
+                        if not fetch: return None
+                        result = cursor.fetchall() if fetch == 'all' else cursor.fetchone()
+                        if cacheable: self.cache.put(key, tables, result, snapshot)
+                        return result
+                    finally: cursor.close()
+            except connection_errors() as err:
+                # Las lecturas se reintentan una vez con otra conexión; las escrituras no, para no duplicarlas.
+                if attempt == 0 and not is_transactional: continue
+                if self.replica: self._go_offline(); return None
+                self._notify('critical', "Error de Base de Datos", f"No se pudo ejecutar la operación.\n\nError: {err}"); return None
+            except mysql.connector.Error as err:
+                self._notify('critical', "Error de Base de Datos", f"No se pudo ejecutar la operación.\n\nError: {err}"); return None
+
+    def _generic_delete(self, table_name, id_col, item_id, success_msg="Registro eliminado."):
+        query = f"DELETE FROM {table_name} WHERE {id_col} = %s"
+        try:
+            rows_affected = self._execute_query(query, (item_id,))
+            if rows_affected > 0: return {"success": True, "message": success_msg}
+            else: return {"success": False, "message": "No se encontró el registro para eliminar."}
+        except Exception as e: return {"success": False, "message": f"No se puede eliminar.\nError: {e}"}
+
+    def _keyset_query(self, query, conditions, params, key_cols, after=None, limit=None, descending=False):
+        """
+        Agrega paginación por llave (keyset) a una consulta: en vez de OFFSET, que recorre todas
+        las filas anteriores, continúa desde la última llave vista (`after`) usando el índice.
+        """
+        conditions, params = list(conditions), list(params)
+        if after is not None:
+            after = after if isinstance(after, (tuple, list)) else (after,); op = "<" if descending else ">"; branches = []
+            for i, col in enumerate(key_cols):
+                branches.append("(" + " AND ".join([f"{c} = %s" for c in key_cols[:i]] + [f"{col} {op} %s"]) + ")"); params += list(after[:i + 1])
+            conditions.append("(" + " OR ".join(branches) + ")")
+        if conditions: query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY " + ", ".join(f"{c} {'DESC' if descending else 'ASC'}" for c in key_cols)
+        if limit: query += " LIMIT %s"; params.append(limit)
+        return self._execute_query(query, tuple(params), fetch='all')
+
+    def _search(self, query, key_col, search_term, fulltext_cols, offset=None, limit=None, prefix_col=None):
+        """
+        Búsqueda indexada: las palabras de 3+ letras usan el índice FULLTEXT con coincidencia por prefijo
+        (`+ana* +perez*`) y los resultados se ordenan por relevancia; las palabras cortas se filtran con
+        `LIKE 'ab%'` sobre índices B-tree. Si el término parece un RUT se busca por prefijo en `prefix_col`.
+        Tildes y mayúsculas se ignoran gracias a la collation utf8mb4_unicode_ci. `offset` pagina el resultado.
+        """
+        words = re.findall(r'\w+', search_term); long_words = [w for w in words if len(w) >= FT_MIN_TOKEN]
+        conditions, params, order_params = [], [], []
+        if prefix_col and re.fullmatch(r'[\dkK.\-]+', search_term.strip()):
+            conditions.append(f"{prefix_col} LIKE %s"); params.append(search_term.strip().replace('.', '') + "%"); order = f"{prefix_col}, {key_col}"
+        elif long_words:
+            match = f"MATCH({', '.join(fulltext_cols)}) AGAINST (%s IN BOOLEAN MODE)"; boolean_query = " ".join(f"+{w}*" for w in long_words)
+            conditions.append(match); params.append(boolean_query); order = f"{match} DESC, {key_col}"; order_params.append(boolean_query)
+        elif not words: return []
+        else: order = key_col
+        for w in words:
+            if len(w) < FT_MIN_TOKEN: conditions.append("(" + " OR ".join(f"{c} LIKE %s" for c in fulltext_cols) + ")"); params += [f"{w}%"] * len(fulltext_cols)
+        query += " WHERE " + " AND ".join(conditions) + f" ORDER BY {order}"; params += order_params
+        if limit: query += " LIMIT %s OFFSET %s"; params += [limit, offset or 0]
+        return self._execute_query(query, tuple(params), fetch='all')
+
+    def get_clients(self, search_term: str = "", after_id=None, limit=None) -> list:
+        """Sin término pagina por llave (`after_id` = último id); con término, por relevancia (`after_id` = desplazamiento)."""
+        query = "SELECT id_cliente, nombre, apellido, rut, telefono, correo, direccion FROM Clientes"
+        if self._local(): return self.replica.search("Clientes", LocalReplica.TABLES["Clientes"][1], search_term, after_id, limit, prefix_col="rut")
+        if search_term: return self._search(query, "id_cliente", search_term, ("nombre", "apellido"), after_id, limit, prefix_col="rut")
+        return self._keyset_query(query, [], (), ("id_cliente",), after_id, limit)
+
+    def get_client(self, client_id: int) -> dict:
+        if self._local(): return self.replica.get_client(client_id)
+        return self._execute_query("SELECT id_cliente, nombre, apellido, rut FROM Clientes WHERE id_cliente = %s", (client_id,), fetch='one')
+
+    def add_client(self, data: dict):
+        if self._execute_query("SELECT 1 FROM Clientes WHERE rut = %s", (data['rut'],), fetch='one', cache=False):
+            self._notify('warning', "RUT Duplicado", f"El RUT '{data['rut']}' ya está registrado."); return None
+        return self._execute_query("INSERT INTO Clientes (nombre, apellido, rut, telefono, correo, direccion) VALUES (%s, %s, %s, %s, %s, %s)", tuple(data.values()))
+    
+    def update_client(self, client_id: int, data: dict):
+        if self._execute_query("SELECT id_cliente FROM Clientes WHERE rut = %s AND id_cliente != %s", (data['rut'], client_id), fetch='one', cache=False):
+            self._notify('warning', "RUT Duplicado", f"El RUT '{data['rut']}' ya pertenece a otro cliente."); return None
+        result = self._execute_query("UPDATE Clientes SET nombre=%s, apellido=%s, rut=%s, telefono=%s, correo=%s, direccion=%s WHERE id_cliente=%s", tuple(data.values()) + (client_id,))
+        self._invalidate_client(client_id); return result
+    
+    def delete_client(self, client_id: int):
+        links = self._execute_query("SELECT EXISTS(SELECT 1 FROM Examenes WHERE id_cliente = %s) AS examenes, EXISTS(SELECT 1 FROM Ordenes WHERE id_cliente = %s) AS ordenes", (client_id, client_id), fetch='one', cache=False)
+        if links and links['examenes']: return {"success": False, "message": "No se puede eliminar. El cliente tiene recetas médicas asociadas."}
+        if links and links['ordenes']: return {"success": False, "message": "No se puede eliminar. El cliente tiene ventas asociadas."}
+        result = self._generic_delete("Clientes", "id_cliente", client_id); self._invalidate_client(client_id); return result
+
+    def get_client_profile(self, client_id: int) -> dict:
+        """
+        Ficha completa del cliente con tres consultas fijas, sin importar cuántos exámenes o ventas tenga, sobre una misma
+        conexión e instantánea: el cliente con sus totales históricos (recetas, compras, gasto, primera y última compra),
+        sus últimos PAGE_SIZE exámenes con las graduaciones y sus últimas PROFILE_ORDERS ventas con el detalle.
+        Queda en la caché hasta que cambian los datos de ese cliente (ver _invalidate_client), se escribe en alguna de las
+        tablas que lee (un producto renombrado o importado cambia el nombre en el detalle) o vence el TTL.
+        El resultado se comparte con la caché: no modificarlo. Sin conexión, 'ordenes' es None.
+        """
+        if not self.pool: return None
+        if self._local(): return self.replica.get_client_profile(client_id, PAGE_SIZE)
+        key, tags = ("get_client_profile", client_id), (f"cliente:{client_id}", "perfiles", "clientes", "ordenes", "detalleorden", "productos", "examenes", "graduaciones")
+        found, profile = self.cache.get(key)
+        if found: return profile
+        snapshot = self.cache.snapshot(tags)
+        try:
+            with self.pool.connection() as conn:
+                cursor = self._cursor(conn, dictionary=True)
+                try:
+                    conn.start_transaction(consistent_snapshot=True, readonly=True)
+                    cursor.execute("SELECT c.id_cliente, c.nombre, c.apellido, c.rut, c.telefono, c.correo, c.direccion, (SELECT COUNT(*) FROM Examenes WHERE id_cliente = %s) AS num_examenes, "
+                                   "COUNT(o.id_orden) AS num_ordenes, COALESCE(SUM(o.total), 0) AS gasto_total, MIN(o.fecha) AS primera_compra, MAX(o.fecha) AS ultima_compra "
+                                   "FROM Clientes c LEFT JOIN Ordenes o ON o.id_cliente = c.id_cliente WHERE c.id_cliente = %s GROUP BY c.id_cliente", (client_id, client_id)); client = cursor.fetchone()
+                    exam_rows = order_rows = []
+                    if client:
+                        cursor.execute("SELECT e.id_examen, e.fecha, e.diagnostico, e.observaciones, e.receta, g.distancia, g.ojo, g.esf, g.cil, g.eje, g.dp "
+                                       "FROM (SELECT id_examen, fecha, diagnostico, observaciones, receta FROM Examenes WHERE id_cliente = %s ORDER BY fecha DESC, id_examen DESC LIMIT %s) e "
+                                       "LEFT JOIN Graduaciones g ON g.id_examen = e.id_examen ORDER BY e.fecha DESC, e.id_examen DESC, g.distancia, g.ojo", (client_id, PAGE_SIZE)); exam_rows = cursor.fetchall()
+                        cursor.execute("SELECT o.id_orden, o.fecha, o.vendedor, o.total, o.estado, d.id_producto, p.nombre, d.cantidad, d.precio "
+                                       "FROM (SELECT id_orden, fecha, vendedor, total, estado FROM Ordenes WHERE id_cliente = %s ORDER BY fecha DESC, id_orden DESC LIMIT %s) o "
+                                       "LEFT JOIN DetalleOrden d ON d.id_orden = o.id_orden LEFT JOIN Productos p ON p.id_producto = d.id_producto ORDER BY o.fecha DESC, o.id_orden DESC", (client_id, PROFILE_ORDERS)); order_rows = cursor.fetchall()
+                    conn.commit()
+                finally: cursor.close()
+        except connection_errors() as err:
+            if self.replica: self._go_offline(); return self.replica.get_client_profile(client_id, PAGE_SIZE)
+            self._notify('critical', "Error de Base de Datos", f"No se pudo cargar la ficha del cliente.\n\nError: {err}"); return None
+        except mysql.connector.Error as err:
+            self._notify('critical', "Error de Base de Datos", f"No se pudo cargar la ficha del cliente.\n\nError: {err}"); return None
+        if not client: return None
+        exams, orders = OrderedDict(), OrderedDict()
+        for row in exam_rows:
+            exam = exams.setdefault(row['id_examen'], dict({k: row[k] for k in ('id_examen', 'fecha', 'diagnostico', 'observaciones', 'receta')}, graduaciones=[]))
+            if row['distancia']: exam['graduaciones'].append({k: row[k] for k in ('distancia', 'ojo', 'esf', 'cil', 'eje', 'dp')})
+        for row in order_rows:
+            order = orders.setdefault(row['id_orden'], dict({k: row[k] for k in ('id_orden', 'fecha', 'vendedor', 'total', 'estado')}, detalles=[]))
+            if row['id_producto'] is not None: order['detalles'].append({k: row[k] for k in ('id_producto', 'nombre', 'cantidad', 'precio')})
+        client['gasto_total'] = int(client['gasto_total'])
+        profile = {'cliente': client, 'examenes': list(exams.values()), 'ordenes': list(orders.values())}
+        self.cache.put(key, tags, profile, snapshot); return profile
+
+    def get_products(self, search_term: str = "", after_id=None, limit=None) -> list:
+        query = "SELECT id_producto, nombre, tipo, marca, stock, precio_compra, precio_venta FROM Productos"
+        if self._local(): return self.replica.search("Productos", LocalReplica.TABLES["Productos"][1][:-1], search_term, after_id, limit)
+        if search_term: return self._search(query, "id_producto", search_term, ("nombre", "tipo", "marca"), after_id, limit)
+        return self._keyset_query(query, [], (), ("id_producto",), after_id, limit)
+
+    def get_product_changes(self, since=None):
+        """
+        Productos con `updated_at` >= `since` (todos si es None) y el total actual, para la caché incremental del catálogo.
+        No pasa por la caché de consultas: el sondeo debe ver también los cambios hechos desde otros equipos.
+        """
+        if self._local(): return self.replica.get_product_changes(since)
+        query = "SELECT id_producto, nombre, tipo, marca, stock, precio_compra, precio_venta, updated_at FROM Productos"
+        rows = self._execute_query(query + " WHERE updated_at >= %s" if since else query, (since,) if since else None, fetch='all', cache=False)
+        total = self._execute_query("SELECT COUNT(*) AS total FROM Productos", fetch='one', cache=False)
+        if rows is None or total is None: return None
+        return rows, total['total']
+
+    def add_product(self, data: dict):
+        return self._execute_query("INSERT INTO Productos (nombre, tipo, marca, stock, precio_compra, precio_venta) VALUES (%s, %s, %s, %s, %s, %s)", tuple(data.values()))
+
+    def update_product(self, product_id: int, data: dict):
+        return self._execute_query("UPDATE Productos SET nombre=%s, tipo=%s, marca=%s, stock=%s, precio_compra=%s, precio_venta=%s, version = version + 1 WHERE id_producto=%s", tuple(data.values()) + (product_id,))
+
+    def delete_product(self, product_id: int):
+        if self._execute_query("SELECT 1 FROM DetalleOrden WHERE id_producto = %s", (product_id,), fetch='one', cache=False): return {"success": False, "message": "No se puede eliminar. El producto está incluido en ventas registradas."}
+        if self._execute_query("SELECT 1 FROM DetalleCompra WHERE id_producto = %s", (product_id,), fetch='one', cache=False): return {"success": False, "message": "No se puede eliminar. El producto está incluido en compras registradas."}
+        return self._generic_delete("Productos", "id_producto", product_id)
+
+    def get_suppliers(self, search_term: str = "", after_id=None, limit=None) -> list:
+        query = "SELECT id_proveedor, nombre, contacto, telefono, direccion FROM Proveedores"
+        if self._local(): return self.replica.search("Proveedores", LocalReplica.TABLES["Proveedores"][1], search_term, after_id, limit)
+        if search_term: return self._search(query, "id_proveedor", search_term, ("nombre", "contacto"), after_id, limit)
+        return self._keyset_query(query, [], (), ("id_proveedor",), after_id, limit)
+        
+    def add_supplier(self, data: dict): return self._execute_query("INSERT INTO Proveedores (nombre, contacto, telefono, direccion) VALUES (%s, %s, %s, %s)", tuple(data.values()))
+    def update_supplier(self, supplier_id: int, data: dict): return self._execute_query("UPDATE Proveedores SET nombre=%s, contacto=%s, telefono=%s, direccion=%s WHERE id_proveedor=%s", tuple(data.values()) + (supplier_id,))
+    def delete_supplier(self, supplier_id: int):
+        if self._execute_query("SELECT 1 FROM Compras WHERE id_proveedor = %s", (supplier_id,), fetch='one', cache=False): return {"success": False, "message": "No se puede eliminar. El proveedor tiene compras asociadas."}
+        return self._generic_delete("Proveedores", "id_proveedor", supplier_id)
+
+    def import_entities(self, entity_name: str, rows, batch_size=500) -> dict:
+        """
+        Importa filas (número de línea, dict) validándolas y haciendo upsert en lotes con
+        INSERT ... ON DUPLICATE KEY UPDATE. Si un lote falla, se reintenta fila por fila para
+        informar exactamente qué líneas tienen errores.
+        """
+        spec, report, batch = IMPORT_SPECS[entity_name], {"procesadas": 0, "errores": []}, []
+        for line_no, raw in rows:
+            data, error = validate_entity_row(entity_name, raw)
+            if error: report["errores"].append((line_no, error)); continue
+            batch.append((line_no, data))
+            if len(batch) >= batch_size: self._upsert_batch(spec['table'], batch, report); batch = []
+        if batch: self._upsert_batch(spec['table'], batch, report)
+        return report
+
+    def _upsert_batch(self, table, batch, report):
+        groups = {}  # Las filas con y sin id explícito llevan columnas distintas.
+        for line_no, data in batch: groups.setdefault(tuple(data), []).append((line_no, data))
+        for columns, items in groups.items():
+            try: self._upsert(table, columns, [tuple(d.values()) for _, d in items]); report["procesadas"] += len(items)
+            except mysql.connector.Error:
+                for line_no, data in items:
+                    try: self._upsert(table, columns, [tuple(data.values())]); report["procesadas"] += 1
+                    except mysql.connector.Error as err: report["errores"].append((line_no, err.msg))
+
+    def _upsert(self, table, columns, values):
+        row_sql = "(" + ", ".join(["%s"] * len(columns)) + ")"; updates = ", ".join(f"{c} = VALUES({c})" for c in columns)
+        if table == "Productos": updates += ", version = version + 1"  # Puede cambiar el stock: invalida las reservas leídas con la versión anterior.
+        with self.pool.connection() as conn:
+            cursor = self._cursor(conn)
+            try: cursor.execute(f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([row_sql] * len(values))} ON DUPLICATE KEY UPDATE {updates}", [v for row in values for v in row])
+            finally: cursor.close(); self._invalidate(table, *(["perfiles"] if table == "Clientes" else []))  # Un RUT ya existente actualiza ese cliente.
+
+    def stream_query(self, query, params=None, chunk_size=1000):
+        """
+        Recorre un resultado con un cursor sin buffer: las filas se leen del servidor a medida que se
+        piden, así que la memoria no depende del tamaño del resultado. Entrega (columnas, bloque de tuplas).
+        """
+        if not self.pool: return
+        conn = self.pool.acquire(); cursor = self._cursor(conn, buffered=False); finished = False
+        try:
+            cursor.execute(query, params or ())
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows: break
+                yield cursor.column_names, rows
+            finished = True
+        finally:
+            try: cursor.close()
+            except mysql.connector.Error: finished = False
+            self.pool.release(conn, broken=not finished)  # Un cursor a medio leer deja la conexión inutilizable.
+
+    def export_entity(self, entity_name: str, path: str, chunk_size=1000):
+        spec = IMPORT_SPECS[entity_name]; columns = ", ".join([spec['id_col']] + list(ENTITY_FIELDS[entity_name]))
+        try: return write_spreadsheet(path, self.stream_query(f"SELECT {columns} FROM {spec['table']} ORDER BY {spec['id_col']}", chunk_size=chunk_size))
+        except (mysql.connector.Error, OSError, ImportError) as err: self._notify('critical', "Error de Exportación", f"No se pudo exportar.\n{err}"); return None
+
+    def get_exams_for_client(self, client_id: int, after=None, limit=None) -> list:
+        if self._local(): return self.replica.get_exams_for_client(client_id, after, limit)
+        return self._keyset_query("SELECT id_examen, fecha, diagnostico, observaciones FROM Examenes", ["id_cliente = %s"], (client_id,), ("fecha", "id_examen"), after, limit, descending=True)
+    def get_exam_details(self, exam_id: int) -> dict:
+        if self._local(): return self.replica.get_exam_details(exam_id)
+        return self._execute_query("SELECT id_examen, id_cliente, fecha, diagnostico, receta, observaciones FROM Examenes WHERE id_examen = %s", (exam_id,), fetch='one')
+    def get_prescriptions(self, exam_id: int) -> list:
+        if self._local(): return self.replica.get_prescriptions(exam_id)
+        return self._execute_query("SELECT distancia, ojo, esf, cil, eje, dp FROM Graduaciones WHERE id_examen = %s", (exam_id,), fetch='all')
+    def add_exam(self, data: dict, prescriptions: list = ()): return self._save_exam(None, data, prescriptions)
+    def update_exam(self, exam_id: int, data: dict, prescriptions: list = ()): return self._save_exam(exam_id, data, prescriptions)
+
+    def _save_exam(self, exam_id, data, prescriptions):
+        """
+        Guarda el examen y sus graduaciones (una fila por distancia y ojo en Graduaciones) en una sola transacción.
+        `prescriptions` es una lista de dicts con distancia ('lejos'/'cerca'), ojo ('od'/'oi'), esf, cil, eje y dp.
+        """
+        if not self.pool: return None
+        columns = ('id_cliente', 'fecha', 'diagnostico', 'observaciones')
+        try:
+            with self.pool.connection() as conn:
+                cursor = self._cursor(conn)
+                try:
+                    conn.start_transaction()
+                    if exam_id is None:
+                        cursor.execute("INSERT INTO Examenes (id_cliente, fecha, diagnostico, observaciones) VALUES (%s, %s, %s, %s)", tuple(data[c] for c in columns)); exam_id = result = cursor.lastrowid
+                    else:
+                        cursor.execute("UPDATE Examenes SET id_cliente=%s, fecha=%s, diagnostico=%s, observaciones=%s, receta=NULL WHERE id_examen=%s", tuple(data[c] for c in columns) + (exam_id,)); result = cursor.rowcount
+                        cursor.execute("DELETE FROM Graduaciones WHERE id_examen = %s", (exam_id,))
+                    if prescriptions:
+                        cursor.execute("INSERT INTO Graduaciones (id_examen, distancia, ojo, esf, cil, eje, dp) VALUES " + ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(prescriptions)),
+                                       [v for p in prescriptions for v in (exam_id, p['distancia'], p['ojo'], p['esf'], p['cil'], p['eje'], p['dp'])])
+                    conn.commit(); self._invalidate("Examenes", "Graduaciones"); self._invalidate_client(data['id_cliente']); return result
+                except mysql.connector.Error: conn.rollback(); raise
+                finally: cursor.close()
+        except mysql.connector.Error as err:
+            self._notify('critical', "Error de Base de Datos", f"No se pudo guardar la receta.\n\nError: {err}"); return None
+
+    def find_prescriptions(self, esf_min=None, esf_max=None, cil_min=None, cil_max=None, since=None, distancia=None) -> list:
+        """
+        Clientes con alguna graduación dentro de los rangos dados, para campañas de control. Por ejemplo,
+        astigmatismo mayor a -2.00 visto en el último año: find_prescriptions(cil_max=-2.0, since=hace_un_año).
+        Los cilindros se guardan en notación negativa, así que "mayor astigmatismo" es un `cil` más bajo.
+        """
+        conditions, params = [], []
+        for column, op, value in (("g.esf", ">=", esf_min), ("g.esf", "<=", esf_max), ("g.cil", ">=", cil_min), ("g.cil", "<=", cil_max), ("e.fecha", ">=", since), ("g.distancia", "=", distancia)):
+            if value is not None: conditions.append(f"{column} {op} %s"); params.append(value)
+        query = ("SELECT c.id_cliente, c.nombre, c.apellido, c.rut, c.telefono, c.correo, MAX(e.fecha) AS ultimo_examen, MIN(g.esf) AS esf_min, MAX(g.esf) AS esf_max, MIN(g.cil) AS cil_min "
+                 "FROM Graduaciones g JOIN Examenes e ON e.id_examen = g.id_examen JOIN Clientes c ON c.id_cliente = e.id_cliente"
+                 + (" WHERE " + " AND ".join(conditions) if conditions else "") +
+                 " GROUP BY c.id_cliente, c.nombre, c.apellido, c.rut, c.telefono, c.correo ORDER BY ultimo_examen DESC")
+        return self._execute_query(query, tuple(params), fetch='all')
+
+    def migrate_json_prescriptions(self):
+        """
+        Convierte en bloque, dentro del servidor, las recetas antiguas guardadas como JSON en Examenes.receta
+        a filas de Graduaciones (un INSERT ... SELECT por distancia y ojo) y vacía la columna de los exámenes convertidos.
+        Solo se convierten las recetas cuyos valores están vacíos o son números; las demás (y el JSON inválido) se
+        conservan en Examenes.receta, que RecipeDialog sigue mostrando, y se avisa cuántas son. Devuelve la cantidad
+        de exámenes convertidos.
+        """
+        if not self.pool: return None
+        def value(path): return f"REPLACE(TRIM(JSON_UNQUOTE(JSON_EXTRACT(receta, '{path}'))), ',', '.')"
+        def number(path, sql_type): return f"CASE WHEN {value(path)} REGEXP '^[+-]?[0-9]+([.][0-9]+)?$' THEN CAST({value(path)} AS {sql_type}) END"
+        def blank_or_number(path): return f"({value(path)} IS NULL OR {value(path)} IN ('', 'null') OR {value(path)} REGEXP '^[+-]?[0-9]+([.][0-9]+)?$')"
+        paths = [f"$.{distance}.{eye}.{field}" for distance in ('lejos', 'cerca') for eye in ('od', 'oi') for field in ('esf', 'cil', 'eje')] + ["$.lejos.dp", "$.cerca.dp"]
+        convertible = "receta IS NOT NULL AND JSON_VALID(receta) AND " + " AND ".join(blank_or_number(path) for path in paths)
+        try:
+            with self.pool.connection() as conn:
+                cursor = self._cursor(conn)
+                try:
+                    conn.start_transaction()
+                    for distance in ('lejos', 'cerca'):
+                        for eye in ('od', 'oi'):
+                            cursor.execute(f"INSERT INTO Graduaciones (id_examen, distancia, ojo, esf, cil, eje, dp) SELECT id_examen, '{distance}', '{eye}', "
+                                           f"{number(f'$.{distance}.{eye}.esf', 'DECIMAL(5,2)')}, {number(f'$.{distance}.{eye}.cil', 'DECIMAL(5,2)')}, {number(f'$.{distance}.{eye}.eje', 'SIGNED')}, "
+                                           f"{number(f'$.{distance}.dp', 'SIGNED')} FROM Examenes WHERE {convertible} AND JSON_CONTAINS_PATH(receta, 'one', '$.{distance}')")
+                    cursor.execute("UPDATE Examenes e SET e.receta = NULL WHERE e.receta = '' OR EXISTS (SELECT 1 FROM Graduaciones g WHERE g.id_examen = e.id_examen)"); converted = cursor.rowcount
+                    cursor.execute("SELECT COUNT(*) FROM Examenes WHERE receta IS NOT NULL"); rejected = cursor.fetchone()[0]
+                    conn.commit(); self._invalidate("Examenes", "Graduaciones"); self._invalidate_client()
+                    if rejected: self._notify('warning', "Migración de Recetas", f"{rejected} recetas antiguas no se pudieron convertir (valores que no son números o JSON inválido). Se conservan tal cual y se convierten al abrirlas y guardarlas.")
+                    return converted
+                except mysql.connector.Error: conn.rollback(); raise
+                finally: cursor.close()
+        except mysql.connector.Error as err:
+            self._notify('critical', "Error de Migración", f"No se pudieron convertir las recetas.\n\nError: {err}"); return None
+    def delete_exam(self, exam_id: int):
+        exam = self._execute_query("SELECT id_cliente FROM Examenes WHERE id_examen = %s", (exam_id,), fetch='one', cache=False)
+        result = self._generic_delete("Examenes", "id_examen", exam_id, "Receta eliminada.")
+        if exam: self._invalidate_client(exam['id_cliente'])
+        return result
+
+    @staticmethod
+    def _stock_deltas(details):
+        """Agrupa las cantidades por producto: un mismo producto puede aparecer en varias líneas del carrito."""
+        deltas = {}
+        for detail in details: deltas[detail['id_producto']] = deltas.get(detail['id_producto'], 0) + detail['cantidad']
+        return deltas
+
+    @staticmethod
+    def _update_stock(cursor, deltas, stock_op):
+        """Aplica todas las variaciones de stock en un solo UPDATE con CASE, en orden de id para evitar interbloqueos."""
+        ids = sorted(deltas); placeholders = ", ".join(["%s"] * len(ids))
+        cursor.execute(f"UPDATE Productos SET stock = stock {stock_op} CASE id_producto {' '.join(['WHEN %s THEN %s'] * len(ids))} END, version = version + 1 WHERE id_producto IN ({placeholders})", [v for i in ids for v in (i, deltas[i])] + ids)
+
+    @staticmethod
+    def _take_stock(cursor, deltas, cart=None):
+        """
+        Descuenta el stock solo si alcanza: un único UPDATE condicional (WHERE stock - reservado por otros >= pedido) que
+        bloquea las filas en orden de id. Si algún producto no alcanza, deshace el descuento parcial (vuelve al SAVEPOINT,
+        manteniendo los bloqueos) y devuelve esos productos.
+        """
+        ids = sorted(deltas); cases = ' '.join(['WHEN %s THEN %s'] * len(ids)); case_params = [v for i in ids for v in (i, deltas[i])]
+        cursor.execute("SAVEPOINT descuento_stock")
+        cursor.execute(f"UPDATE Productos p SET p.stock = p.stock - CASE p.id_producto {cases} END, p.version = p.version + 1 "
+                       f"WHERE p.id_producto IN ({', '.join(['%s'] * len(ids))}) AND p.stock - {RESERVED_BY_OTHERS} >= CASE p.id_producto {cases} END", case_params + ids + [cart] + case_params)
+        if cursor.rowcount == len(ids): return []
+        cursor.execute("ROLLBACK TO SAVEPOINT descuento_stock")
+        cursor.execute(f"SELECT p.id_producto, p.nombre, p.stock - {RESERVED_BY_OTHERS} FROM Productos p WHERE p.id_producto IN ({', '.join(['%s'] * len(ids))}) ORDER BY p.id_producto", [cart] + ids)
+        return [f"{nombre} (disponible {available}, pedido {deltas[id_producto]})" for id_producto, nombre, available in cursor.fetchall() if available < deltas[id_producto]]
+
+    def _retry_transaction(self, apply):
+        """
+        Ejecuta `apply(cursor)` en una transacción y devuelve su resultado, una tupla: si el primer valor es None la revierte,
+        si no la confirma. Ante interbloqueo, espera de bloqueo agotada o _VersionConflict la repite (hasta STOCK_RETRIES
+        veces, con espera aleatoria creciente); los demás errores se propagan igual que antes.
+        """
+        for attempt in range(STOCK_RETRIES):
+            try:
+                with self.pool.connection() as conn:
+                    cursor = self._cursor(conn)
+                    try:
+                        conn.start_transaction(); result = apply(cursor)
+                        if result[0] is None: conn.rollback()
+                        else: conn.commit()
+                        return result
+                    except (mysql.connector.Error, _VersionConflict): conn.rollback(); raise
+                    finally: cursor.close()
+            except (mysql.connector.Error, _VersionConflict) as err:
+                if attempt == STOCK_RETRIES - 1 or not (isinstance(err, _VersionConflict) or err.errno in RETRY_ERRNOS): raise
+                time.sleep(random.uniform(0, 0.005 * 2 ** attempt))
+
+    def reserve_stock(self, cart: str, product_id: int, quantity: int):
+        """
+        Reserva `quantity` unidades para el carrito `cart` (un uuid de la terminal) mientras se arma la venta, por
+        RESERVATION_TTL_S segundos. Bloqueo optimista: lee stock, versión y lo reservado por otros sin bloquear, y
+        escribe solo si la versión del producto no cambió entre tanto; si cambió, vuelve a intentar con los datos nuevos.
+        Devuelve {"success", "disponible", "message"}; sin conexión no reserva (la venta se valida al sincronizar).
+        """
+        if not self.pool: return None
+        if self._local(): return {"success": True, "disponible": None, "message": "Sin conexión: no se reserva."}
+        def apply(cursor):
+            cursor.execute(f"SELECT p.stock, p.version, {RESERVED_BY_OTHERS}, (SELECT COALESCE(SUM(cantidad), 0) FROM ReservasStock WHERE carrito = %s AND id_producto = p.id_producto AND expira > NOW(6)) "
+                           "FROM Productos p WHERE p.id_producto = %s", (cart, cart, product_id))
+            row = cursor.fetchone()
+            if not row: return None, {"success": False, "disponible": 0, "message": "El producto ya no existe."}
+            stock, version, reserved, own = row; available = stock - reserved - own
+            if quantity > available: return None, {"success": False, "disponible": max(0, available), "message": f"Solo quedan {max(0, available)} unidades disponibles (el resto está vendido o reservado en otros carritos)."}
+            cursor.execute("UPDATE Productos SET version = version + 1, updated_at = updated_at WHERE id_producto = %s AND version = %s", (product_id, version))
+            if cursor.rowcount != 1: raise _VersionConflict(product_id)
+            cursor.execute("INSERT INTO ReservasStock (carrito, id_producto, cantidad, expira) VALUES (%s, %s, %s, NOW(6) + INTERVAL %s SECOND) "
+                           "ON DUPLICATE KEY UPDATE cantidad = IF(expira > NOW(6), cantidad, 0) + VALUES(cantidad), expira = VALUES(expira)", (cart, product_id, quantity, RESERVATION_TTL_S))
+            cursor.execute("DELETE FROM ReservasStock WHERE id_producto = %s AND expira <= NOW(6)", (product_id,))  # Limpieza de carritos abandonados.
+            return True, {"success": True, "disponible": available - quantity, "message": "Reservado."}
+        try: return self._retry_transaction(apply)[1]
+        except _VersionConflict: return {"success": False, "disponible": None, "message": "Hay mucha demanda de este producto en este momento; intente nuevamente."}
+        except connection_errors() as err:
+            if self.replica: self._go_offline(); return {"success": True, "disponible": None, "message": "Sin conexión: no se reserva."}
+            self._notify('critical', "Error de Base de Datos", f"No se pudo reservar el stock.\n{err}"); return None
+        except mysql.connector.Error as err:
+            self._notify('critical', "Error de Base de Datos", f"No se pudo reservar el stock.\n{err}"); return None
+
+    def release_stock(self, cart: str, product_id: int = None):
+        """Libera las reservas del carrito (o solo las de un producto). Una venta registrada libera las suyas sola."""
+        if product_id is None: return self._execute_query("DELETE FROM ReservasStock WHERE carrito = %s", (cart,))
+        return self._execute_query("DELETE FROM ReservasStock WHERE carrito = %s AND id_producto = %s", (cart, product_id))
+
+    @staticmethod
+    def _update_sales_summary(cursor, fecha, vendedor, total, lines, sign):
+        """
+        Suma (sign=+1) o resta (sign=-1) una venta en los resúmenes diarios por vendedor y por producto,
+        dentro de la misma transacción que la venta. `lines` son tuplas (id_producto, cantidad, precio, costo).
+        """
+        cursor.execute("INSERT INTO ResumenVentasDiario (fecha, vendedor, num_ordenes, total) VALUES (%s, %s, %s, %s) "
+                       "ON DUPLICATE KEY UPDATE num_ordenes = num_ordenes + VALUES(num_ordenes), total = total + VALUES(total)", (fecha, vendedor or '', sign, sign * (total or 0)))
+        per_product = {}
+        for id_producto, cantidad, precio, costo in lines:
+            acc = per_product.setdefault(id_producto, [0, 0, 0]); acc[0] += cantidad; acc[1] += cantidad * precio; acc[2] += cantidad * costo
+        if per_product:  # Un solo INSERT de varias filas (executemany no reescribe bien los VALUES() del ON DUPLICATE KEY).
+            cursor.execute("INSERT INTO ResumenProductosDiario (fecha, id_producto, cantidad, ingresos, costo) VALUES " + ", ".join(["(%s, %s, %s, %s, %s)"] * len(per_product)) +
+                           " ON DUPLICATE KEY UPDATE cantidad = cantidad + VALUES(cantidad), ingresos = ingresos + VALUES(ingresos), costo = costo + VALUES(costo)",
+                           [v for id_producto, (c, i, k) in sorted(per_product.items()) for v in (fecha, id_producto, sign * c, sign * i, sign * k)])
+
+    def _apply_sale(self, cursor, sale, allow_shortage=False):
+        """
+        Registra `sale` (dict con id_cliente, fecha, total, vendedor, detalles, ref y el carrito cuyas reservas consume)
+        dentro de la transacción de `cursor`. Devuelve (id_orden, faltantes); si falta stock y no se permite, el id es
+        None y no se escribió nada; con `allow_shortage` descuenta igual (el stock puede quedar negativo).
+        """
+        details = sale['detalles']; deltas = self._stock_deltas(details); cart = sale.get('carrito')
+        shortages = self._take_stock(cursor, deltas, cart) if deltas else []
+        if shortages and not allow_shortage: return None, shortages
+        fecha = datetime.date.fromisoformat(sale['fecha']) if isinstance(sale['fecha'], str) else sale['fecha']
+        cursor.execute("INSERT INTO Ordenes (id_cliente, fecha, total, vendedor, estado, ref_local) VALUES (%s, %s, %s, %s, %s, %s)", (sale['id_cliente'], fecha, sale['total'], sale['vendedor'], 'Pagada', sale['ref']))
+        order_id = cursor.lastrowid; lines = [(d['id_producto'], d['cantidad'], d['precio_venta'], d['precio_compra']) for d in details]
+        if details:
+            cursor.executemany("INSERT INTO DetalleOrden (id_orden, id_producto, cantidad, precio, costo) VALUES (%s, %s, %s, %s, %s)", [(order_id,) + line for line in lines])
+            if shortages: self._update_stock(cursor, deltas, "-")  # Venta forzada desde el diario: descuenta aunque quede negativo.
+        if cart: cursor.execute("DELETE FROM ReservasStock WHERE carrito = %s", (cart,))
+        self._update_sales_summary(cursor, fecha, sale['vendedor'], sale['total'], lines, +1)
+        return order_id, shortages
+
+    def _apply_purchase(self, cursor, purchase):
+        details = purchase['detalles']
+        cursor.execute("INSERT INTO Compras (id_proveedor, fecha, total, ref_local) VALUES (%s, %s, %s, %s)", (purchase['id_proveedor'], purchase['fecha'], purchase['total'], purchase['ref']))
+        purchase_id = cursor.lastrowid
+        if details:
+            cursor.executemany("INSERT INTO DetalleCompra (id_compra, id_producto, cantidad, precio_unitario) VALUES (%s, %s, %s, %s)", [(purchase_id, d['id_producto'], d['cantidad'], d['precio_compra']) for d in details])
+            self._update_stock(cursor, self._stock_deltas(details), "+")
+        return purchase_id
+
+    def _journal(self, kind, data):
+        """Registra la transacción en el diario local; el id devuelto ("L12") indica que aún no llega al servidor."""
+        try: return f"L{self.replica.enqueue(kind, data)}"
+        except sqlite3.Error as err: self._notify('critical', f"Error en {kind}", f"No se pudo guardar la transacción en la copia local.\n{err}"); return None
+
+    def create_sale(self, client_id: int, total: int, vendedor: str, details: list, cart: str = None):
+        """Registra la venta descontando el stock solo si alcanza (sin contar lo reservado por otros carritos) y consume las reservas de `cart`."""
+        if not self.pool: return None
+        sale = {'id_cliente': client_id, 'fecha': datetime.date.today().isoformat(), 'total': total, 'vendedor': vendedor, 'detalles': list(details), 'ref': str(uuid.uuid4()), 'carrito': cart}
+        if self._local(): return self._journal('Venta', sale)
+        try:
+            order_id, shortages = self._retry_transaction(lambda cursor: self._apply_sale(cursor, sale))
+            if order_id is None: self._notify('warning', "Stock Insuficiente", "Otra venta se llevó parte del stock:\n" + "\n".join(shortages)); return None
+            self._invalidate(*SALE_TABLES); self._invalidate_client(client_id); return order_id
+        except connection_errors() as err:
+            # La misma `ref` evita duplicarla si el commit alcanzó a llegar antes del corte.
+            if self.replica: self._go_offline(); return self._journal('Venta', sale)
+            self._notify('critical', "Error en Venta", f"No se pudo completar la transacción.\n{err}"); return None
+        except mysql.connector.Error as err:
+            self._notify('critical', "Error en Venta", f"No se pudo completar la transacción.\n{err}"); return None
+    
+    def create_purchase(self, supplier_id: int, total: int, details: list):
+        if not self.pool: return None
+        purchase = {'id_proveedor': supplier_id, 'fecha': datetime.date.today().isoformat(), 'total': total, 'detalles': list(details), 'ref': str(uuid.uuid4())}
+        if self._local(): return self._journal('Compra', purchase)
+        try:
+            with self.pool.connection() as conn:
+                cursor = self._cursor(conn)
+                try:
+                    conn.start_transaction(); purchase_id = self._apply_purchase(cursor, purchase)
+                    conn.commit(); self._invalidate(*PURCHASE_TABLES); return purchase_id
+                except mysql.connector.Error: conn.rollback(); raise
+                finally: cursor.close()
+        except connection_errors() as err:
+            if self.replica: self._go_offline(); return self._journal('Compra', purchase)
+            self._notify('critical', "Error en Compra", f"No se pudo completar la transacción.\n{err}"); return None
+        except mysql.connector.Error as err:
+            self._notify('critical', "Error en Compra", f"No se pudo completar la transacción.\n{err}"); return None
+
+    def get_transactions_by_date(self, type: str, start_date, end_date, after=None, limit=None) -> list:
+        if type == 'Venta': query, alias, id_col = "SELECT o.id_orden, o.fecha, c.nombre, c.apellido, o.vendedor, o.total FROM Ordenes o JOIN Clientes c ON o.id_cliente = c.id_cliente", "o", "id_orden"
+        else: query, alias, id_col = "SELECT c.id_compra, c.fecha, p.nombre, c.total FROM Compras c JOIN Proveedores p ON c.id_proveedor = p.id_proveedor", "c", "id_compra"
+        return self._keyset_query(query, [f"{alias}.fecha BETWEEN %s AND %s"], (start_date, end_date), (f"{alias}.fecha", f"{alias}.{id_col}"), after, limit, descending=True)
+
+    def _transaction_lines_query(self, type, start_date, end_date, vendedor=None, page=None):
+        """
+        Consulta de exportación (ver TRANSACTION_EXPORTS) del rango [start_date, end_date], ordenada por fecha, id y línea.
+        Con `page` = (after, limit) se limita a una página de transacciones por llave (fecha, id), con todas sus líneas.
+        """
+        columns, tables, alias, id_col = TRANSACTION_EXPORTS[type]; main_table = tables.split()[0]
+        conditions, params = ["fecha BETWEEN %s AND %s"], [start_date, end_date]
+        if vendedor: conditions.append("vendedor = %s"); params.append(vendedor)
+        if page is None: query = f"SELECT {columns} FROM {tables} WHERE " + " AND ".join(f"{alias}.{c}" for c in conditions)
+        else:
+            after, limit = page
+            if after is not None: conditions.append(f"(fecha > %s OR (fecha = %s AND {id_col} > %s))"); params += [after[0], after[0], after[1]]
+            joins = tables.split(" ", 2)[2]  # Lo que sigue a "Ordenes o"/"Compras o".
+            query = (f"SELECT {columns} FROM (SELECT {id_col} FROM {main_table} WHERE {' AND '.join(conditions)} ORDER BY fecha, {id_col} LIMIT %s) AS pagina "
+                     f"JOIN {main_table} {alias} ON {alias}.{id_col} = pagina.{id_col} {joins}"); params.append(limit)
+        return query + f" ORDER BY {alias}.fecha, {alias}.{id_col}, d.id_detalle", params
+
+    def count_transaction_lines(self, type: str, start_date, end_date, vendedor: str = None):
+        """Filas que tendrá la exportación (transacciones sin líneas cuentan una), para la barra de progreso."""
+        _, tables, alias, id_col = TRANSACTION_EXPORTS[type]; main_table, detail_table = tables.split()[0], ("DetalleOrden" if type == 'Venta' else "DetalleCompra")
+        query, params = f"SELECT COUNT(*) AS filas FROM {main_table} o LEFT JOIN {detail_table} d ON d.{id_col} = o.{id_col} WHERE o.fecha BETWEEN %s AND %s", [start_date, end_date]
+        if vendedor: query += " AND o.vendedor = %s"; params.append(vendedor)
+        row = self._execute_query(query, params, fetch='one', cache=False); return row['filas'] if row else None
+
+    def get_transaction_lines(self, type: str, start_date, end_date, after=None, limit=PAGE_SIZE, vendedor: str = None) -> list:
+        """Una página de `limit` transacciones con sus líneas, continuando tras la llave `after` = (fecha, id). La usa RemoteDatabase para exportar."""
+        query, params = self._transaction_lines_query(type, start_date, end_date, vendedor, (after, limit))
+        return self._execute_query(query, params, fetch='all', cache=False)
+
+    def export_transactions(self, type: str, start_date, end_date, path: str, progress=None, vendedor: str = None, chunk_size=1000):
+        """
+        Exporta las ventas o compras del rango, una fila por línea de detalle, a CSV, XLSX o PDF. Lee con un cursor sin
+        buffer en bloques de `chunk_size` y escribe cada bloque antes de pedir el siguiente: la memoria no depende del rango.
+        `progress(filas, total)` informa el avance y puede cancelar devolviendo False. Devuelve las filas escritas.
+        """
+        total = self.count_transaction_lines(type, start_date, end_date, vendedor)
+        if total is None: return None
+        query, params = self._transaction_lines_query(type, start_date, end_date, vendedor)
+        try: return write_report(path, with_progress(self.stream_query(query, params, chunk_size), total, progress), transactions_title(type, start_date, end_date, vendedor))
+        except InterruptedError:
+            try: os.remove(path)
+            except OSError: pass
+            return None
+        except (mysql.connector.Error, OSError, ImportError) as err: self._notify('critical', "Error de Exportación", f"No se pudo exportar.\n{err}"); return None
+
+    def delete_transaction(self, type: str, transaction_id: int):
+        result = self.delete_transactions(type, [transaction_id])
+        if result['success'] and not result['eliminadas']: return {"success": False, "message": "La transacción ya no existe."}
+        return result
+
+    def delete_transactions(self, type: str, transaction_ids, chunk_size=1000):
+        """
+        Anula varias ventas o compras en una sola transacción, con sentencias por conjunto en lotes de `chunk_size` ids:
+        descuenta los resúmenes diarios (ventas), revierte el stock con un UPDATE unido al detalle agrupado por producto
+        y borra detalles y cabeceras con DELETE ... IN. Los ids que ya no existen se informan en "no_encontradas".
+        """
+        if not self.pool: return {"success": False, "message": "Sin conexión."}
+        detail_table, main_table, id_col, stock_op = ("DetalleOrden", "Ordenes", "id_orden", "+") if type == 'Venta' else ("DetalleCompra", "Compras", "id_compra", "-")
+        ids = sorted(set(transaction_ids)); found = []; clients = set()
+        try:
+            with self.pool.connection() as conn:
+                cursor = self._cursor(conn)
+                try:
+                    conn.start_transaction()
+                    for i in range(0, len(ids), chunk_size):
+                        chunk = ids[i:i + chunk_size]; in_list = ", ".join(["%s"] * len(chunk))
+                        cursor.execute(f"SELECT {id_col}, {'id_cliente' if type == 'Venta' else 'NULL'} FROM {main_table} WHERE {id_col} IN ({in_list}) ORDER BY {id_col} FOR UPDATE", chunk); locked = cursor.fetchall()
+                        chunk = [row[0] for row in locked]; clients.update(row[1] for row in locked if row[1] is not None)
+                        if not chunk: continue
+                        found += chunk; in_list = ", ".join(["%s"] * len(chunk))
+                        if type == 'Venta':
+                            cursor.execute("INSERT INTO ResumenVentasDiario (fecha, vendedor, num_ordenes, total) SELECT * FROM (SELECT fecha, COALESCE(vendedor, '') AS vendedor, -COUNT(*) AS n, -COALESCE(SUM(total), 0) AS t "
+                                           f"FROM Ordenes WHERE id_orden IN ({in_list}) GROUP BY fecha, COALESCE(vendedor, '')) AS x ON DUPLICATE KEY UPDATE num_ordenes = num_ordenes + VALUES(num_ordenes), total = total + VALUES(total)", chunk)
+                            cursor.execute("INSERT INTO ResumenProductosDiario (fecha, id_producto, cantidad, ingresos, costo) SELECT * FROM (SELECT o.fecha, d.id_producto, -SUM(d.cantidad) AS c, -SUM(d.cantidad * d.precio) AS i, -SUM(d.cantidad * d.costo) AS k "
+                                           f"FROM DetalleOrden d JOIN Ordenes o ON o.id_orden = d.id_orden WHERE d.id_orden IN ({in_list}) GROUP BY o.fecha, d.id_producto) AS x "
+                                           "ON DUPLICATE KEY UPDATE cantidad = cantidad + VALUES(cantidad), ingresos = ingresos + VALUES(ingresos), costo = costo + VALUES(costo)", chunk)
+                        cursor.execute(f"UPDATE Productos p JOIN (SELECT id_producto, SUM(cantidad) AS cantidad FROM {detail_table} WHERE {id_col} IN ({in_list}) GROUP BY id_producto) AS d "
+                                       f"ON d.id_producto = p.id_producto SET p.stock = p.stock {stock_op} d.cantidad, p.version = p.version + 1", chunk)
+                        cursor.execute(f"DELETE FROM {detail_table} WHERE {id_col} IN ({in_list})", chunk); cursor.execute(f"DELETE FROM {main_table} WHERE {id_col} IN ({in_list})", chunk)
+                    conn.commit(); self._invalidate(*(SALE_TABLES if type == 'Venta' else PURCHASE_TABLES))
+                    if clients: self._invalidate_client(*clients)
+                except mysql.connector.Error: conn.rollback(); raise
+                finally: cursor.close()
+        except mysql.connector.Error as err:
+            return {"success": False, "message": f"No se pudo eliminar la transacción.\n{err}"}
+        missing = sorted(set(ids) - set(found))
+        return {"success": True, "eliminadas": len(found), "no_encontradas": missing, "message": f"{len(found)} transacciones anuladas." + (f" {len(missing)} ya no existían." if missing else "")}
+
+    def get_unique_sellers(self) -> list:
+        # Anular una venta solo resta num_ordenes en el resumen: un vendedor con todas sus ventas anuladas no debe aparecer.
+        query = "SELECT vendedor FROM ResumenVentasDiario WHERE vendedor != '' GROUP BY vendedor HAVING SUM(num_ordenes) > 0 ORDER BY vendedor"
+        return self._execute_query(query, fetch='all')
+
+    @staticmethod
+    def _month_range(year: int, month: int):
+        """Primer día del mes y del mes siguiente: `fecha >= inicio AND fecha < fin` sí puede usar el índice, YEAR()/MONTH() no."""
+        start = datetime.date(year, month, 1)
+        return start, datetime.date(year + month // 12, month % 12 + 1, 1)
+
+    def get_sales_by_month(self, year: int, month: int, vendedor: str = None) -> list:
+        query = "SELECT fecha, id_orden, vendedor, total FROM Ordenes WHERE fecha >= %s AND fecha < %s"
+        params = list(self._month_range(year, month))
+        if vendedor:
+            query += " AND vendedor = %s"
+            params.append(vendedor)
+        query += " ORDER BY fecha ASC"
+        return self._execute_query(query, params, fetch='all')
+
+    def get_sales_summary(self, start_date, end_date, vendedor: str = None) -> dict:
+        """Número de órdenes y total vendido en [start_date, end_date), leídos del resumen diario."""
+        query = "SELECT COALESCE(SUM(num_ordenes), 0) AS num_ordenes, COALESCE(SUM(total), 0) AS total FROM ResumenVentasDiario WHERE fecha >= %s AND fecha < %s"
+        params = [start_date, end_date]
+        if vendedor: query += " AND vendedor = %s"; params.append(vendedor)
+        return self._execute_query(query, params, fetch='one')
+
+    def get_monthly_totals(self, year: int, vendedor: str = None) -> list:
+        query = "SELECT MONTH(fecha) AS mes, SUM(num_ordenes) AS num_ordenes, SUM(total) AS total FROM ResumenVentasDiario WHERE fecha >= %s AND fecha < %s"
+        params = [datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)]
+        if vendedor: query += " AND vendedor = %s"; params.append(vendedor)
+        return self._execute_query(query + " GROUP BY MONTH(fecha)", params, fetch='all')
+
+    def get_year_over_year(self, year: int, vendedor: str = None) -> list:
+        current = {r['mes']: int(r['total']) for r in self.get_monthly_totals(year, vendedor) or []}
+        previous = {r['mes']: int(r['total']) for r in self.get_monthly_totals(year - 1, vendedor) or []}
+        return [{'mes': MONTH_NAMES[m - 1], f'total_{year - 1}': previous.get(m, 0), f'total_{year}': current.get(m, 0),
+                 'variacion': f"{(current.get(m, 0) - previous[m]) * 100 / previous[m]:+.1f}%" if previous.get(m) else "-"} for m in range(1, 13)]
+
+    def get_top_products(self, start_date, end_date, limit: int = 10) -> list:
+        """Productos más vendidos en [start_date, end_date) con su margen (precio de venta - precio de compra al momento de la venta)."""
+        query = ("SELECT r.id_producto, p.nombre, SUM(r.cantidad) AS unidades, SUM(r.ingresos) AS ingresos, SUM(r.ingresos - r.costo) AS margen, "
+                 "ROUND(100 * SUM(r.ingresos - r.costo) / NULLIF(SUM(r.ingresos), 0), 1) AS margen_pct "
+                 "FROM ResumenProductosDiario r JOIN Productos p ON p.id_producto = r.id_producto WHERE r.fecha >= %s AND r.fecha < %s "
+                 "GROUP BY r.id_producto, p.nombre HAVING SUM(r.cantidad) > 0 ORDER BY ingresos DESC LIMIT %s")
+        return self._execute_query(query, (start_date, end_date, limit), fetch='all')
+
+    def rebuild_sales_summaries(self, start_date=None, end_date=None):
+        """Recalcula los resúmenes desde Ordenes/DetalleOrden (todo el historial o el rango [start_date, end_date)) en una transacción."""
+        if not self.pool: return None
+        where, params = ("WHERE o.fecha >= %s AND o.fecha < %s", (start_date, end_date)) if start_date else ("", ())
+        try:
+            with self.pool.connection() as conn:
+                cursor = self._cursor(conn)
+                try:
+                    conn.start_transaction()
+                    cursor.execute(f"DELETE FROM ResumenVentasDiario {where.replace('o.', '')}", params); cursor.execute(f"DELETE FROM ResumenProductosDiario {where.replace('o.', '')}", params)
+                    cursor.execute(f"INSERT INTO ResumenVentasDiario (fecha, vendedor, num_ordenes, total) SELECT o.fecha, COALESCE(o.vendedor, ''), COUNT(*), COALESCE(SUM(o.total), 0) FROM Ordenes o {where} GROUP BY o.fecha, COALESCE(o.vendedor, '')", params)
+                    cursor.execute(f"INSERT INTO ResumenProductosDiario (fecha, id_producto, cantidad, ingresos, costo) SELECT o.fecha, d.id_producto, SUM(d.cantidad), SUM(d.cantidad * d.precio), SUM(d.cantidad * d.costo) "
+                                   f"FROM DetalleOrden d JOIN Ordenes o ON o.id_orden = d.id_orden {where} GROUP BY o.fecha, d.id_producto", params)
+                    conn.commit(); self._invalidate("ResumenVentasDiario", "ResumenProductosDiario"); return True
+                except mysql.connector.Error: conn.rollback(); raise
+                finally: cursor.close()
+        except mysql.connector.Error as err:
+            self._notify('critical', "Error de Reportes", f"No se pudieron recalcular los resúmenes.\n{err}"); return None
+        
+    def close(self):
+        self._closing = True; self._sync_wakeup.set()
+        if self.pool: self.pool.close(); self.pool = None
@@ -0,0 +1,145 @@
+# servidor_optica.py
+# Servicio HTTP/JSON sin interfaz que atiende los métodos de Database para varias terminales a la vez:
+# un solo pool de conexiones a MySQL y una sola caché de consultas para todas, en vez de una conexión
+# directa (con credenciales de MySQL) por escritorio. Solo importa datos_optica, así que no necesita PySide6.
+#
+#   python servidor_optica.py --bd-usuario optica --bd-clave ... --token CLAVE [--pool 10] [--puerto 8780]
+#   python Proyecto.py --servidor=http://servidor:8780      (en cada terminal; la contraseña es el --token)
+#
+# Protocolo: POST /api con {"metodo": ..., "args": [...], "kwargs": {...}} o una lista de esas llamadas (lote,
+# se ejecutan en paralelo y se responden en el mismo orden); GET /salud entrega el estado del servicio.
+# Toda petición lleva "Authorization: Bearer <token>". Las fechas y Decimal viajan como en wire_dumps.
+
+import os
+import sys
+import hmac
+import time
+import asyncio
+import argparse
+import datetime
+import threading
+import traceback
+import concurrent.futures
+from datos_optica import Database, METRICS, SERVICE_METHODS, SERVICE_READ_METHODS, SERVICE_PORT, wire_dumps, wire_loads
+
+IDLE_TIMEOUT_S = 60  # Conexiones HTTP inactivas que se cierran.
+MAX_BODY = 32 * 2**20  # Tamaño máximo de una petición (una importación grande va en varios lotes).
+MAX_BATCH = 100  # Llamadas por lote.
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+def log(text): print(f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S} {text}", file=sys.stderr, flush=True)
+
+class ServiceDatabase(Database):
+    """Database del servicio: los avisos no abren ventanas, se devuelven a la terminal que hizo la llamada (o van al registro si no hay ninguna)."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs); self._call = threading.local()
+
+    def _notify(self, level, title, text):
+        messages = getattr(self._call, 'messages', None)
+        if messages is None: log(f"[{level}] {title}: {text}")
+        else: messages.append((level, title, text))
+
+    def run(self, method, args, kwargs):
+        """Ejecuta un método en el hilo actual y devuelve la respuesta de la llamada con los avisos que generó."""
+        self._call.messages = messages = []
+        try: return {"resultado": getattr(self, method)(*args, **kwargs), "mensajes": messages}
+        except Exception as err:
+            log(f"Error en {method}: {traceback.format_exc()}"); return {"error": f"{type(err).__name__}: {err}", "mensajes": messages}
+        finally: self._call.messages = None
+
+class OpticaService:
+    """
+    Atiende las peticiones en un bucle asyncio y ejecuta cada llamada en un hilo de un ThreadPoolExecutor del mismo
+    tamaño que el pool de conexiones, así ninguna llamada espera conexión dentro de Database.
+    - Límite de concurrencia: a lo más `max_pending` llamadas en curso o en cola; las demás reciben 503 de inmediato.
+    - Agrupación: lecturas idénticas que llegan mientras otra igual está en curso esperan ese mismo resultado.
+    """
+    def __init__(self, db, token, workers, max_pending=200):
+        self.db, self.token, self.max_pending = db, token, max_pending
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="servicio")
+        self._inflight = {}; self.pending = 0; self.started = time.time()
+        self.served = self.coalesced = self.rejected = self.errors = 0
+
+    def stats(self) -> dict:
+        return {"estado": "ok", "activo_desde": datetime.datetime.fromtimestamp(self.started).isoformat(timespec="seconds"), "en_curso": self.pending,
+                "atendidas": self.served, "agrupadas": self.coalesced, "rechazadas": self.rejected, "errores": self.errors,
+                "cache": self.db.cache.stats(), "metricas": METRICS.snapshot() if METRICS.enabled else None}
+
+    async def call(self, request):
+        if not isinstance(request, dict) or request.get("metodo") not in SERVICE_METHODS: return {"error": f"Método no permitido: {request.get('metodo') if isinstance(request, dict) else request!r}"}
+        method, args, kwargs = request["metodo"], request.get("args") or [], request.get("kwargs") or {}
+        key = wire_dumps([method, args, kwargs]) if method in SERVICE_READ_METHODS else None
+        if key in self._inflight: self.coalesced += 1; return await asyncio.shield(self._inflight[key])
+        if self.pending >= self.max_pending: self.rejected += 1; return {"error": "Servidor ocupado, intente nuevamente.", "ocupado": True}
+        self.pending += 1
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self.db.run, method, args, kwargs)
+        if key: self._inflight[key] = future
+        try: response = await asyncio.shield(future)
+        finally:
+            self.pending -= 1
+            if key: self._inflight.pop(key, None)
+        self.served += 1; self.errors += "error" in response
+        return response
+
+    async def dispatch(self, method, path, headers, body):
+        if not hmac.compare_digest(headers.get("authorization", ""), f"Bearer {self.token}"): return 401, {"error": "Clave del servicio incorrecta."}
+        if path == "/salud": return 200, self.stats()
+        if path != "/api": return 404, {"error": f"Ruta desconocida: {path}"}
+        if method != "POST": return 405, {"error": "Use POST."}
+        try: request = wire_loads(body)
+        except ValueError as err: return 400, {"error": f"JSON inválido: {err}"}
+        if isinstance(request, list):
+            if len(request) > MAX_BATCH: return 413, {"error": f"A lo más {MAX_BATCH} llamadas por lote."}
+            return 200, list(await asyncio.gather(*(self.call(r) for r in request)))
+        response = await self.call(request)
+        return (503 if response.get("ocupado") else 200), response
+
+    async def handle(self, reader, writer):
+        """Una conexión HTTP/1.1 persistente: atiende peticiones en orden hasta que el cliente cierra o pasa IDLE_TIMEOUT_S sin actividad."""
+        try:
+            while True:
+                try: request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT_S)
+                except asyncio.TimeoutError: break
+                if not request_line.strip(): break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2); headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""): break
+                    name, _, value = line.decode("latin-1").partition(":"); headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY: status, payload = 413, {"error": "Petición demasiado grande."}
+                else: status, payload = await self.dispatch(method, path.split("?", 1)[0], headers, await reader.readexactly(length) if length else b"")
+                data = wire_dumps(payload); close = headers.get("connection", "").lower() == "close" or length > MAX_BODY
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json; charset=utf-8\r\nContent-Length: {len(data)}\r\n{'Connection: close' + chr(13) + chr(10) if close else ''}\r\n".encode("latin-1") + data)
+                await writer.drain()
+                if close: break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError): pass
+        finally: writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        log(f"Servicio escuchando en {host}:{port} ({self.executor._max_workers} hilos, hasta {self.max_pending} llamadas en curso)")
+        async with server: await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Servicio HTTP/JSON de la base de datos de la óptica para varias terminales.")
+    parser.add_argument("--host", default="0.0.0.0"); parser.add_argument("--puerto", type=int, default=SERVICE_PORT)
+    parser.add_argument("--token", default=os.environ.get("OPTICA_TOKEN"), help="Clave que deben enviar las terminales (o variable OPTICA_TOKEN).")
+    parser.add_argument("--bd-host", default="localhost"); parser.add_argument("--bd-usuario", default="root"); parser.add_argument("--bd", default="bbdd_optica")
+    parser.add_argument("--bd-clave", default=os.environ.get("OPTICA_BD_CLAVE", ""), help="Contraseña de MySQL (o variable OPTICA_BD_CLAVE).")
+    parser.add_argument("--pool", type=int, default=10, help="Conexiones a MySQL, y por lo tanto llamadas ejecutándose a la vez.")
+    parser.add_argument("--max-pendientes", type=int, default=200, help="Llamadas en curso o en cola antes de responder 503.")
+    parser.add_argument("--cache", type=int, default=4096, help="Entradas de la caché de consultas compartida.")
+    parser.add_argument("--metricas", action="store_true", help="Activa las métricas por método (se incluyen en /salud).")
+    args = parser.parse_args()
+    if not args.token: parser.error("falta --token (o la variable OPTICA_TOKEN)")
+    METRICS.enabled = args.metricas
+    db = ServiceDatabase(cache_size=args.cache)
+    if not db.connect(args.bd_usuario, args.bd_clave, args.bd_host, args.bd, pool_size=args.pool): sys.exit(1)
+    service = OpticaService(db, args.token, args.pool, args.max_pendientes)
+    try: asyncio.run(service.serve(args.host, args.puerto))
+    except KeyboardInterrupt: log("Deteniendo el servicio.")
+    finally: service.executor.shutdown(wait=True); db.close()
+
+if __name__ == "__main__":
+    main()